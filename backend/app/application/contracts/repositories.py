@@ -1,4 +1,4 @@
-from typing import Protocol
+from typing import Any, Iterable, Iterator, Protocol
 
 
 class UserRepository(Protocol):
@@ -58,6 +58,26 @@ class PUCRepository(Protocol):
         """
         ...
 
+    def iter_projection(
+        self,
+        owner_id: str,
+        fields: Iterable[str] = ("codigo", "nombre", "categoria", "clase", "nivel_agrupacion"),
+    ) -> Iterator[dict[str, Any]]:
+        """
+        Recorre las cuentas del owner como diccionarios con "id" y solo los campos indicados.
+        """
+        ...
+
+    def iter_transactional_projection(
+        self,
+        owner_id: str,
+        fields: Iterable[str] = ("codigo", "nombre", "categoria", "clase", "nivel_agrupacion"),
+    ) -> Iterator[dict[str, Any]]:
+        """
+        Como iter_projection, limitado a cuentas con nivel de agrupación transaccional.
+        """
+        ...
+
     def get_by_owner_and_code(self, owner_id: str, codigo: str) -> object | None:
         """Obtiene una cuenta PUC específica por owner y código"""
         ...
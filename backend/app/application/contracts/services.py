@@ -1,4 +1,4 @@
-from typing import Any, Protocol
+from typing import IO, Any, Protocol
 
 
 class PasswordHasher(Protocol):
@@ -35,6 +35,14 @@ class InvoiceWorkbookBuilder(Protocol):
     ) -> bytes:
         ...
 
+    def build_to(
+        self,
+        fp: IO[bytes],
+        invoices: list[object],
+        suggestions_map: dict[str, list[object]],
+    ) -> None:
+        ...
+
 
 class PUCMapper(Protocol):
     def map_to_specific_account(
@@ -55,3 +63,11 @@ class PUCMapper(Protocol):
             }
         """
         ...
+
+    def map_to_specific_accounts_batch(
+        self,
+        owner_id: str,
+        requests: list[dict[str, Any]],
+    ) -> list[dict[str, Any]]:
+        """Mapea varios códigos genéricos en una sola consulta, preservando el orden."""
+        ...
@@ -1,6 +1,10 @@
 from __future__ import annotations
 
+import asyncio
 from dataclasses import dataclass
+from functools import partial
+from tempfile import SpooledTemporaryFile
+from typing import IO, Iterator
 
 from app.application.contracts.repositories import (
     AISuggestionRepository,
@@ -14,6 +18,11 @@ from app.application.contracts.services import (
 from app.domain import AISuggestion, Invoice
 
 
+# Hasta este tamaño el libro exportado vive en memoria; por encima se vuelca a disco
+_EXPORT_SPOOL_MAX_BYTES = 8 * 1024 * 1024
+_EXPORT_CHUNK_BYTES = 64 * 1024
+
+
 class InvoiceAlreadyExistsError(RuntimeError):
     pass
 
@@ -52,6 +61,11 @@ class UploadInvoice:
         if existing is not None:
             raise InvoiceAlreadyExistsError("La factura ya fue cargada previamente")
 
+        # El parser entrega el XML original en bytes; se decodifica una vez, ya liberado el árbol
+        raw_xml = parsed.get("raw_xml", content)
+        if isinstance(raw_xml, bytes):
+            raw_xml = raw_xml.decode("utf-8", errors="ignore")
+
         invoice = Invoice.create(
             owner_id=owner_id,
             external_id=external_id,
@@ -65,7 +79,7 @@ class UploadInvoice:
             tax_amount=parsed["tax_amount"],
             lines=parsed["lines"],
             original_filename=filename,
-            raw_xml=parsed["raw_xml"],
+            raw_xml=raw_xml,
         )
 
         self.invoice_repository.add(invoice)
@@ -88,17 +102,39 @@ class GenerateAccountingSuggestions:
             self._serialize_invoice(invoice),
             owner_id=owner_id
         )
-        ai_suggestions = self._coerce_ai_suggestions(ai_payload)
-        
+        suggestions = self._select_suggestions(invoice, ai_payload)
+        self.suggestion_repository.replace_for_invoice(invoice.id, suggestions)
+        return suggestions
+
+    async def aexecute(self, *, owner_id: str, invoice_id: str) -> list[AISuggestion]:
+        """
+        Variante asíncrona de execute: la espera a Gemini no ocupa el event loop y
+        las lecturas/escrituras del repositorio corren en hilos.
+        """
+        invoice = await asyncio.to_thread(self.invoice_repository.get_by_id, invoice_id)
+        if invoice is None or invoice.owner_id != owner_id:
+            raise InvoiceNotFoundError("La factura no existe para el usuario indicado")
+
+        payload = self._serialize_invoice(invoice)
+        agenerate = getattr(self.ai_service, "agenerate_suggestions", None)
+        if agenerate is not None:
+            ai_payload = await agenerate(payload, owner_id=owner_id)
+        else:
+            ai_payload = await asyncio.to_thread(
+                partial(self.ai_service.generate_suggestions, payload, owner_id=owner_id)
+            )
+        suggestions = self._select_suggestions(invoice, ai_payload)
+        await asyncio.to_thread(self.suggestion_repository.replace_for_invoice, invoice.id, suggestions)
+        return suggestions
+
+    def _select_suggestions(self, invoice: Invoice, ai_payload: list[dict[str, object]]) -> list[AISuggestion]:
         # Si IA generó sugerencias, usarlas
+        ai_suggestions = self._coerce_ai_suggestions(ai_payload)
         if ai_suggestions:
-            self.suggestion_repository.replace_for_invoice(invoice.id, ai_suggestions)
             return ai_suggestions
         
         # Prioridad 2: Fallback genérico si IA no está disponible
-        fallback_suggestions = self._build_generic_fallback(invoice)
-        self.suggestion_repository.replace_for_invoice(invoice.id, fallback_suggestions)
-        return fallback_suggestions
+        return self._build_generic_fallback(invoice)
 
     def _build_generic_fallback(self, invoice: Invoice) -> list[AISuggestion]:
         """
@@ -205,6 +241,31 @@ class ExportInvoicesToExcel:
     workbook_builder: InvoiceWorkbookBuilder
 
     def execute(self, *, owner_id: str) -> bytes:
+        ordered, suggestions_map = self._load(owner_id)
+        return self.workbook_builder.build(ordered, suggestions_map)
+
+    def execute_iter(self, *, owner_id: str, chunk_size: int = _EXPORT_CHUNK_BYTES) -> Iterator[bytes]:
+        """
+        Escribe el libro en un archivo temporal y devuelve un iterador de bloques para
+        transmitirlo sin copiarlo completo en memoria. La validación ocurre antes de
+        devolver el iterador, así NoInvoicesToExportError se lanza antes de responder.
+        """
+        ordered, suggestions_map = self._load(owner_id)
+        spooled = SpooledTemporaryFile(max_size=_EXPORT_SPOOL_MAX_BYTES)
+        try:
+            self.workbook_builder.build_to(spooled, ordered, suggestions_map)
+            spooled.seek(0)
+        except BaseException:
+            spooled.close()
+            raise
+        return self._iter_chunks(spooled, chunk_size)
+
+    @staticmethod
+    def _iter_chunks(fp: IO[bytes], chunk_size: int) -> Iterator[bytes]:
+        with fp:
+            yield from iter(lambda: fp.read(chunk_size), b"")
+
+    def _load(self, owner_id: str) -> tuple[list[Invoice], dict[str, list[AISuggestion]]]:
         invoices = self.invoice_repository.list_for_user(owner_id)
         if not invoices:
             raise NoInvoicesToExportError("No hay facturas para exportar")
@@ -214,7 +275,7 @@ class ExportInvoicesToExcel:
             invoice.id: self.suggestion_repository.list_for_invoice(invoice.id)
             for invoice in ordered
         }
-        return self.workbook_builder.build(ordered, suggestions_map)
+        return ordered, suggestions_map
 
 
 @dataclass(slots=True)
@@ -3,14 +3,30 @@ Casos de uso para gestión de PUC (Plan Único de Cuentas) personalizado.
 """
 from __future__ import annotations
 
+import asyncio
 import logging
 from dataclasses import dataclass
+from pathlib import Path
+from typing import Callable, Iterator
 
 from app.application.contracts.repositories import PUCRepository
 from app.domain.puc import PUCAccount
 
 logger = logging.getLogger(__name__)
 
+# Campos que se exportan para la IA, en el orden del JSON de salida
+_EXPORT_FIELDS = (
+    "codigo",
+    "nombre",
+    "categoria",
+    "clase",
+    "relacion_con",
+    "maneja_vencimientos",
+    "diferencia_fiscal",
+    "activo",
+    "nivel_agrupacion",
+)
+
 
 class PUCUploadError(Exception):
     """Error al subir archivo PUC"""
@@ -22,8 +38,9 @@ class UploadPUC:
     
     puc_repository: PUCRepository
     excel_parser: object  # PUCExcelParserService
+    on_catalog_changed: Callable[[str], None] | None = None  # p.ej. invalidar cachés del catálogo
     
-    def execute(self, owner_id: str, file_content: bytes, filename: str) -> dict:
+    def execute(self, owner_id: str, file_content: bytes | Path, filename: str) -> dict:
         """
         Procesa un archivo Excel con PUC y lo guarda en el repositorio.
         Reemplaza cualquier PUC existente del mismo owner.
@@ -35,30 +52,33 @@ class UploadPUC:
             }
         """
         try:
-            # Validar extensión del archivo
-            if not filename.lower().endswith((".xlsx", ".xls")):
-                raise PUCUploadError("El archivo debe ser formato Excel (.xlsx o .xls)")
+            self._validate_filename(filename)
             
             # Parsear el archivo Excel (detecta automáticamente .xlsx o .xls)
             logger.info(f"📊 Parseando archivo Excel: {filename}")
             accounts = self.excel_parser.parse_excel(file_content, owner_id, filename)
             
-            if not accounts:
-                raise PUCUploadError("No se encontraron cuentas válidas en el archivo")
+            return self._replace_catalog(owner_id, accounts)
             
-            # Eliminar PUC anterior del mismo owner
-            logger.info(f"🗑️ Eliminando PUC anterior del owner {owner_id}")
-            self.puc_repository.delete_all_by_owner(owner_id)
+        except PUCUploadError:
+            raise
+        except Exception as e:
+            logger.error(f"❌ Error subiendo PUC: {e}")
+            raise PUCUploadError(f"Error procesando archivo: {str(e)}") from e
+
+    async def aexecute(self, owner_id: str, file_content: bytes | Path, filename: str) -> dict:
+        """
+        Variante asíncrona de execute: el parseo y la escritura en el repositorio
+        corren fuera del event loop. `file_content` puede ser la ruta del archivo
+        ya volcado a disco, para no mantener la subida completa en memoria.
+        """
+        try:
+            self._validate_filename(filename)
             
-            # Guardar nuevo PUC
-            logger.info(f"💾 Guardando {len(accounts)} cuentas PUC")
-            self.puc_repository.add_bulk(accounts)
+            logger.info(f"📊 Parseando archivo Excel: {filename}")
+            accounts = await self.excel_parser.parse_excel_async(file_content, owner_id, filename)
             
-            logger.info(f"✅ PUC cargado exitosamente: {len(accounts)} cuentas")
-            return {
-                "total_cuentas": len(accounts),
-                "mensaje": f"PUC cargado exitosamente con {len(accounts)} cuentas",
-            }
+            return await asyncio.to_thread(self._replace_catalog, owner_id, accounts)
             
         except PUCUploadError:
             raise
@@ -66,6 +86,32 @@ class UploadPUC:
             logger.error(f"❌ Error subiendo PUC: {e}")
             raise PUCUploadError(f"Error procesando archivo: {str(e)}") from e
 
+    @staticmethod
+    def _validate_filename(filename: str) -> None:
+        # Validar extensión del archivo
+        if not filename.lower().endswith((".xlsx", ".xls")):
+            raise PUCUploadError("El archivo debe ser formato Excel (.xlsx o .xls)")
+
+    def _replace_catalog(self, owner_id: str, accounts: list[PUCAccount]) -> dict:
+        if not accounts:
+            raise PUCUploadError("No se encontraron cuentas válidas en el archivo")
+        
+        # Eliminar PUC anterior del mismo owner
+        logger.info(f"🗑️ Eliminando PUC anterior del owner {owner_id}")
+        self.puc_repository.delete_all_by_owner(owner_id)
+        
+        # Guardar nuevo PUC
+        logger.info(f"💾 Guardando {len(accounts)} cuentas PUC")
+        self.puc_repository.add_bulk(accounts)
+        if self.on_catalog_changed is not None:
+            self.on_catalog_changed(owner_id)
+        
+        logger.info(f"✅ PUC cargado exitosamente: {len(accounts)} cuentas")
+        return {
+            "total_cuentas": len(accounts),
+            "mensaje": f"PUC cargado exitosamente con {len(accounts)} cuentas",
+        }
+
 
 @dataclass
 class ListPUC:
@@ -162,26 +208,13 @@ class GetPUCForAI:
                 ...
             ]
         """
-        # Obtener todas las cuentas (sin paginación para la IA)
-        accounts, _ = self.puc_repository.list_by_owner(
-            owner_id=owner_id,
-            search=None,
-            limit=10000,  # Límite alto para obtener todas
-            offset=0,
-        )
-        
-        # Convertir a diccionarios simples
-        return [
-            {
-                "codigo": acc.codigo,
-                "nombre": acc.nombre,
-                "categoria": acc.categoria,
-                "clase": acc.clase,
-                "relacion_con": acc.relacion_con,
-                "maneja_vencimientos": acc.maneja_vencimientos,
-                "diferencia_fiscal": acc.diferencia_fiscal,
-                "activo": acc.activo,
-                "nivel_agrupacion": acc.nivel_agrupacion,
-            }
-            for acc in accounts
-        ]
+        return list(self.iter_accounts(owner_id))
+    
+    def iter_accounts(self, owner_id: str) -> Iterator[dict]:
+        """
+        Igual que execute, pero cuenta por cuenta desde el cursor del repositorio,
+        sin materializar el PUC completo en memoria.
+        """
+        for row in self.puc_repository.iter_projection(owner_id, fields=_EXPORT_FIELDS):
+            row.pop("id", None)
+            yield row
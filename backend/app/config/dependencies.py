@@ -37,6 +37,8 @@ from app.infrastructure.repositories.firestore_invoices import FirestoreInvoiceR
 from app.infrastructure.repositories.firestore_suggestions import FirestoreAISuggestionRepository
 from app.infrastructure.repositories.firestore_puc import FirestorePUCRepository
 from app.infrastructure.services.puc_excel_parser import PUCExcelParserService
+from app.infrastructure.services.puc_mapper import PUCMapperService
+from app.infrastructure.services.rate_limit import GeminiRateLimiter
 
 
 @dataclass(slots=True)
@@ -45,6 +47,10 @@ class Settings:
     token_expire_minutes: int
     firebase_credentials_defined: bool
     gemini_api_key: str | None
+    gemini_rpm: int
+    gemini_tpm: int
+    max_invoice_upload_bytes: int
+    password_hash_rounds: int
 
 
 @lru_cache
@@ -52,11 +58,19 @@ def get_settings() -> Settings:
     # Use only FIREBASE_CREDENTIALS_JSON; do not consider FIREBASE_CREDENTIALS_PATH
     firebase_credentials_defined = bool(os.getenv("FIREBASE_CREDENTIALS_JSON"))
     
+    # Las cubetas RPM/TPM viven en la memoria de cada proceso: con varios workers de uvicorn
+    # la cuota de la API key (compartida) se reparte entre ellos
+    workers = max(1, int(os.getenv("WEB_CONCURRENCY", "1")))
     return Settings(
         secret_key=os.getenv("SECRET_KEY", "insecure-development-secret"),
         token_expire_minutes=int(os.getenv("TOKEN_EXPIRE_MINUTES", "60")),
         firebase_credentials_defined=firebase_credentials_defined,
         gemini_api_key=os.getenv("GEMINI_API_KEY"),
+        gemini_rpm=max(1, int(os.getenv("GEMINI_RPM", "1000")) // workers),
+        gemini_tpm=max(1, int(os.getenv("GEMINI_TPM", "4000000")) // workers),
+        max_invoice_upload_bytes=int(os.getenv("MAX_INVOICE_UPLOAD_BYTES", str(10 * 1024 * 1024))),
+        # Costo de bcrypt; solo las pruebas lo bajan (4 es el mínimo que acepta bcrypt)
+        password_hash_rounds=int(os.getenv("PASSWORD_HASH_ROUNDS", "12")),
     )
 
 
@@ -88,9 +102,18 @@ def get_puc_excel_parser() -> PUCExcelParserService:
     return PUCExcelParserService()
 
 
+@lru_cache
+def get_puc_mapper() -> PUCMapperService:
+    """Factory para el mapeo de códigos genéricos a cuentas del PUC del owner"""
+    return PUCMapperService(
+        puc_repository=get_puc_repository(),
+        api_key=get_settings().gemini_api_key,
+    )
+
+
 @lru_cache
 def get_password_hasher() -> BcryptPasswordHasher:
-    return BcryptPasswordHasher()
+    return BcryptPasswordHasher(rounds=get_settings().password_hash_rounds)
 
 
 @lru_cache
@@ -125,7 +148,11 @@ def get_ai_suggestion_service() -> GeminiAISuggestionService:
     
     return GeminiAISuggestionService(
         api_key=api_key,
-        puc_repository=get_puc_repository()
+        puc_repository=get_puc_repository(),
+        rate_limiter=GeminiRateLimiter(
+            requests_per_minute=settings.gemini_rpm,
+            tokens_per_minute=settings.gemini_tpm,
+        ),
     )
 
 
@@ -169,6 +196,28 @@ def get_firebase_project_id() -> str | None:
         return None
 
 
+# Factorías con estado por usuario/factura: los repositorios y los servicios de IA que guardan
+# cachés por owner (catálogo, respuestas, cuentas) y retienen el repositorio PUC con el que se
+# crearon. Los demás servicios (hasher, tokens, parser, Excel) no guardan datos y se conservan
+_STATEFUL_FACTORIES = (
+    get_user_repository,
+    get_invoice_repository,
+    get_ai_suggestion_repository,
+    get_puc_repository,
+    get_ai_suggestion_service,
+    get_puc_mapper,
+)
+
+
+def reset_repositories() -> None:
+    """
+    Descarta los repositorios cacheados (p.ej. entre pruebas) junto con los servicios de IA
+    que los referencian, para que no arrastren el repositorio ni las cachés anteriores.
+    """
+    for factory in _STATEFUL_FACTORIES:
+        factory.cache_clear()
+
+
 def get_register_user_use_case() -> RegisterUser:
     return RegisterUser(
         user_repository=get_user_repository(),
@@ -221,11 +270,20 @@ def get_invoice_detail_use_case() -> GetInvoiceDetail:
     )
 
 
+def _invalidate_puc_caches(owner_id: str) -> None:
+    """Descarta el catálogo cacheado en los servicios de IA, solo si ya fueron creados."""
+    if get_ai_suggestion_service.cache_info().currsize:
+        get_ai_suggestion_service().invalidate(owner_id)
+    if get_puc_mapper.cache_info().currsize:
+        get_puc_mapper().invalidate(owner_id)
+
+
 def get_upload_puc_use_case() -> UploadPUC:
     """Factory para el caso de uso de subir PUC"""
     return UploadPUC(
         puc_repository=get_puc_repository(),
         excel_parser=get_puc_excel_parser(),
+        on_catalog_changed=_invalidate_puc_caches,
     )
 
 
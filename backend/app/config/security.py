@@ -1,6 +1,9 @@
 from __future__ import annotations
 
+from collections import OrderedDict
+from threading import Lock
 from typing import Annotated
+import time
 
 from fastapi import Depends, HTTPException, status
 from fastapi.security import HTTPAuthorizationCredentials, HTTPBearer
@@ -10,8 +13,21 @@ from app.domain import User
 
 bearer_scheme = HTTPBearer(auto_error=False)
 
+# Usuario ya resuelto por token, por poco tiempo: evita leer el repositorio en cada petición
+_USER_CACHE_TTL_SECONDS = 30
+_USER_CACHE_MAX_ENTRIES = 4096
+_user_cache: OrderedDict[str, tuple[User, float]] = OrderedDict()
+_user_cache_lock = Lock()
+
 
 def resolve_user_from_token(token: str) -> User | None:
+    now = time.time()
+    with _user_cache_lock:
+        hit = _user_cache.get(token)
+        if hit is not None and now < hit[1]:
+            _user_cache.move_to_end(token)
+            return hit[0]
+
     token_service = get_token_service()
     try:
         payload = token_service.verify_token(token)
@@ -23,7 +39,19 @@ def resolve_user_from_token(token: str) -> User | None:
         return None
 
     user_repository = get_user_repository()
-    return user_repository.get_by_id(subject)
+    user = user_repository.get_by_id(subject)
+    if user is not None:
+        # Nunca más allá del vencimiento del propio token
+        expires_at = now + _USER_CACHE_TTL_SECONDS
+        token_exp = payload.get("exp")
+        if isinstance(token_exp, (int, float)):
+            expires_at = min(expires_at, float(token_exp))
+        with _user_cache_lock:
+            _user_cache[token] = (user, expires_at)
+            _user_cache.move_to_end(token)
+            while len(_user_cache) > _USER_CACHE_MAX_ENTRIES:
+                _user_cache.popitem(last=False)
+    return user
 
 
 async def get_current_user(
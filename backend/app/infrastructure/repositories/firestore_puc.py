@@ -4,12 +4,18 @@ Implementación del repositorio de PUC usando Firestore.
 from __future__ import annotations
 
 import logging
-from typing import Any
+from typing import Any, Iterable, Iterator
 
 from app.domain.puc import PUCAccount
 
 logger = logging.getLogger(__name__)
 
+# Firestore no compara sin mayúsculas: el parser de Excel guarda "Transaccional" sin importar
+# cómo venga escrito; las otras grafías cubren cuentas cargadas antes de esa normalización
+_TRANSACTIONAL_LEVELS = ["Transaccional", "transaccional", "TRANSACCIONAL"]
+# Campos que revisa _matches_search; son los únicos que se descargan al buscar
+_SEARCHABLE_FIELDS = ["codigo", "nombre", "categoria", "clase", "relacion_con"]
+
 
 class FirestorePUCRepository:
     """Repositorio de cuentas PUC usando Firestore"""
@@ -58,28 +64,87 @@ class FirestorePUCRepository:
         """Lista cuentas PUC del owner con paginación y búsqueda"""
         query = self.db.collection(self.collection_name).where("owner_id", "==", owner_id)
         
-        # Obtener todos los documentos para hacer búsqueda local (Firestore tiene limitaciones en búsqueda de texto)
-        all_docs = list(query.stream())
-        
-        # Filtrar por búsqueda si se proporciona
-        if search and search.strip():
-            search_lower = search.lower().strip()
-            filtered_docs = [
-                doc for doc in all_docs
-                if self._matches_search(doc.to_dict(), search_lower)
-            ]
-        else:
-            filtered_docs = all_docs
-        
-        total_count = len(filtered_docs)
-        
-        # Aplicar paginación
-        paginated_docs = filtered_docs[offset:offset + limit]
-        
-        accounts = [self._from_dict(doc.id, doc.to_dict()) for doc in paginated_docs]
+        if not (search and search.strip()):
+            # Sin búsqueda: total por agregación y solo la página viaja desde Firestore.
+            # Sin order_by para conservar el orden por id de documento (y no exigir índice compuesto)
+            total_count = self._count(query)
+            docs = query.offset(offset).limit(limit).stream()
+            return [self._from_dict(doc.id, doc.to_dict()) for doc in docs], total_count
+        
+        # Búsqueda por subcadena: Firestore no la soporta, se filtra localmente pero
+        # descargando solo los campos buscables; después se leen completos los de la página
+        search_lower = search.lower().strip()
+        matching_ids = [
+            doc.id
+            for doc in query.select(_SEARCHABLE_FIELDS).stream()
+            if self._matches_search(doc.to_dict() or {}, search_lower)
+        ]
+        total_count = len(matching_ids)
+        
+        page_ids = matching_ids[offset:offset + limit]
+        if not page_ids:
+            return [], total_count
+        
+        collection = self.db.collection(self.collection_name)
+        # get_all no garantiza el orden: se reordena según la búsqueda
+        snapshots = {
+            doc.id: doc
+            for doc in self.db.get_all([collection.document(doc_id) for doc_id in page_ids])
+            if doc.exists
+        }
+        accounts = [
+            self._from_dict(doc_id, snapshots[doc_id].to_dict())
+            for doc_id in page_ids
+            if doc_id in snapshots
+        ]
         
         return accounts, total_count
     
+    def iter_projection(
+        self,
+        owner_id: str,
+        fields: Iterable[str] = ("codigo", "nombre", "categoria", "clase", "nivel_agrupacion"),
+    ) -> Iterator[dict[str, Any]]:
+        """
+        Recorre las cuentas del owner pidiendo a Firestore solo los campos indicados.
+        Entrega diccionarios livianos con el id del documento, sin construir entidades.
+        """
+        field_names = [name for name in fields if name != "id"]
+        query = (
+            self.db.collection(self.collection_name)
+            .where("owner_id", "==", owner_id)
+            .select(field_names)
+        )
+        for doc in query.stream():
+            data = doc.to_dict() or {}
+            projected = {"id": doc.id}
+            for name in field_names:
+                projected[name] = data.get(name, "")
+            yield projected
+
+    def iter_transactional_projection(
+        self,
+        owner_id: str,
+        fields: Iterable[str] = ("codigo", "nombre", "categoria", "clase", "nivel_agrupacion"),
+    ) -> Iterator[dict[str, Any]]:
+        """
+        Igual que iter_projection, pero Firestore solo devuelve las cuentas transaccionales.
+        Requiere el índice compuesto (owner_id, nivel_agrupacion).
+        """
+        field_names = [name for name in fields if name != "id"]
+        query = (
+            self.db.collection(self.collection_name)
+            .where("owner_id", "==", owner_id)
+            .where("nivel_agrupacion", "in", _TRANSACTIONAL_LEVELS)
+            .select(field_names)
+        )
+        for doc in query.stream():
+            data = doc.to_dict() or {}
+            projected = {"id": doc.id}
+            for name in field_names:
+                projected[name] = data.get(name, "")
+            yield projected
+
     def get_by_owner_and_code(self, owner_id: str, codigo: str) -> PUCAccount | None:
         """Obtiene una cuenta PUC específica por owner y código"""
         query = (
@@ -124,8 +189,13 @@ class FirestorePUCRepository:
     def count_by_owner(self, owner_id: str) -> int:
         """Cuenta el total de cuentas PUC de un owner"""
         query = self.db.collection(self.collection_name).where("owner_id", "==", owner_id)
-        docs = list(query.stream())
-        return len(docs)
+        return self._count(query)
+    
+    @staticmethod
+    def _count(query) -> int:
+        """Total por agregación COUNT en el servidor, sin descargar los documentos"""
+        results = query.count().get()
+        return int(results[0][0].value) if results and results[0] else 0
     
     def _to_dict(self, account: PUCAccount) -> dict[str, Any]:
         """Convierte entidad a diccionario para Firestore"""
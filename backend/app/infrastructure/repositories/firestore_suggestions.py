@@ -43,27 +43,41 @@ class FirestoreAISuggestionRepository(AISuggestionRepository):
         return result
 
     def replace_for_invoice(self, invoice_id: str, suggestions: List[AISuggestion]) -> None:
-        # Delete existing suggestions for this invoice
-        existing_docs = self.suggestions_collection.where("invoice_id", "==", invoice_id).get()
+        # Solo las referencias de las sugerencias anteriores: no hace falta leer sus campos
+        existing_refs = [
+            doc.reference
+            for doc in self.suggestions_collection.where("invoice_id", "==", invoice_id).select([]).stream()
+        ]
+
+        # Borrado y alta viajan en el mismo batch: un solo commit para el caso normal
         batch = self.db.batch()
-        for doc in existing_docs:
-            batch.delete(doc.reference)
-        batch.commit()
-        
-        # Add new suggestions
-        if suggestions:
-            batch = self.db.batch()
-            for suggestion in suggestions:
-                doc_ref = self.suggestions_collection.document()
-                batch.set(doc_ref, {
-                    "invoice_id": invoice_id,
-                    "account_code": suggestion.account_code,
-                    "rationale": suggestion.rationale,
-                    "confidence": suggestion.confidence,
-                    "source": suggestion.source,
-                    "generated_at": suggestion.generated_at,
-                    "line_number": suggestion.line_number,
-                    "puc_account_id": suggestion.puc_account_id,
-                    "account_name": suggestion.account_name,
-                })
-            batch.commit()
\ No newline at end of file
+        count = 0
+        for doc_ref in existing_refs:
+            batch.delete(doc_ref)
+            count += 1
+            # Firestore permite máximo 500 operaciones por batch
+            if count >= 500:
+                batch.commit()
+                batch = self.db.batch()
+                count = 0
+
+        for suggestion in suggestions:
+            batch.set(self.suggestions_collection.document(), {
+                "invoice_id": invoice_id,
+                "account_code": suggestion.account_code,
+                "rationale": suggestion.rationale,
+                "confidence": suggestion.confidence,
+                "source": suggestion.source,
+                "generated_at": suggestion.generated_at,
+                "line_number": suggestion.line_number,
+                "puc_account_id": suggestion.puc_account_id,
+                "account_name": suggestion.account_name,
+            })
+            count += 1
+            if count >= 500:
+                batch.commit()
+                batch = self.db.batch()
+                count = 0
+
+        if count > 0:
+            batch.commit()
@@ -1,10 +1,23 @@
 from __future__ import annotations
 
-from dataclasses import dataclass
-from typing import Iterable, Any
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from functools import lru_cache, partial
+from typing import Iterable, Iterator, Any
 from pathlib import Path
-import json
+import hashlib
+import heapq
 import logging
+import re
+import time
+import unicodedata
+
+import orjson
+
+from .gemini_common import CachedPrefixModels, JSONObjectStream, chunk_text
+from .llm_cache import InMemoryLLMCache, LLMCache
+from .rate_limit import GeminiRateLimiter
 
 logger = logging.getLogger(__name__)
 
@@ -13,6 +26,337 @@ try:
 except ModuleNotFoundError:
     genai = None  # type: ignore[assignment]
 
+try:
+    import re2 as _json_span_engine  # google-re2: DFA sin backtracking
+except ModuleNotFoundError:
+    _json_span_engine = re  # type: ignore[assignment]
+
+# Un solo escaneo localiza el bloque JSON: contenido de un fence ```json ... ``` o,
+# si no hay fence, el primer array/objeto que aparezca en el texto
+_JSON_SPAN_RE = _json_span_engine.compile(
+    r"```(?:json)?\s*([\s\S]*?)\s*```|(\[[\s\S]*\]|\{[\s\S]*\})"
+)
+
+# Fallback de texto plano: "- codigo | razon | confianza" (columnas extra se ignoran)
+_TEXT_LINE_RE = re.compile(
+    r"^[ \t]*[- ]*([^|\n]*?)[ \t]*\|[ \t]*([^|\n]*?)[ \t]*(?:\|[ \t]*([^|\n]*?)[ \t]*)?(?:\|[^\n]*)?\r?$",
+    re.M,
+)
+
+
+# Sinónimos frecuentes en descripciones de facturas → código PUC del catálogo de ingresos.
+# Complementan los nombres de cuenta de puc_ingresos.json para el clasificador por palabra clave.
+_KEYWORD_SYNONYMS: dict[str, str] = {
+    "restaurante": "4140",
+    "hotel": "4140",
+    "hospedaje": "4140",
+    "alojamiento": "4140",
+    "transporte": "4145",
+    "flete": "4145",
+    "mensajeria": "4145",
+    "arriendo": "4220",
+    "arrendamiento": "4220",
+    "comision": "4225",
+    "honorario": "4230",
+    "dividendo": "4215",
+    "indemnizacion": "4255",
+    "matricula": "4160",
+}
+
+# Nombres de cuenta demasiado genéricos para decidir sin el modelo
+_GENERIC_ACCOUNT_NAMES = frozenset({"servicios", "diversos", "financieros", "recuperaciones"})
+
+_KEYWORD_CONFIDENCE = 0.85
+
+# Empaquetado de facturas por llamada: ~250 tokens de salida por línea caben en max_output_tokens
+_BATCH_MAX_INVOICES = 5
+_BATCH_MAX_LINES = 30
+
+# Cambiar al modificar el prompt: invalida las respuestas cacheadas con la versión anterior
+_PROMPT_VERSION = "4"
+
+# Campos del catálogo que el modelo necesita para clasificar (nivel_agrupacion no aporta)
+_PROMPT_ACCOUNT_FIELDS = ("id", "codigo", "nombre", "categoria", "clase")
+
+# Catálogos grandes: solo se envían al modelo las K cuentas más afines a la factura
+_TOP_K_ACCOUNTS = 50
+_TOP_K_MIN_CATALOG = 200
+_MISC_ACCOUNT_MARKERS = ("diversos", "otros", "otras")
+_MAX_MISC_ACCOUNTS = 10
+_TOKEN_RE = re.compile(r"[a-z0-9]{3,}")
+_STOPWORDS = frozenset({"del", "los", "las", "por", "para", "con", "una", "que", "sin"})
+
+# Vigencia del catálogo PUC cacheado por owner (se invalida además al subir un PUC nuevo)
+_CATALOG_TTL_SECONDS = 300
+
+def _block(*lines: str) -> str:
+    # Cada línea termina en salto de línea, igual que al escribirlas una a una
+    return "".join(f"{line}\n" for line in lines)
+
+
+# Secciones estáticas del prompt: se construyen una vez al importar el módulo
+_PREAMBLE = _block(
+    "Eres un experto contador colombiano especializado en el Plan Único de Cuentas (PUC).",
+    "",
+    "CONTEXTO: Factura Electrónica de Venta según DIAN 2.1 (UBL 2.1)",
+    "Perfil: DIAN 2.1: Factura Electrónica de Venta",
+    "",
+    "TAREA: Analiza cada línea de venta y asigna el código PUC más apropiado del catálogo personalizado de la empresa.",
+    "",
+)
+
+_BATCH_PREAMBLE = _block(
+    "Eres un experto contador colombiano especializado en el Plan Único de Cuentas (PUC).",
+    "",
+    "CONTEXTO: Facturas Electrónicas de Venta según DIAN 2.1 (UBL 2.1)",
+    "Perfil: DIAN 2.1: Factura Electrónica de Venta",
+    "",
+    "TAREA: Analiza cada línea de venta de CADA factura y asigna el código PUC más apropiado del catálogo personalizado de la empresa.",
+    "",
+)
+
+_INSTRUCTIONS = _block(
+    "═══════════════════════════════════════════════════════════════",
+    "INSTRUCCIONES DE CLASIFICACIÓN:",
+    "═══════════════════════════════════════════════════════════════",
+    "",
+    "1. Analiza CADA línea de producto/servicio de la factura",
+    "2. Para CADA línea, busca en el catálogo JSON la cuenta PUC más apropiada",
+    "3. Usa el campo 'id' de la cuenta seleccionada (importante para referencia)",
+    "4. Usa el campo 'codigo' exacto de la cuenta seleccionada",
+    "5. NO inventes códigos - SOLO usa los que están en el catálogo JSON",
+    "",
+    "CRITERIOS DE SELECCIÓN:",
+    "- Lee cuidadosamente la descripción del producto/servicio",
+    "- Analiza el tipo de transacción (venta, servicio, etc.)",
+    "- Compara con los 'nombre', 'categoria' y 'clase' de las cuentas PUC",
+    "- Elige la cuenta que mejor coincida semánticamente",
+    "- Si hay múltiples opciones similares, elige la más específica",
+    "",
+)
+
+_RESPONSE_FORMAT = _block(
+    "═══════════════════════════════════════════════════════════════",
+    "FORMATO DE RESPUESTA:",
+    "═══════════════════════════════════════════════════════════════",
+    "",
+    "Responde ÚNICAMENTE con un array JSON (sin markdown, sin ```json):",
+    "",
+    '[',
+    '  {',
+    '    "line_number": 1,',
+    '    "puc_account_id": "uuid-de-la-cuenta-puc",',
+    '    "account_code": "41350101",',
+    '    "account_name": "Venta de mercancías al por mayor",',
+    '    "rationale": "Este producto/servicio corresponde a [tipo de operación]. Se clasifica como [categoría] porque [razón específica]. La cuenta seleccionada es apropiada dado que [justificación basada en el nombre/categoría de la cuenta del catálogo PUC].",',
+    '    "confidence": 0.95',
+    '  },',
+    '  {',
+    '    "line_number": 2,',
+    '    "puc_account_id": "uuid-de-otra-cuenta",',
+    '    "account_code": "41400501",',
+    '    "account_name": "Ingresos operacionales - Restaurante",',
+    '    "rationale": "Se trata de un servicio de alimentación. Se clasifica en la categoría de servicios de restaurante porque involucra la preparación y venta de alimentos. Esta cuenta del PUC es la indicada para registrar ingresos por este tipo de actividad comercial.",',
+    '    "confidence": 0.90',
+    '  }',
+    ']',
+    "",
+)
+
+_BATCH_RESPONSE_FORMAT = _block(
+    "═══════════════════════════════════════════════════════════════",
+    "FORMATO DE RESPUESTA:",
+    "═══════════════════════════════════════════════════════════════",
+    "",
+    "Responde ÚNICAMENTE con un array JSON (sin markdown, sin ```json), un elemento por factura:",
+    "",
+    '[',
+    '  {',
+    '    "invoice_index": 1,',
+    '    "suggestions": [',
+    '      {',
+    '        "line_number": 1,',
+    '        "puc_account_id": "uuid-de-la-cuenta-puc",',
+    '        "account_code": "41350101",',
+    '        "account_name": "Venta de mercancías al por mayor",',
+    '        "rationale": "Explicación detallada de la clasificación.",',
+    '        "confidence": 0.95',
+    '      }',
+    '    ]',
+    '  }',
+    ']',
+    "",
+    "- invoice_index: número de la FACTURA (1, 2, 3...) tal como aparece abajo",
+    "- line_number: número de línea dentro de esa factura",
+    "",
+)
+
+_FIELD_RULES = "\n".join((
+    "CAMPOS OBLIGATORIOS:",
+    "- line_number: número de línea (1, 2, 3...)",
+    "- puc_account_id: campo 'id' de la cuenta PUC seleccionada del catálogo JSON",
+    "- account_code: campo 'codigo' de la cuenta PUC seleccionada",
+    "- account_name: campo 'nombre' de la cuenta PUC seleccionada",
+    "- rationale: explicación DETALLADA (150-250 caracteres) que incluya:",
+    "    * Qué tipo de operación/producto/servicio es",
+    "    * Por qué se clasifica en esa categoría",
+    "    * Cómo coincide con la cuenta PUC seleccionada",
+    "    * Cualquier detalle relevante del vendedor/cliente si aplica",
+    "- confidence: número entre 0 y 1",
+    "",
+    "IMPORTANTE:",
+    "- Los valores puc_account_id, account_code y account_name DEBEN venir del catálogo JSON",
+    "- NO inventes IDs ni códigos",
+    "- El rationale debe ser informativo y profesional (piensa como un contador explicando)",
+    "- Menciona elementos específicos de la descripción del producto/servicio",
+    "- Explica claramente la conexión entre la transacción y la cuenta PUC",
+    "- Si el vendedor/cliente tiene actividad relevante, menciónalo",
+    "- Si no encuentras una cuenta apropiada, explica por qué y usa confidence bajo (< 0.5)",
+    "",
+    "EJEMPLO DE BUEN RATIONALE:",
+    '"El vendedor es una droguería que comercializa productos farmacéuticos. Este ítem corresponde a ',
+    'la venta de mercancías del giro comercial principal (productos de salud). Se clasifica en la cuenta ',
+    'de \'Comercio al por mayor y al detal\' ya que refleja los ingresos operacionales por la actividad ',
+    'comercial de compra-venta de productos. Esta es la clasificación apropiada según el PUC para empresas ',
+    'del sector comercio."',
+))
+
+_CATALOG_HEADER = _block(
+    "",
+    "═══════════════════════════════════════════════════════════════",
+    "CATÁLOGO PUC PERSONALIZADO DE LA EMPRESA (solo usar estos códigos)",
+    "═══════════════════════════════════════════════════════════════",
+    "",
+)
+
+_FULL_CATALOG_INTRO = "A continuación, el CATÁLOGO COMPLETO de cuentas PUC en formato JSON:\n"
+_TRIMMED_CATALOG_INTRO = _block(
+    "A continuación, las cuentas PUC MÁS RELEVANTES para esta factura, tomadas de un catálogo más",
+    "amplio (no es el catálogo completo), en formato JSON. Elige entre ellas:",
+)
+
+_NO_CATALOG_BLOCK = _block(
+    "⚠️ No se ha cargado un PUC personalizado.",
+    "Por favor, sube tu catálogo PUC usando el endpoint /puc/upload",
+    "",
+)
+
+# La factura va al final: todo lo anterior es idéntico entre facturas del mismo owner,
+# así Gemini reutiliza el prefijo (caché implícita) y solo procesa la parte variable
+_INVOICE_HEADER = _block(
+    "═══════════════════════════════════════════════════════════════",
+    "FACTURA A CLASIFICAR:",
+    "═══════════════════════════════════════════════════════════════",
+    "",
+)
+
+_BATCH_INVOICE_HEADER = _block(
+    "═══════════════════════════════════════════════════════════════",
+    "FACTURAS A CLASIFICAR:",
+    "═══════════════════════════════════════════════════════════════",
+    "",
+)
+
+
+
+# Salida estructurada: Gemini decodifica restringido a este esquema y corta al cerrar el array
+_SUGGESTIONS_SCHEMA: dict[str, Any] = {
+    "type": "array",
+    "items": {
+        "type": "object",
+        "properties": {
+            "line_number": {"type": "integer"},
+            "puc_account_id": {"type": "string"},
+            "account_code": {"type": "string"},
+            "account_name": {"type": "string"},
+            "rationale": {"type": "string"},
+            "confidence": {"type": "number"},
+        },
+        "required": ["line_number", "account_code", "rationale", "confidence"],
+    },
+}
+
+_BATCH_SUGGESTIONS_SCHEMA: dict[str, Any] = {
+    "type": "array",
+    "items": {
+        "type": "object",
+        "properties": {
+            "invoice_index": {"type": "integer"},
+            "suggestions": _SUGGESTIONS_SCHEMA,
+        },
+        "required": ["invoice_index", "suggestions"],
+    },
+}
+
+# Presupuesto de salida: una base fija (gemini-2.5 descuenta aquí su razonamiento interno)
+# más ~256 tokens por línea a clasificar, en vez de 8192 fijos
+_OUTPUT_TOKENS_BASE = 1024
+_OUTPUT_TOKENS_PER_LINE = 256
+_MAX_OUTPUT_TOKENS = 8192
+
+
+def _output_token_budget(line_count: int) -> int:
+    return min(_OUTPUT_TOKENS_BASE + _OUTPUT_TOKENS_PER_LINE * max(line_count, 1), _MAX_OUTPUT_TOKENS)
+
+
+@lru_cache(maxsize=64)
+def _generation_config(max_output_tokens: int, batch: bool) -> Any:
+    """Configuración de generación reutilizable por tamaño de salida y tipo de prompt."""
+    return genai.types.GenerationConfig(
+        temperature=0.2,
+        max_output_tokens=max_output_tokens,
+        response_mime_type="application/json",
+        response_schema=_BATCH_SUGGESTIONS_SCHEMA if batch else _SUGGESTIONS_SCHEMA,
+    )
+
+
+@lru_cache(maxsize=8)
+def _gemini_model(api_key: str, model_name: str) -> Any:
+    """
+    Cliente de Gemini compartido por proceso: configurar el SDK y crear el modelo (con su
+    transporte y canal) se hace una vez por API key y modelo, no por cada servicio creado.
+    genai.configure es global, así que la última key configurada es la que queda activa.
+    """
+    genai.configure(api_key=api_key)
+    return genai.GenerativeModel(model_name)
+
+
+# Las llamadas a Gemini son I/O puro: un pool compartido permite solapar varias facturas
+_EXECUTOR = ThreadPoolExecutor(max_workers=16, thread_name_prefix="gemini")
+
+# Llamadas simultáneas por defecto en la variante asíncrona (acotadas por la cuota RPM)
+_DEFAULT_CONCURRENCY = 8
+
+
+@dataclass(slots=True)
+class _LineGroup:
+    """Líneas pendientes con la misma descripción normalizada: se envían al modelo una sola vez."""
+    number: int  # número de la primera línea del grupo, el que ve el modelo
+    description: str
+    amount: float
+    quantity: float
+    duplicates: list[int] = field(default_factory=list)  # demás líneas que reciben la misma sugerencia
+
+
+@dataclass(slots=True)
+class _PendingInvoice:
+    position: int
+    payload: dict[str, object]
+    direct: list[dict[str, object]]
+    line_count: int
+    cache_key: str
+
+
+@dataclass(slots=True)
+class _CatalogEntry:
+    accounts: list[dict[str, Any]]
+    puc_json: str
+    prompt_block: str  # sección del catálogo ya renderizada para el prompt
+    loaded_at: float
+    fingerprint: str = ""  # huella de id:codigo de las cuentas, calculada una vez por carga
+    token_index: dict[str, list[int]] = field(default_factory=dict)  # token → posiciones de cuentas
+    misc_positions: list[int] = field(default_factory=list)
+
 
 @dataclass(slots=True)
 class GeminiAISuggestionService:
@@ -27,20 +371,30 @@ class GeminiAISuggestionService:
     puc_repository: Any = None  # PUCRepository
     model_name: str = "gemini-2.5-flash"
     _initialized: bool = False
+    _keyword_map: dict[str, str] = field(default_factory=dict)
+    _keyword_re: re.Pattern[str] | None = None
+    response_cache: LLMCache = field(default_factory=InMemoryLLMCache)
+    _model: Any = None
+    _puc_cache: dict[str, _CatalogEntry] = field(default_factory=dict)
+    rate_limiter: GeminiRateLimiter | None = None  # cuotas RPM/TPM compartidas entre hilos
+    _prefix_models: CachedPrefixModels | None = None  # CachedContent por prefijo estable del prompt
 
     def __post_init__(self) -> None:
+        self._build_keyword_index()
+        self._prefix_models = CachedPrefixModels(self.model_name)
         if genai is None or not self.api_key:
             # SDK no instalado o no hay API key → no inicializa
             logger.warning("GeminiAISuggestionService: SDK no disponible o API key faltante")
             return
         try:
-            logger.info(f"Configurando Gemini con API key: {self.api_key[:10]}...")
-            genai.configure(api_key=self.api_key)
+            logger.info("Configurando Gemini con API key: %s...", self.api_key[:10])
+            # El modelo se comparte entre instancias del servicio (ver _gemini_model)
+            self._model = _gemini_model(self.api_key, self.model_name)
             self._initialized = True
-            logger.info(f"Gemini configurado exitosamente. Modelo: {self.model_name}")
+            logger.info("Gemini configurado exitosamente. Modelo: %s", self.model_name)
         except Exception as e:
             # No lanzamos excepciones: el servicio fallará en silencio devolviendo []
-            logger.error(f"Error al configurar Gemini: {e}")
+            logger.error("Error al configurar Gemini: %s", e)
             self._initialized = False
     
     def _get_puc_for_owner(self, owner_id: str) -> list[dict[str, Any]]:
@@ -49,51 +403,28 @@ class GeminiAISuggestionService:
         Si no tiene PUC cargado, usa el fallback del puc_ingresos.json.
         
         Returns: Lista de diccionarios con id, codigo, nombre, categoria, clase
+        Raises: los errores del repositorio se propagan para que no se cachee el fallback
         """
         if not self.puc_repository:
             logger.warning("⚠️ No hay repositorio PUC configurado, usando fallback")
             return self._load_puc_fallback()
-        
-        try:
-            # Obtener todas las cuentas del owner
-            accounts, total = self.puc_repository.list_by_owner(
-                owner_id=owner_id,
-                search=None,
-                limit=10000,
-                offset=0,
-            )
-            
-            if not accounts:
-                logger.warning(f"⚠️ Owner {owner_id} no tiene PUC cargado, usando fallback")
-                return self._load_puc_fallback()
-            
-            # Convertir a formato simple para el prompt - INCLUIR ID
-            puc_data = [
-                {
-                    "id": acc.id,  # ID de Firestore para referencia posterior
-                    "codigo": acc.codigo,
-                    "nombre": acc.nombre,
-                    "categoria": acc.categoria,
-                    "clase": acc.clase,
-                    "nivel_agrupacion": acc.nivel_agrupacion,
-                }
-                for acc in accounts
-            ]
-            
-            logger.info(f"✅ Cargadas {len(puc_data)} cuentas PUC personalizadas para owner {owner_id}")
-            return puc_data
-            
-        except Exception as e:
-            logger.error(f"❌ Error obteniendo PUC del repositorio: {e}")
+
+        # Proyección en Firestore: solo los campos que usa el prompt
+        puc_data = list(self.puc_repository.iter_projection(owner_id, fields=_PROMPT_ACCOUNT_FIELDS))
+
+        if not puc_data:
+            logger.warning("⚠️ Owner %s no tiene PUC cargado, usando fallback", owner_id)
             return self._load_puc_fallback()
+
+        logger.info("✅ Cargadas %d cuentas PUC personalizadas para owner %s", len(puc_data), owner_id)
+        return puc_data
     
     def _load_puc_fallback(self) -> list[dict[str, Any]]:
         """Carga el PUC fallback desde puc_ingresos.json"""
         try:
             puc_path = Path(__file__).parent.parent.parent.parent / "puc_ingresos.json"
             if puc_path.exists():
-                with open(puc_path, 'r', encoding='utf-8') as f:
-                    data = json.load(f)
+                data = orjson.loads(puc_path.read_bytes())
                 logger.info("✅ Catálogo PUC de ingresos fallback cargado")
                 
                 # Convertir formato del JSON a lista plana
@@ -109,10 +440,10 @@ class GeminiAISuggestionService:
                         })
                 return accounts
             else:
-                logger.warning(f"⚠️ No se encontró puc_ingresos.json en {puc_path}")
+                logger.warning("⚠️ No se encontró puc_ingresos.json en %s", puc_path)
                 return []
         except Exception as e:
-            logger.error(f"❌ Error cargando PUC fallback: {e}")
+            logger.error("❌ Error cargando PUC fallback: %s", e)
             return []
 
     # ------------------ API PÚBLICA ------------------
@@ -131,99 +462,565 @@ class GeminiAISuggestionService:
             invoice_payload: Datos de la factura
             owner_id: ID del propietario para obtener su PUC personalizado
         """
+        return list(self.iter_suggestions(invoice_payload, owner_id=owner_id))
+
+    def iter_suggestions(
+        self,
+        invoice_payload: dict[str, object],
+        owner_id: str | None = None,
+    ) -> Iterator[dict[str, object]]:
+        """
+        Igual que generate_suggestions, pero entrega cada sugerencia en cuanto el
+        modelo termina de escribirla (respuesta en streaming).
+        """
         logger.info("Iniciando generación de sugerencias con Gemini")
-        logger.info(f"   _initialized: {self._initialized}")
-        logger.info(f"   genai disponible: {genai is not None}")
-        logger.info(f"   owner_id: {owner_id}")
-        
+        logger.info("   _initialized: %s", self._initialized)
+        logger.info("   genai disponible: %s", genai is not None)
+        logger.info("   owner_id: %s", owner_id)
+
+        lines = invoice_payload.get("lines")
+        if not isinstance(lines, list) or not lines:
+            logger.warning("No hay líneas en la factura")
+            return
+
+        catalog = self._catalog_entry(owner_id)
+        puc_accounts = catalog.accounts
+
+        # Camino rápido: líneas clasificables por palabra clave no llegan al modelo
+        direct, unresolved = self._prefilter(lines, puc_accounts)
+        if not unresolved:
+            logger.info("✅ %d líneas clasificadas por palabra clave, sin llamar a Gemini", len(direct))
+            yield from direct
+            return
+
+        cache_key = self._cache_key(invoice_payload, owner_id, catalog)
+        cached = self.response_cache.get(cache_key)
+        if cached is not None:
+            logger.info("✅ Sugerencias recuperadas de caché, sin llamar a Gemini")
+            yield from (dict(item) for item in cached)
+            return
+
         if genai is None or not self._initialized:
             logger.warning("Gemini no inicializado o SDK no disponible")
-            return []
+            yield from direct
+            return
+
+        yield from self._stream_with_model(invoice_payload, catalog, direct, cache_key)
+
+    def generate_suggestions_batch(
+        self,
+        invoice_payloads: Iterable[dict[str, object]],
+        owner_id: str | None = None,
+    ) -> list[list[dict[str, object]]]:
+        """
+        Genera sugerencias para varias facturas de un mismo owner empaquetando
+        hasta _BATCH_MAX_INVOICES facturas por llamada, con el catálogo PUC una sola vez.
+        Las facturas que el modelo omita se reintentan de forma individual.
+        """
+        payloads = list(invoice_payloads)
+        results: list[list[dict[str, object]]] = [[] for _ in payloads]
+        catalog = self._catalog_entry(owner_id)
+        puc_accounts = catalog.accounts
+
+        pending: list[_PendingInvoice] = []
+        for position, invoice_payload in enumerate(payloads):
+            lines = invoice_payload.get("lines")
+            if not isinstance(lines, list) or not lines:
+                continue
+            direct, unresolved = self._prefilter(lines, puc_accounts)
+            results[position] = direct
+            if not unresolved:
+                continue
+            cache_key = self._cache_key(invoice_payload, owner_id, catalog)
+            cached = self.response_cache.get(cache_key)
+            if cached is not None:
+                results[position] = [dict(item) for item in cached]
+                continue
+            groups = self._line_groups(lines, {s["line_number"] for s in direct})
+            pending.append(_PendingInvoice(position, invoice_payload, direct, len(groups), cache_key))
+
+        if not pending or genai is None or not self._initialized:
+            return results
 
-        prompt = self._build_prompt(invoice_payload, owner_id)
+        for chunk in self._chunk_pending(pending):
+            if len(chunk) == 1:
+                item = chunk[0]
+                results[item.position] = self._classify_with_model(
+                    item.payload, catalog, item.direct, item.cache_key
+                )
+                continue
+
+            relevant = self._relevant_accounts(catalog, [item.payload for item in chunk])
+            if relevant is None:
+                catalog_block = catalog.prompt_block
+            else:
+                catalog_block = self._catalog_block(relevant, trimmed=True)
+            prompt = self._build_batch_prompt(
+                [(item.payload, {s["line_number"] for s in item.direct}) for item in chunk],
+                puc_accounts,
+                catalog_block=catalog_block,
+            )
+            line_count = sum(item.line_count for item in chunk)
+            grouped = self._parse_batch_response(
+                self._generate_text(prompt, _generation_config(_output_token_budget(line_count), batch=True))
+            )
+            for invoice_index, item in enumerate(chunk, start=1):
+                generated = grouped.get(invoice_index)
+                if not generated:
+                    logger.warning("⚠️ El lote no incluyó la factura %s, reintentando sola", invoice_index)
+                    results[item.position] = self._classify_with_model(
+                        item.payload, catalog, item.direct, item.cache_key
+                    )
+                    continue
+                skip = {s["line_number"] for s in item.direct}
+                duplicates = self._duplicate_map(self._line_groups(item.payload.get("lines") or [], skip))
+                result = item.direct + list(self._expand_duplicates(generated, duplicates))
+                self.response_cache.set(item.cache_key, [dict(entry) for entry in result])
+                results[item.position] = result
+        return results
+
+    def generate_suggestions_many(
+        self,
+        invoice_payloads: Iterable[dict[str, object]],
+        owner_id: str | None = None,
+    ) -> list[list[dict[str, object]]]:
+        """
+        Genera sugerencias para varias facturas en paralelo.
+        Conserva el orden de entrada en el resultado.
+        """
+        worker = partial(self.generate_suggestions, owner_id=owner_id)
+        return list(_EXECUTOR.map(worker, invoice_payloads))
+
+    async def agenerate_suggestions(
+        self,
+        invoice_payload: dict[str, object],
+        owner_id: str | None = None,
+    ) -> list[dict[str, object]]:
+        """
+        Variante asíncrona: ejecuta la generación en el pool compartido para no
+        bloquear el event loop mientras se espera a Gemini.
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            _EXECUTOR, partial(self.generate_suggestions, invoice_payload, owner_id=owner_id)
+        )
+
+    async def agenerate_suggestions_many(
+        self,
+        invoice_payloads: Iterable[dict[str, object]],
+        owner_id: str | None = None,
+        concurrency: int = _DEFAULT_CONCURRENCY,
+    ) -> list[list[dict[str, object]]]:
+        """
+        Genera sugerencias concurrentemente con un máximo de `concurrency` llamadas
+        en vuelo, para no superar la cuota por minuto de Gemini.
+        """
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def bounded(invoice_payload: dict[str, object]) -> list[dict[str, object]]:
+            async with semaphore:
+                return await self.agenerate_suggestions(invoice_payload, owner_id=owner_id)
+
+        return list(await asyncio.gather(*(bounded(payload) for payload in invoice_payloads)))
+
+    # ------------------ HELPERS ------------------
+
+    def _stream_with_model(
+        self,
+        invoice_payload: dict[str, object],
+        catalog: _CatalogEntry,
+        direct: list[dict[str, object]],
+        cache_key: str,
+    ) -> Iterator[dict[str, object]]:
+        yield from direct
+
+        skip = {s["line_number"] for s in direct}
+        # Con el catálogo completo ya cacheado en Gemini (CachedContent) no hace falta recortarlo:
+        # el prefijo no se vuelve a procesar y el modelo ve todas las cuentas
+        prefix = self._prompt_prefix(catalog.prompt_block)
+        cached_model = self._prefix_models.get(prefix)
+        relevant = None if cached_model is not None else self._relevant_accounts(catalog, [invoice_payload])
+        catalog_block = catalog.prompt_block if relevant is None else self._catalog_block(relevant, trimmed=True)
+        prompt = self._build_prompt(
+            invoice_payload,
+            catalog.accounts,
+            skip=skip,
+            catalog_block=catalog_block,
+        )
         if not prompt:
             logger.warning("Prompt vacío, no se puede generar sugerencias")
-            return []
+            return
+
+        groups = self._line_groups(invoice_payload.get("lines") or [], skip)
+        duplicates = self._duplicate_map(groups)
 
-        logger.info(f"Prompt generado ({len(prompt)} caracteres)")
-        logger.debug(f"Prompt completo:\n{prompt[:500]}...")
+        # Con un prefijo cacheado en Gemini solo se envía la sección de la factura
+        model, contents = self._model, prompt
+        if cached_model is not None:
+            model, contents = cached_model, prompt[len(prefix):]
 
+        logger.info("Prompt generado (%d caracteres), llamando a Gemini en streaming", len(prompt))
+        generated: list[dict[str, object]] = []
+        received: list[str] = []
+        scanner = JSONObjectStream()
+        completed = False
+        estimated = 0
+        usage = None
         try:
-            logger.info(f"Llamando a Gemini modelo: {self.model_name}")
-            model = genai.GenerativeModel(self.model_name)
-            response = model.generate_content(
-                prompt,
-                generation_config=getattr(genai.types, "GenerationConfig", dict)(
-                    temperature=0.2,
-                    max_output_tokens=8192,  # Aumentado de 2048 a 8192
-                ),
-            )
-            logger.info("Respuesta recibida de Gemini")
-            logger.info(f"   Tipo de respuesta: {type(response)}")
-            logger.info(f"   Dir de respuesta: {dir(response)}")
-            
-            # Log completo de la respuesta para debugging
+            config = _generation_config(_output_token_budget(len(groups)), batch=False)
+            estimated = self._acquire_quota(prompt, config)
+            stream = model.generate_content(contents, generation_config=config, stream=True)
+            for chunk in stream:
+                usage = getattr(chunk, "usage_metadata", None) or usage
+                text = chunk_text(chunk)
+                received.append(text)
+                for item in self._expand_duplicates(scanner.feed(text), duplicates):
+                    generated.append(item)
+                    yield item
+            completed = True
+        except Exception as e:
+            logger.error("Error durante el streaming de Gemini: %s", e, exc_info=True)
+        finally:
+            # La reserva se corrige aunque el stream se corte a mitad de camino
+            self._settle_quota(estimated, usage)
+
+        if not generated and received:
+            # La respuesta no traía objetos JSON reconocibles: se usa el parseo tolerante
+            generated = list(self._expand_duplicates(self._parse_response("".join(received)), duplicates))
+            yield from generated
+
+        # Una respuesta cortada no se cachea: la siguiente llamada vuelve a consultar el modelo
+        if completed and generated:
+            self.response_cache.set(cache_key, [dict(item) for item in direct + generated])
+
+    def _classify_with_model(
+        self,
+        invoice_payload: dict[str, object],
+        catalog: _CatalogEntry,
+        direct: list[dict[str, object]],
+        cache_key: str,
+    ) -> list[dict[str, object]]:
+        return list(self._stream_with_model(invoice_payload, catalog, direct, cache_key))
+
+    @staticmethod
+    def _chunk_pending(pending: list[_PendingInvoice]) -> Iterable[list[_PendingInvoice]]:
+        # Corta el lote por número de facturas y por líneas para no exceder max_output_tokens
+        chunk: list[_PendingInvoice] = []
+        line_count = 0
+        for item in pending:
+            item_lines = item.line_count
+            if chunk and (len(chunk) >= _BATCH_MAX_INVOICES or line_count + item_lines > _BATCH_MAX_LINES):
+                yield chunk
+                chunk, line_count = [], 0
+            chunk.append(item)
+            line_count += item_lines
+        if chunk:
+            yield chunk
+
+    def _parse_batch_response(self, text: str) -> dict[int, list[dict[str, object]]]:
+        grouped: dict[int, list[dict[str, object]]] = {}
+        if not text:
+            return grouped
+        parsed = self._try_parse_json(text)
+        if not isinstance(parsed, list):
+            logger.warning("La respuesta del lote no es un array JSON")
+            return grouped
+        for entry in parsed:
+            if not isinstance(entry, dict) or not isinstance(entry.get("suggestions"), list):
+                continue
             try:
-                logger.info(f"   response.text disponible: {hasattr(response, 'text')}")
-                logger.info(f"   response.candidates disponible: {hasattr(response, 'candidates')}")
-                if hasattr(response, 'candidates') and response.candidates:
-                    logger.info(f"   Número de candidates: {len(response.candidates)}")
-                    first = response.candidates[0]
-                    logger.info(f"   finish_reason: {getattr(first, 'finish_reason', 'N/A')}")
-                    if hasattr(response, 'usage_metadata'):
-                        logger.info(f"   usage_metadata: {response.usage_metadata}")
-            except Exception as e:
-                logger.error(f"   Error inspeccionando respuesta: {e}")
-            
+                invoice_index = int(entry.get("invoice_index"))
+            except (TypeError, ValueError):
+                continue
+            grouped[invoice_index] = [item for item in entry["suggestions"] if isinstance(item, dict)]
+        return grouped
+
+    def _generate_text(self, prompt: str, generation_config: Any) -> str:
+        """
+        Envía el prompt a Gemini y devuelve el texto de la respuesta ("" si falla).
+        """
+        logger.info("Prompt generado (%d caracteres)", len(prompt))
+        logger.debug("Prompt completo:\n%s...", prompt[:500])
+
+        try:
+            logger.info("Llamando a Gemini modelo: %s", self.model_name)
+            estimated = self._acquire_quota(prompt, generation_config)
+            response = self._model.generate_content(prompt, generation_config=generation_config)
+            self._settle_quota(estimated, getattr(response, "usage_metadata", None))
+            logger.info("Respuesta recibida de Gemini")
+
+            # Diagnóstico de la respuesta solo cuando se depura: evita formatear objetos grandes
+            if logger.isEnabledFor(logging.DEBUG):
+                try:
+                    candidates = getattr(response, "candidates", None) or []
+                    logger.debug("   Número de candidates: %d", len(candidates))
+                    if candidates:
+                        logger.debug("   finish_reason: %s", getattr(candidates[0], 'finish_reason', 'N/A'))
+                    logger.debug("   usage_metadata: %s", getattr(response, 'usage_metadata', 'N/A'))
+                except Exception as e:
+                    logger.debug("   Error inspeccionando respuesta: %s", e)
+
         except Exception as e:
-            logger.error(f"Error al llamar a Gemini: {e}", exc_info=True)
-            return []
+            logger.error("Error al llamar a Gemini: %s", e, exc_info=True)
+            return ""
 
         # Extraer texto de respuesta con tolerancia a cambios del SDK
         text = self._extract_text(response)
         if not text:
             logger.warning("No se pudo extraer texto de la respuesta")
-            logger.warning(f"   Respuesta completa (repr): {repr(response)}")
-            return []
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("   Respuesta completa (repr): %s", repr(response)[:200])
+            return ""
+
+        logger.info("Texto extraído (%d caracteres)", len(text))
+        logger.debug("Primeros 300 caracteres: %s", text[:300])
+        return text
+
+    def _acquire_quota(self, prompt: str, generation_config: Any) -> int:
+        """Reserva petición y tokens estimados antes de llamar a Gemini (0 si no hay limitador)."""
+        if self.rate_limiter is None:
+            return 0
+        max_output = getattr(generation_config, "max_output_tokens", None) or 0
+        estimated = self.rate_limiter.estimate_tokens(prompt, max_output)
+        self.rate_limiter.acquire(estimated)
+        return estimated
 
-        logger.info(f"Texto extraído ({len(text)} caracteres)")
-        logger.debug(f"Primeros 300 caracteres: {text[:300]}")
+    def _settle_quota(self, estimated: int, usage_metadata: Any) -> None:
+        if self.rate_limiter is not None and estimated:
+            self.rate_limiter.settle(estimated, usage_metadata)
 
+    def _parse_response(self, text: str) -> list[dict[str, object]]:
         # Intento 1: JSON directo (con o sin ```json ... ```)
         parsed = self._try_parse_json(text)
         if isinstance(parsed, list):
-            logger.info(f"JSON parseado exitosamente como lista: {len(parsed)} sugerencias")
+            logger.info("JSON parseado exitosamente como lista: %d sugerencias", len(parsed))
             return [item for item in parsed if isinstance(item, dict)]
         if isinstance(parsed, dict) and "suggestions" in parsed:
             raw = parsed.get("suggestions")
             if isinstance(raw, list):
-                logger.info(f"JSON parseado exitosamente (campo 'suggestions'): {len(raw)} sugerencias")
+                logger.info("JSON parseado exitosamente (campo 'suggestions'): %d sugerencias", len(raw))
                 return [item for item in raw if isinstance(item, dict)]
 
         # Intento 2: Fallback a texto plano "codigo | razon | confianza"
         logger.warning("No se pudo parsear JSON, intentando parseo de texto plano")
         result = list(self._parse_from_text(text))
-        logger.info(f"Parseadas {len(result)} sugerencias desde texto plano")
+        logger.info("Parseadas %d sugerencias desde texto plano", len(result))
         return result
 
-    # ------------------ HELPERS ------------------
+    def _cache_key(
+        self,
+        invoice_payload: dict[str, object],
+        owner_id: str | None,
+        catalog: _CatalogEntry,
+    ) -> str:
+        """
+        Huella de la factura: ignora campos volátiles (id externo, fechas) y
+        redondea montos para que facturas equivalentes compartan respuesta.
+        """
+        supplier = self._safe_dict(invoice_payload.get("supplier"))
+        customer = self._safe_dict(invoice_payload.get("customer"))
+        lines = invoice_payload.get("lines") or []
+        normalized = {
+            "supplier": [supplier.get("name"), supplier.get("tax_id")],
+            "customer": [customer.get("name"), customer.get("tax_id")],
+            "currency": invoice_payload.get("currency"),
+            "total": self._fmt_amount(invoice_payload.get("total_amount", 0)),
+            "lines": [
+                [
+                    str(line.get("description", "") or "").strip(),
+                    self._fmt_amount(line.get("amount", 0)),
+                    self._fmt_amount(line.get("quantity", 1)),
+                ]
+                for line in lines
+                if isinstance(line, dict)
+            ],
+        }
+        digest = hashlib.sha256()
+        digest.update(orjson.dumps(normalized, option=orjson.OPT_SORT_KEYS, default=str))
+        digest.update(f"|{owner_id or ''}|{self.model_name}|{_PROMPT_VERSION}|".encode("utf-8"))
+        # El catálogo forma parte del prompt: si cambia, la respuesta cacheada deja de servir
+        digest.update(catalog.fingerprint.encode("ascii"))
+        return digest.hexdigest()
+
+    @staticmethod
+    def _catalog_fingerprint(accounts: list[dict[str, Any]]) -> str:
+        digest = hashlib.sha256()
+        for account in accounts:
+            digest.update(f"{account.get('id', '')}:{account.get('codigo', '')};".encode("utf-8"))
+        return digest.hexdigest()
+
+    def invalidate(self, owner_id: str | None = None) -> None:
+        """Descarta el catálogo cacheado de un owner (o de todos si no se indica)."""
+        if owner_id is None:
+            self._puc_cache.clear()
+        else:
+            self._puc_cache.pop(owner_id, None)
+
+    def _catalog_entry(self, owner_id: str | None) -> _CatalogEntry:
+        """
+        Devuelve el catálogo del owner junto con su JSON ya serializado para el prompt.
+        Se cachea por owner durante _CATALOG_TTL_SECONDS para evitar releer Firestore;
+        el fallback usado por un error del repositorio no se cachea.
+        """
+        key = owner_id or ""
+        entry = self._puc_cache.get(key)
+        now = time.monotonic()
+        if entry is not None and now - entry.loaded_at < _CATALOG_TTL_SECONDS:
+            return entry
+
+        cacheable = True
+        if owner_id:
+            try:
+                accounts = self._get_puc_for_owner(owner_id)
+            except Exception as e:
+                # Un fallo transitorio no debe fijar el catálogo genérico durante todo el TTL
+                logger.error("❌ Error obteniendo PUC del repositorio: %s", e)
+                accounts = self._load_puc_fallback()
+                cacheable = False
+        else:
+            logger.warning("⚠️ No se proporcionó owner_id, usando PUC fallback")
+            accounts = self._load_puc_fallback()
+
+        # JSON compacto: sin indentación el bloque del catálogo ocupa bastantes menos tokens
+        puc_json = self._serialize_catalog(accounts)
+        entry = _CatalogEntry(
+            accounts,
+            puc_json,
+            self._catalog_block(accounts, puc_json),
+            now,
+            fingerprint=self._catalog_fingerprint(accounts),
+        )
+        if len(accounts) > _TOP_K_MIN_CATALOG:
+            entry.token_index, entry.misc_positions = self._build_token_index(accounts)
+        if cacheable:
+            self._puc_cache[key] = entry
+        return entry
+
+    def _build_token_index(self, accounts: list[dict[str, Any]]) -> tuple[dict[str, list[int]], list[int]]:
+        index: dict[str, list[int]] = {}
+        misc_positions: list[int] = []
+        for position, account in enumerate(accounts):
+            name = str(account.get("nombre", ""))
+            for token in self._tokenize(f"{name} {account.get('categoria', '')}"):
+                index.setdefault(token, []).append(position)
+            if len(misc_positions) < _MAX_MISC_ACCOUNTS and any(
+                marker in self._normalize_text(name) for marker in _MISC_ACCOUNT_MARKERS
+            ):
+                misc_positions.append(position)
+        return index, misc_positions
+
+    def _relevant_accounts(
+        self,
+        catalog: _CatalogEntry,
+        invoice_payloads: list[dict[str, object]],
+    ) -> list[dict[str, Any]] | None:
+        """
+        Recorta un catálogo grande a las _TOP_K_ACCOUNTS cuentas con más términos en común
+        con las descripciones (ponderados por rareza), más algunas cuentas "diversos/otros"
+        para que el modelo tenga salida cuando nada encaja. None = enviar el catálogo completo
+        (también cuando la factura no comparte ningún término con el catálogo).
+        """
+        if not catalog.token_index:
+            return None
+
+        scores: dict[int, float] = {}
+        for invoice_payload in invoice_payloads:
+            for line in invoice_payload.get("lines") or []:
+                if not isinstance(line, dict):
+                    continue
+                for token in self._tokenize(str(line.get("description", "") or "")):
+                    postings = catalog.token_index.get(token)
+                    if not postings:
+                        continue
+                    weight = 1.0 / len(postings)
+                    for position in postings:
+                        scores[position] = scores.get(position, 0.0) + weight
+
+        if not scores:
+            # Ningún término de la factura aparece en el catálogo: recortar lo dejaría vacío
+            return None
+
+        selected = set(heapq.nlargest(_TOP_K_ACCOUNTS, scores, key=scores.__getitem__))
+        selected.update(catalog.misc_positions)
+        logger.info("📋 Catálogo recortado a %d de %d cuentas relevantes", len(selected), len(catalog.accounts))
+        return [catalog.accounts[position] for position in sorted(selected)]
+
+    def _build_keyword_index(self) -> None:
+        """
+        Construye el mapa palabra clave → código PUC a partir de los nombres de
+        cuenta del catálogo de ingresos y de los sinónimos manuales.
+        """
+        keyword_map: dict[str, str] = {}
+        for account in self._load_puc_fallback():
+            name = self._normalize_text(str(account.get("nombre", "")))
+            if name and " " not in name and name not in _GENERIC_ACCOUNT_NAMES:
+                keyword_map[name] = str(account.get("codigo", ""))
+        keyword_map.update(_KEYWORD_SYNONYMS)
+
+        self._keyword_map = keyword_map
+        if keyword_map:
+            # Las claves más largas primero para que la alternancia prefiera la coincidencia completa
+            alternation = "|".join(map(re.escape, sorted(keyword_map, key=len, reverse=True)))
+            self._keyword_re = re.compile(rf"\b({alternation})(?:es|s)?\b")
+
+    def _prefilter(
+        self,
+        lines: list[object],
+        puc_accounts: list[dict[str, Any]],
+    ) -> tuple[list[dict[str, object]], list[int]]:
+        """
+        Clasifica de forma determinista las líneas cuya descripción contiene una
+        palabra clave inequívoca. Devuelve (sugerencias_directas, líneas_sin_resolver).
+        Solo se usan códigos presentes en el catálogo recibido.
+        """
+        direct: list[dict[str, object]] = []
+        unresolved: list[int] = []
+        if self._keyword_re is None:
+            return direct, [idx for idx, line in enumerate(lines, start=1) if isinstance(line, dict)]
+
+        by_code = {str(acc.get("codigo", "")): acc for acc in puc_accounts}
+        for idx, line in enumerate(lines, start=1):
+            if not isinstance(line, dict):
+                continue
+            description = self._normalize_text(str(line.get("description", "") or ""))
+            match = self._keyword_re.search(description)
+            account = by_code.get(self._keyword_map[match.group(1)]) if match else None
+            if account is None:
+                unresolved.append(idx)
+                continue
+            direct.append(
+                {
+                    "line_number": idx,
+                    "puc_account_id": account.get("id", ""),
+                    "account_code": account.get("codigo", ""),
+                    "account_name": account.get("nombre", ""),
+                    "rationale": (
+                        f"La descripción contiene '{match.group(0)}', que corresponde de forma directa "
+                        f"a la cuenta '{account.get('nombre', '')}' del catálogo PUC."
+                    ),
+                    "confidence": _KEYWORD_CONFIDENCE,
+                }
+            )
+        return direct, unresolved
 
     def _extract_text(self, response: Any) -> str:
         """
         Extrae texto de la respuesta del SDK de forma segura,
         intentando .text y, si no está, armando desde candidates/parts.
         """
-        # 1) Camino feliz: .text
+        # 1) Camino feliz: .text (el SDK lanza ValueError si no hay una única parte de texto)
         try:
-            text = getattr(response, "text", None)
-            if isinstance(text, str) and text.strip():
-                logger.debug("Texto extraído usando response.text")
-                return text.strip()
-        except Exception as e:
-            logger.debug(f"No se pudo usar response.text: {e}")
-            pass
+            text = response.text
+        except (AttributeError, ValueError) as e:
+            logger.debug("No se pudo usar response.text: %s", e)
+            text = None
+        if isinstance(text, str) and text.strip():
+            return text.strip()
 
         # 2) Intentar candidates -> parts -> text
+        return self._extract_from_candidates(response)
+
+    def _extract_from_candidates(self, response: Any) -> str:
         try:
             logger.debug("🔍 Intentando extraer desde candidates/parts")
             candidates = getattr(response, "candidates", None)
@@ -243,217 +1040,219 @@ class GeminiAISuggestionService:
                     if isinstance(t, str) and t.strip():
                         parts_text.append(t.strip())
             result = "\n".join(parts_text).strip()
-            logger.debug(f"Texto extraído desde candidates/parts: {len(result)} caracteres")
+            logger.debug("Texto extraído desde candidates/parts: %d caracteres", len(result))
             return result
         except Exception as e:
-            logger.error(f"Error extrayendo texto desde candidates/parts: {e}")
+            logger.error("Error extrayendo texto desde candidates/parts: %s", e)
             return ""
 
     def _try_parse_json(self, raw: str) -> Any:
         """
         Intenta parsear JSON eliminando fences de markdown si existen.
+        También tolera texto alrededor del array/objeto.
         """
         s = raw.strip()
-        # Remover fences ```json ... ``` o ```
-        if s.startswith("```json"):
-            logger.debug("🔧 Removiendo fence ```json")
-            s = s[7:]
-        if s.startswith("```"):
-            logger.debug("🔧 Removiendo fence ```")
-            s = s[3:]
-        if s.endswith("```"):
-            logger.debug("🔧 Removiendo fence final ```")
-            s = s[:-3]
-        s = s.strip()
+        # Camino rápido: el modelo respondió JSON puro, como pide el prompt
+        if s[:1] in ("[", "{"):
+            try:
+                return orjson.loads(s)
+            except orjson.JSONDecodeError:
+                pass
+
+        match = _JSON_SPAN_RE.search(raw)
+        if match:
+            s = match.group(1) if match.group(1) is not None else match.group(2)
 
         try:
-            result = json.loads(s)
-            logger.debug(f"JSON parseado exitosamente: {type(result)}")
+            result = orjson.loads(s)
+            logger.debug("JSON parseado exitosamente: %s", type(result))
             return result
-        except Exception as e:
-            logger.warning(f"No se pudo parsear como JSON: {e}")
-            logger.debug(f"Contenido que falló: {s[:200]}...")
+        except orjson.JSONDecodeError as e:
+            logger.warning("No se pudo parsear como JSON: %s", e)
+            logger.debug("Contenido que falló: %s...", s[:200])
             return None
 
-    def _build_prompt(self, invoice_payload: dict[str, object], owner_id: str | None = None) -> str:
+    def _build_prompt(
+        self,
+        invoice_payload: dict[str, object],
+        puc_accounts: list[dict[str, Any]],
+        skip: set[int] | None = None,
+        catalog_block: str | None = None,
+    ) -> str:
         """
         Construye el prompt para analizar la factura y producir un array JSON de sugerencias.
-        Usa el PUC personalizado del owner si está disponible.
+        Usa el catálogo PUC recibido; las líneas en `skip` ya fueron clasificadas.
         """
-        supplier = self._safe_dict(invoice_payload.get("supplier"))
-        customer = self._safe_dict(invoice_payload.get("customer"))
         lines = invoice_payload.get("lines")
         if not isinstance(lines, list) or not lines:
             logger.warning("No hay líneas en la factura")
             return ""
 
-        logger.info(f"Construyendo prompt para {len(lines)} líneas")
-        
-        # Obtener PUC personalizado del owner
-        puc_accounts = []
-        if owner_id:
-            puc_accounts = self._get_puc_for_owner(owner_id)
-        else:
-            logger.warning("⚠️ No se proporcionó owner_id, usando PUC fallback")
-            puc_accounts = self._load_puc_fallback()
-
-        summary: list[str] = [
-            "Eres un experto contador colombiano especializado en el Plan Único de Cuentas (PUC).",
-            "",
-            "CONTEXTO: Factura Electrónica de Venta según DIAN 2.1 (UBL 2.1)",
-            "Perfil: DIAN 2.1: Factura Electrónica de Venta",
-            "",
-            "TAREA: Analiza cada línea de venta y asigna el código PUC más apropiado del catálogo personalizado de la empresa.",
-            "",
-            f"Vendedor: {supplier.get('name', 'N/A')} - NIT: {supplier.get('tax_id', 'N/A')}",
-            f"Cliente: {customer.get('name', 'N/A')} - NIT: {customer.get('tax_id', 'N/A')}",
-            f"Total factura: ${self._fmt_amount(invoice_payload.get('total_amount', 0))} {invoice_payload.get('currency', 'COP')}",
-            "",
-            "LÍNEAS DE PRODUCTOS/SERVICIOS VENDIDOS:",
-        ]
+        skip = skip or set()
+        logger.info("Construyendo prompt para %d líneas", len(lines) - len(skip))
 
-        # Limitar a 15 líneas para reducir tokens
-        for idx, line in enumerate(lines[:15], start=1):
-            if not isinstance(line, dict):
+        invoice_block = self._invoice_block(invoice_payload, skip)
+        if catalog_block is None:
+            catalog_block = self._catalog_block(puc_accounts)
+        return f"{self._prompt_prefix(catalog_block)}{_INVOICE_HEADER}{invoice_block}"
+
+    @staticmethod
+    def _prompt_prefix(catalog_block: str, batch: bool = False) -> str:
+        """Parte estable del prompt (instrucciones + catálogo), común a todas las facturas del owner."""
+        if batch:
+            return f"{_BATCH_PREAMBLE}{_INSTRUCTIONS}{_BATCH_RESPONSE_FORMAT}{_FIELD_RULES}\n{catalog_block}"
+        return f"{_PREAMBLE}{_INSTRUCTIONS}{_RESPONSE_FORMAT}{_FIELD_RULES}\n{catalog_block}"
+
+    def _build_batch_prompt(
+        self,
+        items: list[tuple[dict[str, object], set[int]]],
+        puc_accounts: list[dict[str, Any]],
+        catalog_block: str | None = None,
+    ) -> str:
+        """
+        Empaqueta varias facturas en un solo prompt con el catálogo PUC una única vez.
+        La respuesta esperada agrupa las sugerencias por `invoice_index` (1..N).
+        """
+        invoices_block = "".join(
+            f"FACTURA {invoice_index}:\n{self._invoice_block(invoice_payload, skip)}\n"
+            for invoice_index, (invoice_payload, skip) in enumerate(items, start=1)
+        )
+        if catalog_block is None:
+            catalog_block = self._catalog_block(puc_accounts)
+        return f"{self._prompt_prefix(catalog_block, batch=True)}{_BATCH_INVOICE_HEADER}{invoices_block}"
+
+    def _invoice_block(self, invoice_payload: dict[str, object], skip: set[int]) -> str:
+        supplier = self._safe_dict(invoice_payload.get("supplier"))
+        customer = self._safe_dict(invoice_payload.get("customer"))
+        lines = invoice_payload.get("lines") or []
+        header = (
+            f"Vendedor: {supplier.get('name', 'N/A')} - NIT: {supplier.get('tax_id', 'N/A')}\n"
+            f"Cliente: {customer.get('name', 'N/A')} - NIT: {customer.get('tax_id', 'N/A')}\n"
+            f"Total factura: ${self._fmt_amount(invoice_payload.get('total_amount', 0))} "
+            f"{invoice_payload.get('currency', 'COP')}\n"
+            "\n"
+            "LÍNEAS DE PRODUCTOS/SERVICIOS VENDIDOS:\n"
+        )
+
+        # Una entrada por descripción única (cantidades y montos sumados), máximo 15
+        lines_block = "".join(
+            f'{group.number}. "{group.description}" - '
+            f'${self._fmt_amount(group.amount)} (x{group.quantity:g})\n'
+            for group in self._line_groups(lines, skip)
+        )
+        return header + lines_block
+
+    def _line_groups(self, lines: list[Any], skip: set[int]) -> list[_LineGroup]:
+        """
+        Agrupa las líneas pendientes por descripción normalizada, conservando el orden.
+        Limita a 15 descripciones únicas; las repeticiones posteriores se siguen agrupando.
+        """
+        groups: dict[str, _LineGroup] = {}
+        for idx, line in enumerate(lines, start=1):
+            if not isinstance(line, dict) or idx in skip:
                 continue
             description = str(line.get("description", "") or "")
-            amount = line.get("amount", 0)
-            quantity = line.get("quantity", 1)
-            summary.append(f'{idx}. "{description}" - ${self._fmt_amount(amount)} (x{quantity})')
-
-        # Agregar catálogo PUC personalizado
-        summary.extend([
-            "",
-            "═══════════════════════════════════════════════════════════════",
-            "CATÁLOGO PUC PERSONALIZADO DE LA EMPRESA (solo usar estos códigos)",
-            "═══════════════════════════════════════════════════════════════",
-            "",
-        ])
-
-        if puc_accounts:
-            logger.info(f"📋 Agregando {len(puc_accounts)} cuentas PUC al prompt")
-            
-            # Crear un JSON compacto con todas las cuentas
-            summary.append("A continuación, el CATÁLOGO COMPLETO de cuentas PUC en formato JSON:")
-            summary.append("```json")
-            
-            # Formatear como JSON compacto
-            import json
-            puc_json = json.dumps(puc_accounts, ensure_ascii=False, indent=2)
-            summary.append(puc_json)
-            summary.append("```")
-            summary.append("")
-        else:
-            summary.extend([
-                "⚠️ No se ha cargado un PUC personalizado.",
-                "Por favor, sube tu catálogo PUC usando el endpoint /puc/upload",
-                "",
-            ])
-
-        summary.extend(
-            [
-                "═══════════════════════════════════════════════════════════════",
-                "INSTRUCCIONES DE CLASIFICACIÓN:",
-                "═══════════════════════════════════════════════════════════════",
-                "",
-                "1. Analiza CADA línea de producto/servicio de la factura",
-                "2. Para CADA línea, busca en el catálogo JSON la cuenta PUC más apropiada",
-                "3. Usa el campo 'id' de la cuenta seleccionada (importante para referencia)",
-                "4. Usa el campo 'codigo' exacto de la cuenta seleccionada",
-                "5. NO inventes códigos - SOLO usa los que están en el catálogo JSON",
-                "",
-                "CRITERIOS DE SELECCIÓN:",
-                "- Lee cuidadosamente la descripción del producto/servicio",
-                "- Analiza el tipo de transacción (venta, servicio, etc.)",
-                "- Compara con los 'nombre', 'categoria' y 'clase' de las cuentas PUC",
-                "- Elige la cuenta que mejor coincida semánticamente",
-                "- Si hay múltiples opciones similares, elige la más específica",
-                "",
-                "═══════════════════════════════════════════════════════════════",
-                "FORMATO DE RESPUESTA:",
-                "═══════════════════════════════════════════════════════════════",
-                "",
-                "Responde ÚNICAMENTE con un array JSON (sin markdown, sin ```json):",
-                "",
-                '[',
-                '  {',
-                '    "line_number": 1,',
-                '    "puc_account_id": "uuid-de-la-cuenta-puc",',
-                '    "account_code": "41350101",',
-                '    "account_name": "Venta de mercancías al por mayor",',
-                '    "rationale": "Este producto/servicio corresponde a [tipo de operación]. Se clasifica como [categoría] porque [razón específica]. La cuenta seleccionada es apropiada dado que [justificación basada en el nombre/categoría de la cuenta del catálogo PUC].",',
-                '    "confidence": 0.95',
-                '  },',
-                '  {',
-                '    "line_number": 2,',
-                '    "puc_account_id": "uuid-de-otra-cuenta",',
-                '    "account_code": "41400501",',
-                '    "account_name": "Ingresos operacionales - Restaurante",',
-                '    "rationale": "Se trata de un servicio de alimentación. Se clasifica en la categoría de servicios de restaurante porque involucra la preparación y venta de alimentos. Esta cuenta del PUC es la indicada para registrar ingresos por este tipo de actividad comercial.",',
-                '    "confidence": 0.90',
-                '  }',
-                ']',
-                "",
-                "CAMPOS OBLIGATORIOS:",
-                "- line_number: número de línea (1, 2, 3...)",
-                "- puc_account_id: campo 'id' de la cuenta PUC seleccionada del catálogo JSON",
-                "- account_code: campo 'codigo' de la cuenta PUC seleccionada",
-                "- account_name: campo 'nombre' de la cuenta PUC seleccionada",
-                "- rationale: explicación DETALLADA (150-250 caracteres) que incluya:",
-                "    * Qué tipo de operación/producto/servicio es",
-                "    * Por qué se clasifica en esa categoría",
-                "    * Cómo coincide con la cuenta PUC seleccionada",
-                "    * Cualquier detalle relevante del vendedor/cliente si aplica",
-                "- confidence: número entre 0 y 1",
-                "",
-                "IMPORTANTE:",
-                "- Los valores puc_account_id, account_code y account_name DEBEN venir del catálogo JSON",
-                "- NO inventes IDs ni códigos",
-                "- El rationale debe ser informativo y profesional (piensa como un contador explicando)",
-                "- Menciona elementos específicos de la descripción del producto/servicio",
-                "- Explica claramente la conexión entre la transacción y la cuenta PUC",
-                "- Si el vendedor/cliente tiene actividad relevante, menciónalo",
-                "- Si no encuentras una cuenta apropiada, explica por qué y usa confidence bajo (< 0.5)",
-                "",
-                "EJEMPLO DE BUEN RATIONALE:",
-                '"El vendedor es una droguería que comercializa productos farmacéuticos. Este ítem corresponde a ',
-                'la venta de mercancías del giro comercial principal (productos de salud). Se clasifica en la cuenta ',
-                'de \'Comercio al por mayor y al detal\' ya que refleja los ingresos operacionales por la actividad ',
-                'comercial de compra-venta de productos. Esta es la clasificación apropiada según el PUC para empresas ',
-                'del sector comercio."',
-            ]
-        )
+            amount = self._to_float(line.get("amount", 0), 0.0)
+            quantity = self._to_float(line.get("quantity", 1), 1.0)
+            key = self._normalize_text(description)
+            group = groups.get(key)
+            if group is not None:
+                group.amount += amount
+                group.quantity += quantity
+                group.duplicates.append(idx)
+            elif len(groups) < 15:
+                groups[key] = _LineGroup(idx, description, amount, quantity)
+        return list(groups.values())
+
+    @staticmethod
+    def _duplicate_map(groups: list[_LineGroup]) -> dict[int, list[int]]:
+        return {group.number: group.duplicates for group in groups if group.duplicates}
 
-        return "\n".join(summary)
+    @staticmethod
+    def _expand_duplicates(
+        suggestions: Iterable[dict[str, object]],
+        duplicates: dict[int, list[int]],
+    ) -> Iterator[dict[str, object]]:
+        """Replica la sugerencia de cada línea representativa en sus líneas repetidas."""
+        for suggestion in suggestions:
+            yield suggestion
+            try:
+                line_number = int(suggestion.get("line_number"))  # type: ignore[arg-type]
+            except (TypeError, ValueError):
+                continue
+            for duplicate in duplicates.get(line_number, ()):
+                yield {**suggestion, "line_number": duplicate}
+
+    @staticmethod
+    def _serialize_catalog(puc_accounts: list[dict[str, Any]]) -> str:
+        # JSON compacto (sin espacios) y solo con los campos útiles: menos tokens de entrada
+        projected = [
+            {key: account[key] for key in _PROMPT_ACCOUNT_FIELDS if key in account}
+            for account in puc_accounts
+        ]
+        return orjson.dumps(projected).decode("utf-8")
+
+    @staticmethod
+    def _catalog_block(
+        puc_accounts: list[dict[str, Any]],
+        puc_json: str | None = None,
+        trimmed: bool = False,
+    ) -> str:
+        """
+        Sección del catálogo PUC; se cachea por owner junto con el catálogo.
+        Con `trimmed` se aclara al modelo que solo ve las cuentas más afines de un catálogo mayor.
+        """
+        if not puc_accounts:
+            return _CATALOG_HEADER + _NO_CATALOG_BLOCK
+
+        logger.info("📋 Agregando %d cuentas PUC al prompt", len(puc_accounts))
+        # Normalmente ya viene serializado desde la caché del catálogo
+        if puc_json is None:
+            puc_json = GeminiAISuggestionService._serialize_catalog(puc_accounts)
+        intro = _TRIMMED_CATALOG_INTRO if trimmed else _FULL_CATALOG_INTRO
+        return f"{_CATALOG_HEADER}{intro}```json\n{puc_json}\n```\n\n"
 
     def _parse_from_text(self, content: str) -> Iterable[dict[str, object]]:
         """
         Fallback: líneas con formato "codigo | razon | confianza"
         """
-        for line in content.splitlines():
-            if "|" not in line:
-                continue
-            cleaned = line.strip().lstrip("- ")
-            parts = [segment.strip() for segment in cleaned.split("|")]
-            if not parts or not parts[0]:
+        for match in _TEXT_LINE_RE.finditer(content):
+            code, rationale, confidence = match.groups()
+            if not code:
                 continue
 
-            suggestion: dict[str, object] = {"account_code": parts[0]}
-            if len(parts) >= 2 and parts[1]:
-                suggestion["rationale"] = parts[1]
-            if len(parts) >= 3:
+            suggestion: dict[str, object] = {"account_code": code}
+            if rationale:
+                suggestion["rationale"] = rationale
+            if confidence:
                 try:
-                    suggestion["confidence"] = float(parts[2])
+                    suggestion["confidence"] = float(confidence)
                 except ValueError:
                     pass
             yield suggestion
 
     # ------------------ UTILIDADES ------------------
 
+    @classmethod
+    def _tokenize(cls, value: str) -> set[str]:
+        return {token for token in _TOKEN_RE.findall(cls._normalize_text(value)) if token not in _STOPWORDS}
+
+    @staticmethod
+    def _normalize_text(value: str) -> str:
+        decomposed = unicodedata.normalize("NFKD", value)
+        return "".join(ch for ch in decomposed if not unicodedata.combining(ch)).lower()
+
     @staticmethod
     def _safe_dict(value: object) -> dict[str, Any]:
         return value if isinstance(value, dict) else {}
 
+    @staticmethod
+    def _to_float(value: object, default: float) -> float:
+        try:
+            return float(value)  # type: ignore[arg-type]
+        except (TypeError, ValueError):
+            return default
+
     @staticmethod
     def _fmt_amount(value: object) -> str:
         try:
@@ -2,299 +2,334 @@ from __future__ import annotations
 
 from dataclasses import dataclass
 from datetime import UTC, datetime
-from decimal import Decimal
-from io import BytesIO
-from typing import Any, Iterable
+from tempfile import SpooledTemporaryFile
+from typing import IO, Any, Iterable
 from xml.sax.saxutils import escape
-from zipfile import ZIP_DEFLATED, ZipFile
+from zipfile import ZIP_DEFLATED, ZIP_STORED, ZipFile
 
 from app.domain import AISuggestion, Invoice
 
 try:  # pragma: no cover - dependencia opcional
-    import pandas as pd  # type: ignore
+    import xlsxwriter  # type: ignore
 except ModuleNotFoundError:  # pragma: no cover - degradación controlada
-    pd = None  # type: ignore[assignment]
+    xlsxwriter = None  # type: ignore[assignment]
+
+
+# Encabezados fijos de cada hoja; las filas se generan como tuplas en este mismo orden
+_RESUMEN_HEADERS = (
+    "Consecutivo externo",
+    "Fecha",
+    "Proveedor",
+    "NIT proveedor",
+    "Cliente",
+    "NIT cliente",
+    "Moneda",
+    "Subtotal",
+    "Impuestos",
+    "Total",
+)
+
+_PRODUCTOS_HEADERS = (
+    "Consecutivo externo",
+    "ID producto",
+    "Descripción",
+    "Cantidad",
+    "Precio unitario",
+    "Subtotal",
+    "Código PUC",
+    "Justificación",
+    "Confianza",
+)
+
+# Columnas con valores numéricos (se escriben como <v>, no como texto)
+_RESUMEN_NUMERIC = frozenset({"Subtotal", "Impuestos", "Total"})
+_PRODUCTOS_NUMERIC = frozenset({"Cantidad", "Precio unitario", "Subtotal", "Confianza"})
+
+
+def _column_letter(index: int) -> str:
+    result = ""
+    while index:
+        index, remainder = divmod(index - 1, 26)
+        result = chr(65 + remainder) + result
+    return result or "A"
+
+
+# Letras de columna precalculadas para todo el rango de Excel (A..XFD)
+_COLUMN_LETTERS = tuple(_column_letter(index) for index in range(1, 16385))
+
+# Tamaño a partir del cual el libro en construcción se vuelca a disco
+_SPOOL_MAX_BYTES = 32 * 1024 * 1024
+
+# Envoltura fija de cada hoja del escritor mínimo, ya codificada
+_SHEET_XML_HEAD = (
+    b"<?xml version=\"1.0\" encoding=\"UTF-8\"?>"
+    b"<worksheet xmlns=\"http://schemas.openxmlformats.org/spreadsheetml/2006/main\">"
+    b"<sheetData>"
+)
+_SHEET_XML_TAIL = b"</sheetData></worksheet>"
+
+# Partes fijas del paquete .xlsx del escritor mínimo, ya codificadas (solo core.xml lleva la fecha)
+_CONTENT_TYPES_XML = (
+    b"<?xml version=\"1.0\" encoding=\"UTF-8\"?>"
+    b"<Types xmlns=\"http://schemas.openxmlformats.org/package/2006/content-types\">"
+    b"<Default Extension=\"rels\" ContentType=\"application/vnd.openxmlformats-package.relationships+xml\"/>"
+    b"<Default Extension=\"xml\" ContentType=\"application/xml\"/>"
+    b"<Override PartName=\"/xl/workbook.xml\" ContentType=\"application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml\"/>"
+    b"<Override PartName=\"/xl/worksheets/sheet1.xml\" ContentType=\"application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml\"/>"
+    b"<Override PartName=\"/xl/worksheets/sheet2.xml\" ContentType=\"application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml\"/>"
+    b"<Override PartName=\"/xl/styles.xml\" ContentType=\"application/vnd.openxmlformats-officedocument.spreadsheetml.styles+xml\"/>"
+    b"<Override PartName=\"/docProps/core.xml\" ContentType=\"application/vnd.openxmlformats-package.core-properties+xml\"/>"
+    b"<Override PartName=\"/docProps/app.xml\" ContentType=\"application/vnd.openxmlformats-officedocument.extended-properties+xml\"/>"
+    b"</Types>"
+)
+
+_RELS_XML = (
+    b"<?xml version=\"1.0\" encoding=\"UTF-8\"?>"
+    b"<Relationships xmlns=\"http://schemas.openxmlformats.org/package/2006/relationships\">"
+    b"<Relationship Id=\"rId1\" Type=\"http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument\" Target=\"xl/workbook.xml\"/>"
+    b"</Relationships>"
+)
+
+_WORKBOOK_XML = (
+    b"<?xml version=\"1.0\" encoding=\"UTF-8\"?>"
+    b"<workbook xmlns=\"http://schemas.openxmlformats.org/spreadsheetml/2006/main\" xmlns:r=\"http://schemas.openxmlformats.org/officeDocument/2006/relationships\">"
+    b"<sheets>"
+    b"<sheet name=\"Resumen\" sheetId=\"1\" r:id=\"rId1\"/>"
+    b"<sheet name=\"Productos\" sheetId=\"2\" r:id=\"rId2\"/>"
+    b"</sheets>"
+    b"</workbook>"
+)
+
+_WORKBOOK_RELS_XML = (
+    b"<?xml version=\"1.0\" encoding=\"UTF-8\"?>"
+    b"<Relationships xmlns=\"http://schemas.openxmlformats.org/package/2006/relationships\">"
+    b"<Relationship Id=\"rId1\" Type=\"http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet\" Target=\"worksheets/sheet1.xml\"/>"
+    b"<Relationship Id=\"rId2\" Type=\"http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet\" Target=\"worksheets/sheet2.xml\"/>"
+    b"<Relationship Id=\"rId3\" Type=\"http://schemas.openxmlformats.org/officeDocument/2006/relationships/styles\" Target=\"styles.xml\"/>"
+    b"</Relationships>"
+)
+
+_STYLES_XML = (
+    b"<?xml version=\"1.0\" encoding=\"UTF-8\"?>"
+    b"<styleSheet xmlns=\"http://schemas.openxmlformats.org/spreadsheetml/2006/main\">"
+    b"<fonts count=\"1\"><font><sz val=\"11\"/><color theme=\"1\"/><name val=\"Calibri\"/></font></fonts>"
+    b"<fills count=\"1\"><fill><patternFill patternType=\"none\"/></fill></fills>"
+    b"<borders count=\"1\"><border><left/><right/><top/><bottom/><diagonal/></border></borders>"
+    b"<cellStyleXfs count=\"1\"><xf numFmtId=\"0\" fontId=\"0\" fillId=\"0\" borderId=\"0\"/></cellStyleXfs>"
+    b"<cellXfs count=\"1\"><xf numFmtId=\"0\" fontId=\"0\" fillId=\"0\" borderId=\"0\" xfId=\"0\"/></cellXfs>"
+    b"</styleSheet>"
+)
+
+_CORE_XML_TEMPLATE = (
+    b"<?xml version=\"1.0\" encoding=\"UTF-8\"?>"
+    b"<cp:coreProperties xmlns:cp=\"http://schemas.openxmlformats.org/package/2006/metadata/core-properties\" xmlns:dc=\"http://purl.org/dc/elements/1.1/\" xmlns:dcterms=\"http://purl.org/dc/terms/\" xmlns:xsi=\"http://www.w3.org/2001/XMLSchema-instance\">"
+    b"<dc:creator>Cifrato Backend</dc:creator>"
+    b"<cp:lastModifiedBy>Cifrato Backend</cp:lastModifiedBy>"
+    b"<dcterms:created xsi:type=\"dcterms:W3CDTF\">%b</dcterms:created>"
+    b"<dcterms:modified xsi:type=\"dcterms:W3CDTF\">%b</dcterms:modified>"
+    b"</cp:coreProperties>"
+)
+
+_APP_XML = (
+    b"<?xml version=\"1.0\" encoding=\"UTF-8\"?>"
+    b"<Properties xmlns=\"http://schemas.openxmlformats.org/officeDocument/2006/extended-properties\" xmlns:vt=\"http://schemas.openxmlformats.org/officeDocument/2006/docPropsVTypes\">"
+    b"<Application>Python</Application>"
+    b"</Properties>"
+)
 
 
 @dataclass(slots=True)
 class SpreadsheetInvoiceWorkbookBuilder:
-    engine: str = "openpyxl"
     puc_catalog_generator: Any = None  # PUCCatalogGenerator opcional
+    compresslevel: int = 6  # nivel deflate de las hojas en el escritor mínimo
 
     def build(
         self,
         invoices: list[Invoice],
         suggestions_map: dict[str, list[AISuggestion]],
     ) -> bytes:
-        if pd is not None:
-            return self._build_with_pandas(invoices, suggestions_map)
-        return self._build_with_minimal_writer(invoices, suggestions_map)
+        # Hasta _SPOOL_MAX_BYTES el libro se arma en memoria; si lo supera pasa a un archivo
+        # temporal en lugar de seguir duplicando un BytesIO
+        with SpooledTemporaryFile(max_size=_SPOOL_MAX_BYTES) as buffer:
+            self.build_to(buffer, invoices, suggestions_map)
+            buffer.seek(0)
+            return buffer.read()
 
-    def _build_with_pandas(
+    def build_to(
         self,
+        fp: IO[bytes],
         invoices: list[Invoice],
         suggestions_map: dict[str, list[AISuggestion]],
-    ) -> bytes:
-        buffer = BytesIO()
+    ) -> None:
+        """
+        Escribe el libro directamente en `fp` (archivo, respuesta HTTP, carga multiparte...)
+        sin acumular el resultado completo en memoria.
+        """
+        if xlsxwriter is not None:
+            self._write_with_xlsxwriter(fp, invoices, suggestions_map)
+        else:
+            self._write_with_minimal_writer(fp, invoices, suggestions_map)
+
+    def _write_with_xlsxwriter(
+        self,
+        fp: IO[bytes],
+        invoices: list[Invoice],
+        suggestions_map: dict[str, list[AISuggestion]],
+    ) -> None:
+        """
+        Escribe las filas directamente en la hoja, sin DataFrames ni formateo por celda.
+        constant_memory vuelca cada fila al terminarla: memoria O(fila), no O(hoja).
+        Los textos de terceros (descripciones, rationales) se escriben tal cual: un "=..."
+        no se convierte en fórmula ni un "https://..." en hipervínculo.
+        """
+        workbook = xlsxwriter.Workbook(
+            fp,
+            {"constant_memory": True, "strings_to_formulas": False, "strings_to_urls": False},
+        )
 
         # Hoja 1: Resumen con datos generales de factura (sin PUC)
-        resumen_rows = list(self._build_resumen_rows(invoices, suggestions_map))
-        
-        # Hoja 2: Productos con sus códigos PUC específicos por línea
-        productos_rows = list(self._build_lines_rows(invoices, suggestions_map))
+        resumen = workbook.add_worksheet("Resumen")
+        resumen.write_row(0, 0, _RESUMEN_HEADERS)
+        for row_index, row in enumerate(self._build_resumen_rows(invoices, suggestions_map), start=1):
+            resumen.write_row(row_index, 0, row)
 
-        with pd.ExcelWriter(buffer, engine=self.engine) as writer:  # type: ignore[arg-type]
-            pd.DataFrame(resumen_rows).to_excel(writer, sheet_name="Resumen", index=False)  # type: ignore[call-arg]
-            pd.DataFrame(productos_rows).to_excel(writer, sheet_name="Productos", index=False)  # type: ignore[call-arg]
+        # Hoja 2: Productos con sus códigos PUC específicos por línea
+        productos = workbook.add_worksheet("Productos")
+        productos.write_row(0, 0, _PRODUCTOS_HEADERS)
+        for row_index, row in enumerate(self._build_lines_rows(invoices, suggestions_map), start=1):
+            productos.write_row(row_index, 0, row)
 
-        return buffer.getvalue()
+        workbook.close()
 
-    def _build_with_minimal_writer(
+    def _write_with_minimal_writer(
         self,
+        fp: IO[bytes],
         invoices: list[Invoice],
         suggestions_map: dict[str, list[AISuggestion]],
-    ) -> bytes:
-        # Hoja 1: Resumen (sin PUC)
-        resumen_sheet = [
-            [
-                "Consecutivo externo",
-                "Fecha",
-                "Proveedor",
-                "NIT proveedor",
-                "Cliente",
-                "NIT cliente",
-                "Moneda",
-                "Subtotal",
-                "Impuestos",
-                "Total",
-            ]
-        ]
-        for row in self._build_resumen_rows(invoices, suggestions_map):
-            resumen_sheet.append(
-                [
-                    row["Consecutivo externo"],
-                    row["Fecha"],
-                    row["Proveedor"],
-                    row["NIT proveedor"],
-                    row["Cliente"],
-                    row["NIT cliente"],
-                    row["Moneda"],
-                    row["Subtotal"],
-                    row["Impuestos"],
-                    row["Total"],
-                ]
-            )
-
-        # Hoja 2: Productos (con PUC por línea)
-        productos_sheet = [
-            [
-                "Consecutivo externo",
-                "ID producto",
-                "Descripción",
-                "Cantidad",
-                "Precio unitario",
-                "Subtotal",
-                "Código PUC",
-                "Justificación",
-                "Confianza",
-            ]
-        ]
-        for row in self._build_lines_rows(invoices, suggestions_map):
-            productos_sheet.append(
-                [
-                    row["Consecutivo externo"],
-                    row["ID producto"],
-                    row["Descripción"],
-                    row["Cantidad"],
-                    row["Precio unitario"],
-                    row["Subtotal"],
-                    row["Código PUC"],
-                    row["Justificación"],
-                    row["Confianza"],
-                ]
-            )
+    ) -> None:
+        timestamp = datetime.now(UTC).strftime("%Y-%m-%dT%H:%M:%SZ").encode("ascii")
+        with ZipFile(fp, "w", ZIP_DEFLATED, compresslevel=self.compresslevel) as archive:
+            # Las partes fijas pesan pocos cientos de bytes: se guardan sin comprimir
+            archive.writestr("[Content_Types].xml", _CONTENT_TYPES_XML, compress_type=ZIP_STORED)
+            archive.writestr("_rels/.rels", _RELS_XML, compress_type=ZIP_STORED)
+            archive.writestr("docProps/core.xml", _CORE_XML_TEMPLATE % (timestamp, timestamp), compress_type=ZIP_STORED)
+            archive.writestr("docProps/app.xml", _APP_XML, compress_type=ZIP_STORED)
+            archive.writestr("xl/_rels/workbook.xml.rels", _WORKBOOK_RELS_XML, compress_type=ZIP_STORED)
+            archive.writestr("xl/workbook.xml", _WORKBOOK_XML, compress_type=ZIP_STORED)
+            archive.writestr("xl/styles.xml", _STYLES_XML, compress_type=ZIP_STORED)
 
-        timestamp = datetime.now(UTC).strftime("%Y-%m-%dT%H:%M:%SZ")
-        buffer = BytesIO()
-        with ZipFile(buffer, "w", ZIP_DEFLATED) as archive:
-            archive.writestr("[Content_Types].xml", self._content_types_xml())
-            archive.writestr("_rels/.rels", self._rels_xml())
-            archive.writestr("docProps/core.xml", self._core_xml(timestamp))
-            archive.writestr("docProps/app.xml", self._app_xml())
-            archive.writestr("xl/_rels/workbook.xml.rels", self._workbook_rels_xml())
-            archive.writestr("xl/workbook.xml", self._workbook_xml())
-            archive.writestr("xl/styles.xml", self._styles_xml())
-            archive.writestr("xl/worksheets/sheet1.xml", self._sheet_xml(resumen_sheet))
-            archive.writestr("xl/worksheets/sheet2.xml", self._sheet_xml(productos_sheet))
-
-        return buffer.getvalue()
+            # Las hojas se escriben fila a fila dentro del zip: nunca existe la hoja completa en memoria
+            with archive.open("xl/worksheets/sheet1.xml", "w", force_zip64=True) as sheet:
+                # Hoja 1: Resumen (sin PUC)
+                self._write_sheet(
+                    sheet, _RESUMEN_HEADERS, self._build_resumen_rows(invoices, suggestions_map), _RESUMEN_NUMERIC
+                )
+            with archive.open("xl/worksheets/sheet2.xml", "w", force_zip64=True) as sheet:
+                # Hoja 2: Productos (con PUC por línea)
+                self._write_sheet(
+                    sheet, _PRODUCTOS_HEADERS, self._build_lines_rows(invoices, suggestions_map), _PRODUCTOS_NUMERIC
+                )
 
     def _build_resumen_rows(
         self,
         invoices: Iterable[Invoice],
         suggestions_map: dict[str, list[AISuggestion]],
-    ) -> Iterable[dict[str, object]]:
+    ) -> Iterable[tuple[object, ...]]:
         """
-        Datos generales de factura sin códigos PUC.
+        Datos generales de factura sin códigos PUC (columnas de _RESUMEN_HEADERS).
         Los códigos PUC ahora van en la hoja de productos.
         """
         for invoice in invoices:
-            subtotal = invoice.total_amount - invoice.tax_amount
-            
-            yield {
-                "Consecutivo externo": invoice.external_id,
-                "Fecha": invoice.issue_date.isoformat(),
-                "Proveedor": invoice.supplier_name,
-                "NIT proveedor": invoice.supplier_tax_id,
-                "Cliente": invoice.customer_name,
-                "NIT cliente": invoice.customer_tax_id,
-                "Moneda": invoice.currency,
-                "Subtotal": float(subtotal),
-                "Impuestos": float(invoice.tax_amount),
-                "Total": float(invoice.total_amount),
-            }
+            # Cada monto se lee una vez; el subtotal se resta en Decimal antes de pasar a float
+            total_amount = invoice.total_amount
+            tax_amount = invoice.tax_amount
+            yield (
+                invoice.external_id,
+                invoice.issue_date.isoformat(),
+                invoice.supplier_name,
+                invoice.supplier_tax_id,
+                invoice.customer_name,
+                invoice.customer_tax_id,
+                invoice.currency,
+                float(total_amount - tax_amount),
+                float(tax_amount),
+                float(total_amount),
+            )
 
     def _build_lines_rows(
         self, 
         invoices: Iterable[Invoice],
         suggestions_map: dict[str, list[AISuggestion]],
-    ) -> Iterable[dict[str, object]]:
+    ) -> Iterable[tuple[object, ...]]:
         """
-        Productos con sus respectivas sugerencias PUC según line_number.
+        Productos con sus respectivas sugerencias PUC según line_number (columnas de _PRODUCTOS_HEADERS).
         """
         for invoice in invoices:
-            suggestions = suggestions_map.get(invoice.id, [])
-            
-            for idx, line in enumerate(invoice.lines, start=1):
-                # Buscar sugerencia para esta línea específica
-                line_suggestions = [s for s in suggestions if s.line_number == idx]
-                
-                # Ordenar por confianza y tomar la mejor
-                if line_suggestions:
-                    line_suggestions.sort(key=lambda s: s.confidence, reverse=True)
-                    suggestion = line_suggestions[0]
-                else:
-                    suggestion = None
-                
-                yield {
-                    "Consecutivo externo": invoice.external_id,
-                    "ID producto": line.line_id,
-                    "Descripción": line.description,
-                    "Cantidad": float(line.quantity),
-                    "Precio unitario": float(line.unit_price),
-                    "Subtotal": float(line.line_extension_amount),
-                    "Código PUC": suggestion.account_code if suggestion else "",
-                    "Justificación": suggestion.rationale if suggestion else "",
-                    "Confianza": float(suggestion.confidence) if suggestion else 0.0,
-                }
-
-    def _sheet_xml(self, rows: list[list[object]]) -> str:
-        body: list[str] = []
-        for row_index, row in enumerate(rows, start=1):
-            cells: list[str] = []
-            for column_index, value in enumerate(row, start=1):
-                cell_ref = f"{self._column_letter(column_index)}{row_index}"
-                if self._is_number(value):
-                    cells.append(f'<c r="{cell_ref}"><v>{value}</v></c>')
-                else:
-                    text = "" if value is None else escape(str(value))
-                    cells.append(
-                        f'<c r="{cell_ref}" t="inlineStr"><is><t>{text}</t></is></c>'
-                    )
-            body.append(f"<row r=\"{row_index}\">{''.join(cells)}</row>")
-
-        return (
-            "<?xml version=\"1.0\" encoding=\"UTF-8\"?>"
-            "<worksheet xmlns=\"http://schemas.openxmlformats.org/spreadsheetml/2006/main\">"
-            f"<sheetData>{''.join(body)}</sheetData>"
-            "</worksheet>"
-        )
-
-    def _content_types_xml(self) -> str:
-        return (
-            "<?xml version=\"1.0\" encoding=\"UTF-8\"?>"
-            "<Types xmlns=\"http://schemas.openxmlformats.org/package/2006/content-types\">"
-            "<Default Extension=\"rels\" ContentType=\"application/vnd.openxmlformats-package.relationships+xml\"/>"
-            "<Default Extension=\"xml\" ContentType=\"application/xml\"/>"
-            "<Override PartName=\"/xl/workbook.xml\" ContentType=\"application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml\"/>"
-            "<Override PartName=\"/xl/worksheets/sheet1.xml\" ContentType=\"application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml\"/>"
-            "<Override PartName=\"/xl/worksheets/sheet2.xml\" ContentType=\"application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml\"/>"
-            "<Override PartName=\"/xl/styles.xml\" ContentType=\"application/vnd.openxmlformats-officedocument.spreadsheetml.styles+xml\"/>"
-            "<Override PartName=\"/docProps/core.xml\" ContentType=\"application/vnd.openxmlformats-package.core-properties+xml\"/>"
-            "<Override PartName=\"/docProps/app.xml\" ContentType=\"application/vnd.openxmlformats-officedocument.extended-properties+xml\"/>"
-            "</Types>"
-        )
-
-    def _rels_xml(self) -> str:
-        return (
-            "<?xml version=\"1.0\" encoding=\"UTF-8\"?>"
-            "<Relationships xmlns=\"http://schemas.openxmlformats.org/package/2006/relationships\">"
-            "<Relationship Id=\"rId1\" Type=\"http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument\" Target=\"xl/workbook.xml\"/>"
-            "</Relationships>"
-        )
+            best_by_line = self._best_suggestion_by_line(suggestions_map.get(invoice.id, ()))
 
-    def _workbook_xml(self) -> str:
-        return (
-            "<?xml version=\"1.0\" encoding=\"UTF-8\"?>"
-            "<workbook xmlns=\"http://schemas.openxmlformats.org/spreadsheetml/2006/main\" xmlns:r=\"http://schemas.openxmlformats.org/officeDocument/2006/relationships\">"
-            "<sheets>"
-            "<sheet name=\"Resumen\" sheetId=\"1\" r:id=\"rId1\"/>"
-            "<sheet name=\"Productos\" sheetId=\"2\" r:id=\"rId2\"/>"
-            "</sheets>"
-            "</workbook>"
-        )
-
-    def _workbook_rels_xml(self) -> str:
-        return (
-            "<?xml version=\"1.0\" encoding=\"UTF-8\"?>"
-            "<Relationships xmlns=\"http://schemas.openxmlformats.org/package/2006/relationships\">"
-            "<Relationship Id=\"rId1\" Type=\"http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet\" Target=\"worksheets/sheet1.xml\"/>"
-            "<Relationship Id=\"rId2\" Type=\"http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet\" Target=\"worksheets/sheet2.xml\"/>"
-            "<Relationship Id=\"rId3\" Type=\"http://schemas.openxmlformats.org/officeDocument/2006/relationships/styles\" Target=\"styles.xml\"/>"
-            "</Relationships>"
-        )
+            for idx, line in enumerate(invoice.lines, start=1):
+                suggestion = best_by_line.get(idx)
+                yield (
+                    invoice.external_id,
+                    line.line_id,
+                    line.description,
+                    float(line.quantity),
+                    float(line.unit_price),
+                    float(line.line_extension_amount),
+                    suggestion.account_code if suggestion else "",
+                    suggestion.rationale if suggestion else "",
+                    float(suggestion.confidence) if suggestion else 0.0,
+                )
 
-    def _styles_xml(self) -> str:
-        return (
-            "<?xml version=\"1.0\" encoding=\"UTF-8\"?>"
-            "<styleSheet xmlns=\"http://schemas.openxmlformats.org/spreadsheetml/2006/main\">"
-            "<fonts count=\"1\"><font><sz val=\"11\"/><color theme=\"1\"/><name val=\"Calibri\"/></font></fonts>"
-            "<fills count=\"1\"><fill><patternFill patternType=\"none\"/></fill></fills>"
-            "<borders count=\"1\"><border><left/><right/><top/><bottom/><diagonal/></border></borders>"
-            "<cellStyleXfs count=\"1\"><xf numFmtId=\"0\" fontId=\"0\" fillId=\"0\" borderId=\"0\"/></cellStyleXfs>"
-            "<cellXfs count=\"1\"><xf numFmtId=\"0\" fontId=\"0\" fillId=\"0\" borderId=\"0\" xfId=\"0\"/></cellXfs>"
-            "</styleSheet>"
-        )
+    @staticmethod
+    def _best_suggestion_by_line(suggestions: Iterable[AISuggestion]) -> dict[int, AISuggestion]:
+        """
+        Sugerencia de mayor confianza por número de línea, en una sola pasada.
+        Con empate se conserva la primera, igual que el ordenamiento estable anterior.
+        """
+        best: dict[int, AISuggestion] = {}
+        for suggestion in suggestions:
+            if suggestion.line_number is None:
+                continue
+            current = best.get(suggestion.line_number)
+            if current is None or suggestion.confidence > current.confidence:
+                best[suggestion.line_number] = suggestion
+        return best
 
-    def _core_xml(self, timestamp: str) -> str:
-        return (
-            "<?xml version=\"1.0\" encoding=\"UTF-8\"?>"
-            "<cp:coreProperties xmlns:cp=\"http://schemas.openxmlformats.org/package/2006/metadata/core-properties\" xmlns:dc=\"http://purl.org/dc/elements/1.1/\" xmlns:dcterms=\"http://purl.org/dc/terms/\" xmlns:xsi=\"http://www.w3.org/2001/XMLSchema-instance\">"
-            "<dc:creator>Cifrato Backend</dc:creator>"
-            "<cp:lastModifiedBy>Cifrato Backend</cp:lastModifiedBy>"
-            f"<dcterms:created xsi:type=\"dcterms:W3CDTF\">{timestamp}</dcterms:created>"
-            f"<dcterms:modified xsi:type=\"dcterms:W3CDTF\">{timestamp}</dcterms:modified>"
-            "</cp:coreProperties>"
-        )
+    def _write_sheet(
+        self,
+        fp: IO[bytes],
+        headers: tuple[str, ...],
+        rows: Iterable[Iterable[object]],
+        numeric_columns: frozenset[str],
+    ) -> None:
+        # Cada fila se codifica una vez y se escribe de inmediato en el destino (p. ej. el zip)
+        fp.write(_SHEET_XML_HEAD)
+        letters = _COLUMN_LETTERS[: len(headers)]
+        # El esquema de cada hoja es fijo: qué columnas son numéricas se decide una vez
+        numeric = [header in numeric_columns for header in headers]
 
-    def _app_xml(self) -> str:
-        return (
-            "<?xml version=\"1.0\" encoding=\"UTF-8\"?>"
-            "<Properties xmlns=\"http://schemas.openxmlformats.org/officeDocument/2006/extended-properties\" xmlns:vt=\"http://schemas.openxmlformats.org/officeDocument/2006/docPropsVTypes\">"
-            "<Application>Python</Application>"
-            "</Properties>"
+        header_cells = "".join(
+            f'<c r="{letter}1" t="inlineStr"><is><t>{escape(header)}</t></is></c>'
+            for letter, header in zip(letters, headers)
         )
+        fp.write(f'<row r="1">{header_cells}</row>'.encode("utf-8"))
 
-    def _column_letter(self, index: int) -> str:
-        result = ""
-        while index:
-            index, remainder = divmod(index - 1, 26)
-            result = chr(65 + remainder) + result
-        return result or "A"
-
-    def _is_number(self, value: object) -> bool:
-        if isinstance(value, (int, float)):
-            return True
-        if isinstance(value, Decimal):
-            return True
-        return False
+        # Las filas se arman directamente en bytes: los números se formatean con %r (repr de
+        # float/int) sin pasar por str, y solo el texto de las celdas se escapa y codifica
+        column_refs = [letter.encode("ascii") for letter in letters]
+        for row_index, row in enumerate(rows, start=2):
+            body = bytearray(b'<row r="%d">' % row_index)
+            for ref, is_numeric, value in zip(column_refs, numeric, row):
+                if value is None:
+                    body += b'<c r="%b%d" t="inlineStr"><is><t></t></is></c>' % (ref, row_index)
+                elif is_numeric and value.__class__ in (float, int):
+                    body += b'<c r="%b%d"><v>%r</v></c>' % (ref, row_index, value)
+                elif is_numeric:
+                    body += b'<c r="%b%d"><v>%b</v></c>' % (ref, row_index, str(value).encode("ascii"))
+                else:
+                    text = escape(str(value)).encode("utf-8")
+                    body += b'<c r="%b%d" t="inlineStr"><is><t>%b</t></is></c>' % (ref, row_index, text)
+            body += b"</row>"
+            fp.write(body)
+        fp.write(_SHEET_XML_TAIL)
@@ -1,10 +1,11 @@
 from __future__ import annotations
 
-import json
 import os
 from functools import lru_cache
 from typing import Any
 
+import orjson
+
 try:  # pragma: no cover - la dependencia real es opcional en pruebas
     import firebase_admin
     from firebase_admin import credentials
@@ -17,12 +18,15 @@ class FirebaseAdminUnavailable(RuntimeError):
     pass
 
 
+@lru_cache(maxsize=1)
 def _load_service_account() -> dict[str, Any]:
     # Only support FIREBASE_CREDENTIALS_JSON. Do not read a credentials file from disk.
+    # Se parsea una sola vez por proceso; usar _load_service_account.cache_clear() si rotan.
+    # Un fallo (variable ausente) no queda en caché: se reintenta en la siguiente llamada.
     credentials_json = os.getenv("FIREBASE_CREDENTIALS_JSON")
 
     if credentials_json:
-        return json.loads(credentials_json)
+        return orjson.loads(credentials_json)
 
     raise FirebaseAdminUnavailable(
         "Configura FIREBASE_CREDENTIALS_JSON para inicializar Firebase Admin. (FIREBASE_CREDENTIALS_PATH no está soportado)",
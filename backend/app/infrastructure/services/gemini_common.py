@@ -0,0 +1,141 @@
+from __future__ import annotations
+
+from threading import Lock
+from typing import Any
+import hashlib
+import logging
+import time
+
+import orjson
+
+logger = logging.getLogger(__name__)
+
+try:
+    import google.generativeai as genai
+except ModuleNotFoundError:
+    genai = None
+
+# Caché explícita (CachedContent) del prefijo: solo compensa con catálogos grandes
+CACHED_PREFIX_MIN_CHARS = 16_000
+CACHED_PREFIX_TTL_SECONDS = 3600
+# Tras un fallo al crear el CachedContent se reintenta pronto: suele ser un error transitorio
+CACHED_PREFIX_RETRY_SECONDS = 60
+
+
+def chunk_text(chunk: Any) -> str:
+    """
+    Texto de un fragmento del streaming. `chunk.text` lanza ValueError cuando el fragmento
+    no trae partes de texto (p. ej. el fragmento final o uno bloqueado por seguridad): "".
+    """
+    # Sin strip: en streaming los espacios de borde son parte del texto
+    try:
+        text = chunk.text
+    except (AttributeError, ValueError):
+        return ""
+    return text if isinstance(text, str) else ""
+
+
+class JSONObjectStream:
+    """
+    Escáner incremental: recibe fragmentos de texto y devuelve cada objeto JSON
+    completo que sea elemento directo de un array, sin esperar al cierre del array.
+    """
+
+    __slots__ = ("_buffer", "_pos", "_stack", "_in_string", "_escaped")
+
+    def __init__(self) -> None:
+        self._buffer = ""
+        self._pos = 0
+        self._stack: list[tuple[str, int]] = []  # (apertura, posición)
+        self._in_string = False
+        self._escaped = False
+
+    def feed(self, chunk: str) -> list[dict[str, object]]:
+        self._buffer += chunk
+        buf = self._buffer
+        completed: list[dict[str, object]] = []
+        for i in range(self._pos, len(buf)):
+            ch = buf[i]
+            if self._in_string:
+                if self._escaped:
+                    self._escaped = False
+                elif ch == "\\":
+                    self._escaped = True
+                elif ch == '"':
+                    self._in_string = False
+            elif ch == '"':
+                self._in_string = True
+            elif ch in "[{":
+                self._stack.append((ch, i))
+            elif ch in "]}" and self._stack:
+                opener, start = self._stack.pop()
+                if ch == "}" and opener == "{" and self._stack and self._stack[-1][0] == "[":
+                    try:
+                        item = orjson.loads(buf[start : i + 1])
+                    except orjson.JSONDecodeError:
+                        continue
+                    if isinstance(item, dict):
+                        completed.append(item)
+        self._pos = len(buf)
+        return completed
+
+
+class CachedPrefixModels:
+    """
+    Modelos de Gemini ligados a un CachedContent con el prefijo estable del prompt
+    (instrucciones + catálogo del owner). Cada prefijo se sube una sola vez y se reutiliza
+    hasta que vence; es segura entre hilos.
+    """
+
+    def __init__(self, model_name: str) -> None:
+        self._model_name = model_name
+        self._entries: dict[str, tuple[Any, float]] = {}  # hash prefijo → (modelo, expira)
+        self._key_locks: dict[str, Lock] = {}  # un candado por prefijo: prefijos distintos no se esperan
+        self._lock = Lock()  # protege los dos diccionarios
+
+    def get(self, prefix: str) -> Any:
+        """Modelo con el prefijo ya cacheado en Gemini; None si no aplica o no se pudo crear."""
+        caching = getattr(genai, "caching", None)
+        if caching is None or len(prefix) < CACHED_PREFIX_MIN_CHARS:
+            return None
+
+        key = hashlib.sha256(prefix.encode("utf-8")).hexdigest()
+        hit = self._entries.get(key)
+        if hit is not None and hit[1] > time.monotonic():
+            return hit[0]
+
+        with self._lock:
+            key_lock = self._key_locks.setdefault(key, Lock())
+
+        # Dos hilos con el mismo fallo crearían (y pagarían) dos CachedContent: uno espera al otro.
+        # La llamada de red se hace fuera del candado global para no frenar a otros owners
+        with key_lock:
+            now = time.monotonic()
+            hit = self._entries.get(key)
+            if hit is not None and hit[1] > now:
+                return hit[0]
+
+            model = None
+            expires_at = now + CACHED_PREFIX_RETRY_SECONDS
+            try:
+                cached = caching.CachedContent.create(
+                    model=self._model_name,
+                    contents=[prefix],
+                    ttl=f"{CACHED_PREFIX_TTL_SECONDS}s",
+                )
+                model = genai.GenerativeModel.from_cached_content(cached)
+                # Se deja un margen antes del vencimiento real en Gemini
+                expires_at = now + CACHED_PREFIX_TTL_SECONDS - 60
+                logger.info("✅ Prefijo del prompt cacheado en Gemini (%d caracteres)", len(prefix))
+            except Exception as e:
+                # Sin caché explícita se sigue enviando el prompt completo (la implícita aún aplica)
+                logger.warning("⚠️ No se pudo crear el CachedContent del prefijo: %s", e)
+
+            with self._lock:
+                for stale in [k for k, (_, expires) in self._entries.items() if expires <= now]:
+                    self._entries.pop(stale, None)
+                    stale_lock = self._key_locks.get(stale)
+                    if stale_lock is not None and not stale_lock.locked():
+                        self._key_locks.pop(stale, None)
+                self._entries[key] = (model, expires_at)
+            return model
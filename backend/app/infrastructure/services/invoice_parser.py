@@ -2,43 +2,175 @@ from __future__ import annotations
 
 from datetime import date
 from decimal import Decimal, InvalidOperation
+from functools import lru_cache
+from io import BytesIO
+import re
+import threading
 
 from lxml import etree
 
 from app.domain import InvoiceLine
 
 
+_NAMESPACES = {
+    "cbc": "urn:oasis:names:specification:ubl:schema:xsd:CommonBasicComponents-2",
+    "cac": "urn:oasis:names:specification:ubl:schema:xsd:CommonAggregateComponents-2",
+}
+
+
+@lru_cache(maxsize=None)
+def _text_xpath(path: str) -> etree.XPath:
+    """XPath compilada que devuelve el texto del primer nodo de `path` ("" si no existe)."""
+    return etree.XPath(f"string(({path})[1])", namespaces=_NAMESPACES)
+
+
+@lru_cache(maxsize=None)
+def _union_text_xpath(paths: tuple[str, ...]) -> etree.XPath:
+    """XPath compilada con los nodos de texto de todas las rutas (`A/text() | B/text()`)."""
+    return etree.XPath(" | ".join(f"{path}/text()" for path in paths), namespaces=_NAMESPACES)
+
+
+@lru_cache(maxsize=None)
+def _nodes_xpath(path: str) -> etree.XPath:
+    """XPath compilada que devuelve todos los elementos de `path`."""
+    return etree.XPath(path, namespaces=_NAMESPACES)
+
+
+# Soportar múltiples tipos de línea (InvoiceLine, CreditNoteLine, DebitNoteLine), en orden de preferencia
+_LINE_TAGS = ("cac:InvoiceLine", "cac:CreditNoteLine", "cac:DebitNoteLine")
+# Cantidad puede aparecer como InvoicedQuantity, CreditedQuantity o DebitedQuantity
+_QUANTITY_PATHS = ("cbc:InvoicedQuantity", "cbc:CreditedQuantity", "cbc:DebitedQuantity")
+# Mismos tags de línea como nombres calificados, para filtrar eventos de iterparse
+_QUALIFIED_LINE_TAGS = tuple(
+    "{%s}%s" % (_NAMESPACES[prefix], local) for prefix, local in (tag.split(":") for tag in _LINE_TAGS)
+)
+
+_ZERO = Decimal("0")
+
+# A partir de este tamaño las líneas se leen en streaming y se liberan al procesarlas
+_STREAMING_MIN_BYTES = 1024 * 1024
+
+# Opciones del parser para XML que llega de terceros: sin expandir entidades (billion laughs),
+# sin red y con los límites de tamaño de libxml2 activos. Los nodos de solo espacios entre
+# elementos se descartan: el árbol queda más chico y las XPath recorren menos nodos
+_PARSER_OPTIONS = {
+    "resolve_entities": False,
+    "no_network": True,
+    "huge_tree": False,
+    "remove_blank_text": True,
+}
+_parser_local = threading.local()
+
+
+def _xml_parser() -> etree.XMLParser:
+    """Parser configurado, uno por hilo: los XMLParser de lxml no se comparten entre hilos."""
+    parser = getattr(_parser_local, "parser", None)
+    if parser is None:
+        parser = _parser_local.parser = etree.XMLParser(**_PARSER_OPTIONS)
+    return parser
+
+
+# Raíz AttachedDocument (tras BOM, declaración y comentarios): se detecta sin parsear para
+# extraer la factura embebida en la misma pasada, sin construir el árbol del contenedor
+_ATTACHED_ROOT_RE = re.compile(
+    rb"(?:\xef\xbb\xbf)?\s*(?:<\?xml[^>]*\?>\s*)?(?:<!--.*?-->\s*)*<(?:[A-Za-z_][\w.-]*:)?AttachedDocument[\s/>]",
+    re.S,
+)
+_ROOT_SNIFF_BYTES = 4096
+
+_ATTACHMENT_TAG = "{%s}Attachment" % _NAMESPACES["cac"]
+_EXTERNAL_REFERENCE_TAG = "{%s}ExternalReference" % _NAMESPACES["cac"]
+_DESCRIPTION_TAG = "{%s}Description" % _NAMESPACES["cbc"]
+
+
+class _EmbeddedInvoiceTarget:
+    """
+    Target de lxml para AttachedDocument: no arma el árbol del contenedor y entrega el texto
+    de cada cac:Attachment/cac:ExternalReference/cbc:Description, a medida que llega, a un
+    parser propio. close() devuelve la primera factura embebida con LegalMonetaryTotal.
+    """
+
+    def __init__(self) -> None:
+        self._stack: list[str] = []
+        self._candidate: etree.XMLParser | None = None
+        self._started = False
+        self._invoice: etree._Element | None = None
+
+    def start(self, tag: str, attrib: dict[str, str]) -> None:
+        self._stack.append(tag)
+        if (
+            self._invoice is None
+            and tag == _DESCRIPTION_TAG
+            and self._stack[-3:-1] == [_ATTACHMENT_TAG, _EXTERNAL_REFERENCE_TAG]
+        ):
+            self._candidate = etree.XMLParser(**_PARSER_OPTIONS)
+            self._started = False
+
+    def data(self, text: str) -> None:
+        if self._candidate is None:
+            return
+        if not self._started:
+            # La declaración XML solo se admite al inicio: se omiten los espacios previos
+            text = text.lstrip()
+            if not text:
+                return
+            self._started = True
+        try:
+            self._candidate.feed(text)
+        except etree.XMLSyntaxError:
+            self._candidate = None  # el Description no contiene XML
+
+    def end(self, tag: str) -> None:
+        self._stack.pop()
+        if tag != _DESCRIPTION_TAG or self._candidate is None:
+            return
+        parser, self._candidate = self._candidate, None
+        try:
+            embedded_root = parser.close()
+        except etree.XMLSyntaxError:
+            return
+        # Descarta el ApplicationResponse de la DIAN, que no tiene totales
+        if _nodes_xpath(".//cac:LegalMonetaryTotal/cbc:PayableAmount")(embedded_root):
+            self._invoice = embedded_root
+
+    def close(self) -> etree._Element | None:
+        return self._invoice
+
+
 class UBLInvoiceParser:
-    _namespaces = {
-        "cbc": "urn:oasis:names:specification:ubl:schema:xsd:CommonBasicComponents-2",
-        "cac": "urn:oasis:names:specification:ubl:schema:xsd:CommonAggregateComponents-2",
-    }
+    # Las rutas se compilan una sola vez (ver _text_xpath/_nodes_xpath) y se reutilizan
+    # en cada factura, en lugar de reinterpretar la ruta en cada find()
+    _namespaces = _NAMESPACES
 
     def parse(self, xml_bytes: bytes) -> dict[str, object]:
         """Convierte un XML UBL en los campos clave utilizados por el dominio."""
 
+        streamed_lines: list[InvoiceLine] | None = None
         try:
-            root = etree.fromstring(xml_bytes)
+            if _ATTACHED_ROOT_RE.match(xml_bytes, 0, _ROOT_SNIFF_BYTES):
+                target_parser = etree.XMLParser(target=_EmbeddedInvoiceTarget(), **_PARSER_OPTIONS)
+                root = etree.fromstring(xml_bytes, target_parser)
+                if root is None:
+                    raise ValueError("No se encontró factura embebida en el AttachedDocument")
+            elif len(xml_bytes) >= _STREAMING_MIN_BYTES:
+                root, streamed_lines = self._stream_lines(xml_bytes)
+            else:
+                root = etree.fromstring(xml_bytes, _xml_parser())
         except etree.XMLSyntaxError as exc:
             raise ValueError("No fue posible leer el XML proporcionado") from exc
 
-        # Detectar si es un AttachedDocument (contiene una factura embebida en CDATA)
-        # Extraer el nombre local del tag (sin namespace)
+        # Tipo de documento por el nombre local del root (sin namespace). Un AttachedDocument
+        # que no se detectó antes de parsear (p.ej. prólogo muy largo) llega aquí como árbol
+        # completo y se extrae su factura embebida
         doc_type = root.tag.split("}")[-1] if "}" in root.tag else root.tag
         if doc_type == "AttachedDocument":
             root = self._extract_invoice_from_cdata(root)
             if root is None:
                 raise ValueError("No se encontró factura embebida en el AttachedDocument")
+            streamed_lines = None
 
-        raw_xml = xml_bytes.decode("utf-8", errors="ignore")
         get_text = lambda path: self._read_text(root, path)
 
-        # Detectar el tipo de documento UBL por el nombre local del root
-        # Puede ser Invoice, CreditNote o DebitNote (entre otros). Esto nos
-        # permite adaptar la lectura de líneas y cantidades.
-        # Extraer el nombre local del tag (sin namespace)
-        doc_type = root.tag.split("}")[-1] if "}" in root.tag else root.tag
-
         external_id = get_text("cbc:ID")
         issue_date_text = get_text("cbc:IssueDate")
         if not issue_date_text:
@@ -49,63 +181,38 @@ class UBLInvoiceParser:
         except ValueError as exc:
             raise ValueError("La fecha de emisión no tiene el formato esperado") from exc
 
-        supplier_name = self._first_non_empty(
-            get_text("cac:AccountingSupplierParty/cac:Party/cac:PartyName/cbc:Name"),
-            get_text("cac:AccountingSupplierParty/cac:Party/cac:PartyLegalEntity/cbc:RegistrationName"),
+        supplier_name = self._read_first(
+            root,
+            "cac:AccountingSupplierParty/cac:Party/cac:PartyName/cbc:Name",
+            "cac:AccountingSupplierParty/cac:Party/cac:PartyLegalEntity/cbc:RegistrationName",
         )
-        supplier_tax_id = self._first_non_empty(
-            get_text("cac:AccountingSupplierParty/cac:Party/cac:PartyTaxScheme/cbc:CompanyID"),
-            get_text("cac:AccountingSupplierParty/cac:Party/cac:PartyLegalEntity/cbc:CompanyID"),
+        supplier_tax_id = self._read_first(
+            root,
+            "cac:AccountingSupplierParty/cac:Party/cac:PartyTaxScheme/cbc:CompanyID",
+            "cac:AccountingSupplierParty/cac:Party/cac:PartyLegalEntity/cbc:CompanyID",
         )
-        customer_name = self._first_non_empty(
-            get_text("cac:AccountingCustomerParty/cac:Party/cac:PartyName/cbc:Name"),
-            get_text("cac:AccountingCustomerParty/cac:Party/cac:PartyLegalEntity/cbc:RegistrationName"),
+        customer_name = self._read_first(
+            root,
+            "cac:AccountingCustomerParty/cac:Party/cac:PartyName/cbc:Name",
+            "cac:AccountingCustomerParty/cac:Party/cac:PartyLegalEntity/cbc:RegistrationName",
         )
-        customer_tax_id = self._first_non_empty(
-            get_text("cac:AccountingCustomerParty/cac:Party/cac:PartyTaxScheme/cbc:CompanyID"),
-            get_text("cac:AccountingCustomerParty/cac:Party/cac:PartyLegalEntity/cbc:CompanyID"),
+        customer_tax_id = self._read_first(
+            root,
+            "cac:AccountingCustomerParty/cac:Party/cac:PartyTaxScheme/cbc:CompanyID",
+            "cac:AccountingCustomerParty/cac:Party/cac:PartyLegalEntity/cbc:CompanyID",
         )
 
-        totals_element = root.find("cac:LegalMonetaryTotal/cbc:PayableAmount", namespaces=self._namespaces)
+        totals = _nodes_xpath("cac:LegalMonetaryTotal/cbc:PayableAmount")(root)
+        totals_element = totals[0] if totals else None
         if totals_element is None or totals_element.text is None:
             raise ValueError("No se encontró el total de la factura")
 
         currency = totals_element.get("currencyID") or get_text("cbc:DocumentCurrencyCode")
         total_amount = self._to_decimal(totals_element.text)
 
-        tax_element = root.find("cac:TaxTotal/cbc:TaxAmount", namespaces=self._namespaces)
-        tax_amount = self._to_decimal(tax_element.text) if tax_element is not None and tax_element.text else Decimal("0")
+        tax_amount = self._to_decimal(get_text("cac:TaxTotal/cbc:TaxAmount"))
 
-        # Soportar múltiples tipos de línea (InvoiceLine, CreditNoteLine, DebitNoteLine)
-        line_tags = ["cac:InvoiceLine", "cac:CreditNoteLine", "cac:DebitNoteLine"]
-        # Cantidad puede aparecer como InvoicedQuantity, CreditedQuantity o DebitedQuantity
-        quantity_paths = ["cbc:InvoicedQuantity", "cbc:CreditedQuantity", "cbc:DebitedQuantity"]
-
-        lines: list[InvoiceLine] = []
-        for tag in line_tags:
-            for line in root.findall(tag, namespaces=self._namespaces):
-                line_id = self._read_text(line, "cbc:ID") or str(len(lines) + 1)
-                description = self._first_non_empty(
-                    self._read_text(line, "cac:Item/cbc:Description"),
-                    self._read_text(line, "cac:Item/cac:ItemIdentification/cbc:ID"),
-                )
-                # Leer la primera ruta de cantidad disponible
-                qty_text = self._read_first(line, *quantity_paths)
-                quantity = self._to_decimal(qty_text)
-                unit_price = self._to_decimal(self._read_text(line, "cac:Price/cbc:PriceAmount"))
-                line_total = self._to_decimal(self._read_text(line, "cbc:LineExtensionAmount"))
-                lines.append(
-                    InvoiceLine(
-                        line_id=line_id,
-                        description=description,
-                        quantity=quantity,
-                        unit_price=unit_price,
-                        line_extension_amount=line_total,
-                    )
-                )
-            # si ya encontramos líneas, no intentamos con los tags siguientes
-            if lines:
-                break
+        lines = streamed_lines if streamed_lines is not None else self._read_lines(root)
 
         if not lines:
             raise ValueError("No se encontraron líneas de producto en la factura")
@@ -119,19 +226,78 @@ class UBLInvoiceParser:
             "total_amount": total_amount,
             "tax_amount": tax_amount,
             "lines": lines,
-            "raw_xml": raw_xml,
+            # Los bytes originales, sin copiar: quien necesite texto lo decodifica después del parseo
+            "raw_xml": xml_bytes,
         }
 
+    def _read_lines(self, root: etree._Element) -> list[InvoiceLine]:
+        lines: list[InvoiceLine] = []
+        for tag in _LINE_TAGS:
+            for line in _nodes_xpath(tag)(root):
+                lines.append(self._read_line(line, len(lines) + 1))
+            # si ya encontramos líneas, no intentamos con los tags siguientes
+            if lines:
+                break
+        return lines
+
+    def _stream_lines(self, xml_bytes: bytes) -> tuple[etree._Element, list[InvoiceLine]]:
+        """
+        Lee las líneas con iterparse y vacía cada una al procesarla, de modo que en memoria
+        solo queda el encabezado del documento. Devuelve la raíz (sin líneas) y las líneas.
+        """
+        found: dict[str, list[InvoiceLine]] = {tag: [] for tag in _QUALIFIED_LINE_TAGS}
+        root: etree._Element | None = None
+        for _, element in etree.iterparse(
+            BytesIO(xml_bytes), events=("end",), tag=_QUALIFIED_LINE_TAGS, **_PARSER_OPTIONS
+        ):
+            parent = element.getparent()
+            if parent is None or parent.getparent() is not None:
+                continue  # solo líneas hijas directas de la raíz, igual que _read_lines
+            root = parent
+            bucket = found[element.tag]
+            bucket.append(self._read_line(element, len(bucket) + 1))
+            element.clear(keep_tail=True)
+            # Las líneas ya leídas quedan vacías; se sueltan para no acumular nodos
+            previous = element.getprevious()
+            while previous is not None and previous.tag in found:
+                parent.remove(previous)
+                previous = element.getprevious()
+
+        if root is None:
+            # Sin líneas (o AttachedDocument): se trabaja con el árbol completo
+            return etree.fromstring(xml_bytes, _xml_parser()), []
+        for tag in _QUALIFIED_LINE_TAGS:
+            if found[tag]:
+                return root, found[tag]
+        return root, []
+
+    def _read_line(self, line: etree._Element, position: int) -> InvoiceLine:
+        line_id = self._read_text(line, "cbc:ID") or str(position)
+        description = self._first_non_empty(
+            self._read_text(line, "cac:Item/cbc:Description"),
+            self._read_text(line, "cac:Item/cac:ItemIdentification/cbc:ID"),
+        )
+        # Leer la primera ruta de cantidad disponible
+        qty_text = self._read_first(line, *_QUANTITY_PATHS)
+        return InvoiceLine(
+            line_id=line_id,
+            description=description,
+            quantity=self._to_decimal(qty_text),
+            unit_price=self._to_decimal(self._read_text(line, "cac:Price/cbc:PriceAmount")),
+            line_extension_amount=self._to_decimal(self._read_text(line, "cbc:LineExtensionAmount")),
+        )
+
     def _read_text(self, element: etree._Element, path: str) -> str:
-        node = element.find(path, namespaces=self._namespaces)
-        if node is not None and node.text is not None:
-            return node.text.strip()
-        return ""
+        return _text_xpath(path)(element).strip()
 
     def _read_first(self, element: etree._Element, *paths: str) -> str:
-        """Devuelve el texto de la primera ruta que no sea vacía entre las dadas."""
-        for path in paths:
-            value = self._read_text(element, path)
+        """
+        Devuelve el primer texto no vacío entre las rutas dadas, con una sola evaluación XPath.
+        La unión sale en orden de documento: las rutas deben listarse en el orden del esquema
+        UBL (p. ej. PartyName antes que PartyLegalEntity), que coincide con la prioridad.
+        """
+        for text in _union_text_xpath(paths)(element):
+            value = text.strip()
             if value:
                 return value
         return ""
@@ -143,8 +309,11 @@ class UBLInvoiceParser:
         return ""
 
     def _to_decimal(self, value: str) -> Decimal:
+        if not value:
+            return _ZERO
         try:
-            return Decimal(value.strip()) if value else Decimal("0")
+            # Decimal ya ignora espacios alrededor: no hace falta strip() previo
+            return Decimal(value)
         except (InvalidOperation, AttributeError) as exc:
             raise ValueError("No fue posible interpretar un valor numérico") from exc
 
@@ -178,10 +347,14 @@ class UBLInvoiceParser:
         
         for path in paths:
             # findall porque puede haber múltiples elementos Description
-            cdata_elements = root.findall(path, namespaces=self._namespaces)
+            cdata_elements = _nodes_xpath(path)(root)
             
             for cdata_element in cdata_elements:
                 if cdata_element is not None and cdata_element.text:
+                    # Sin el tag de totales la XPath de abajo nunca coincidiría: se descarta
+                    # (p.ej. el ApplicationResponse de la DIAN) sin construir su árbol
+                    if "LegalMonetaryTotal" not in cdata_element.text:
+                        continue
                     inner_xml = cdata_element.text.strip()
                     
                     # Limpiar el XML embebido (puede tener declaración XML)
@@ -191,20 +364,20 @@ class UBLInvoiceParser:
                     
                     try:
                         # Parsear el XML embebido
-                        embedded_root = etree.fromstring(inner_xml.encode("utf-8"))
+                        embedded_root = etree.fromstring(inner_xml.encode("utf-8"), _xml_parser())
                         
                         # Verificar que sea una factura válida (debe tener LegalMonetaryTotal)
                         # Esto descarta ApplicationResponse que no tiene totales
-                        totals = embedded_root.find(".//cac:LegalMonetaryTotal/cbc:PayableAmount", namespaces=self._namespaces)
-                        if totals is not None:
+                        totals = _nodes_xpath(".//cac:LegalMonetaryTotal/cbc:PayableAmount")(embedded_root)
+                        if totals:
                             return embedded_root
                             
                     except etree.XMLSyntaxError:
                         # Intentar con el texto original sin limpiar
                         try:
-                            embedded_root = etree.fromstring(cdata_element.text.encode("utf-8"))
-                            totals = embedded_root.find(".//cac:LegalMonetaryTotal/cbc:PayableAmount", namespaces=self._namespaces)
-                            if totals is not None:
+                            embedded_root = etree.fromstring(cdata_element.text.encode("utf-8"), _xml_parser())
+                            totals = _nodes_xpath(".//cac:LegalMonetaryTotal/cbc:PayableAmount")(embedded_root)
+                            if totals:
                                 return embedded_root
                         except etree.XMLSyntaxError:
                             continue
@@ -1,26 +1,30 @@
-from passlib.context import CryptContext
-from passlib.exc import UnknownHashError
+import hmac
+
+import bcrypt
 
 
 class BcryptPasswordHasher:
-    def __init__(self) -> None:
-        self._context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+    def __init__(self, rounds: int = 12) -> None:
+        # Mismo costo por defecto que usaba passlib, así los hashes existentes siguen siendo válidos
+        self.rounds = rounds
 
     def hash(self, plain_password: str) -> str:
         # bcrypt has a 72-byte limit. Truncate if needed.
         # For production, consider using PBKDF2 or Argon2 for longer passwords
-        truncated_password = plain_password[:72]
-        return self._context.hash(truncated_password)
+        password_bytes = plain_password.encode("utf-8")[:72]
+        return bcrypt.hashpw(password_bytes, bcrypt.gensalt(rounds=self.rounds)).decode("ascii")
 
     def verify(self, plain_password: str, hashed_password: str) -> bool:
+        # Una sola conversión a bytes, reutilizada por bcrypt y por el fallback
+        password_bytes = plain_password.encode("utf-8")
+        hashed_bytes = hashed_password.encode("utf-8")
         try:
             # bcrypt has a 72-byte limit. Truncate if needed.
-            truncated_password = plain_password[:72]
-            return self._context.verify(truncated_password, hashed_password)
-        except UnknownHashError:
+            return bcrypt.checkpw(password_bytes[:72], hashed_bytes)
+        except ValueError:
             # Si el hash no es reconocido (e.g., contraseña en texto plano o hash antiguo)
-            # comparar directamente como fallback (SOLO para migración de datos legacy)
-            return plain_password == hashed_password
+            # comparar en tiempo constante como fallback (SOLO para migración de datos legacy)
+            return hmac.compare_digest(password_bytes, hashed_bytes)
 
 
 __all__ = ["BcryptPasswordHasher"]
@@ -3,117 +3,32 @@ Servicio para generar catálogo completo de cuentas PUC usando IA.
 """
 from __future__ import annotations
 
-import json
+import hashlib
 import logging
-from typing import Any
+import re
+from typing import Any, Iterator
+
+import orjson
+
+from .gemini_common import JSONObjectStream, chunk_text
+from .llm_cache import InMemoryLLMCache
 
 logger = logging.getLogger(__name__)
 
+# Fence markdown (```json ... ```) al inicio o al final de la respuesta
+_FENCE_RE = re.compile(r"^\s*```(?:json)?\s*|\s*```\s*$")
+
 try:
     import google.generativeai as genai
 except ModuleNotFoundError:
     genai = None
 
+# Modelo y configuración fijos: cualquier variación rompería la caché implícita de prefijos
+_CATALOG_MODEL = "gemini-2.5-flash-live"
+_CATALOG_GENERATION_CONFIG = {"temperature": 0.1, "max_output_tokens": 8192}
 
-class PUCCatalogGenerator:
-    """
-    Genera un catálogo completo de cuentas PUC usando Gemini AI.
-    Toma los códigos seleccionados y genera toda la estructura jerárquica.
-    """
-    
-    def __init__(self, api_key: str):
-        self.api_key = api_key
-        self._initialized = False
-        
-        if genai and api_key:
-            try:
-                genai.configure(api_key=api_key)
-                self._initialized = True
-                logger.info("✅ PUCCatalogGenerator inicializado con Gemini")
-            except Exception as e:
-                logger.error(f"❌ Error configurando Gemini: {e}")
-    
-    def generate_catalog(
-        self,
-        selected_codes: list[str],
-        suggestions_context: list[dict[str, Any]],
-    ) -> list[dict[str, Any]]:
-        """
-        Genera el catálogo completo de cuentas PUC incluyendo jerarquía.
-        
-        Args:
-            selected_codes: Lista de códigos PUC seleccionados (8 dígitos)
-            suggestions_context: Contexto de las sugerencias (rationale, invoice info)
-        
-        Returns:
-            Lista de cuentas con estructura completa para Excel
-        """
-        if not self._initialized or not genai:
-            logger.warning("Gemini no disponible, retornando estructura básica")
-            return self._generate_basic_catalog(selected_codes)
-        
-        try:
-            prompt = self._build_catalog_prompt(selected_codes, suggestions_context)
-            
-            logger.info(f"🤖 Generando catálogo PUC con Gemini para {len(selected_codes)} códigos")
-            model = genai.GenerativeModel("gemini-2.5-flash-live")
-            response = model.generate_content(
-                prompt,
-                generation_config=genai.types.GenerationConfig(
-                    temperature=0.1,
-                    max_output_tokens=8192,
-                ),
-            )
-            
-            text = response.text.strip()
-            
-            # Limpiar markdown
-            if text.startswith("```json"):
-                text = text[7:]
-            if text.startswith("```"):
-                text = text[3:]
-            if text.endswith("```"):
-                text = text[:-3]
-            text = text.strip()
-            
-            catalog = json.loads(text)
-            
-            if isinstance(catalog, dict) and "cuentas" in catalog:
-                result = catalog["cuentas"]
-            elif isinstance(catalog, list):
-                result = catalog
-            else:
-                logger.warning("Formato inesperado de respuesta, usando fallback")
-                return self._generate_basic_catalog(selected_codes)
-            
-            logger.info(f"✅ Catálogo generado: {len(result)} cuentas")
-            return result
-            
-        except Exception as e:
-            logger.error(f"❌ Error generando catálogo con IA: {e}")
-            return self._generate_basic_catalog(selected_codes)
-    
-    def _build_catalog_prompt(
-        self,
-        selected_codes: list[str],
-        suggestions_context: list[dict[str, Any]],
-    ) -> str:
-        """
-        Construye el prompt para que Gemini genere el catálogo completo.
-        """
-        context_lines = []
-        for ctx in suggestions_context[:10]:  # Limitar a 10 para no exceder tokens
-            context_lines.append(
-                f"- {ctx.get('code', 'N/A')}: {ctx.get('rationale', 'N/A')}"
-            )
-        
-        prompt = f"""Eres un experto contador colombiano. Genera un catálogo completo de cuentas PUC siguiendo el Plan Único de Cuentas colombiano.
-
-CÓDIGOS SELECCIONADOS:
-{', '.join(selected_codes)}
-
-CONTEXTO DE USO:
-{chr(10).join(context_lines)}
+# Parte estática del prompt (rol, instrucciones y esquema) al inicio; los datos van al final
+_CATALOG_PROMPT_PREFIX = """Eres un experto contador colombiano. Genera un catálogo completo de cuentas PUC siguiendo el Plan Único de Cuentas colombiano.
 
 INSTRUCCIONES:
 1. Para cada código, genera la estructura JERÁRQUICA completa (grupo, cuenta, subcuenta, auxiliar)
@@ -123,7 +38,7 @@ INSTRUCCIONES:
 
 RESPONDE SOLO CON JSON EN ESTE FORMATO:
 [
-  {{
+  {
     "codigo": "1",
     "nombre": "ACTIVO",
     "categoria": "Activos",
@@ -133,8 +48,8 @@ RESPONDE SOLO CON JSON EN ESTE FORMATO:
     "diferencia_fiscal": "No",
     "activo": "Sí",
     "nivel_agrupacion": "Clase"
-  }},
-  {{
+  },
+  {
     "codigo": "11",
     "nombre": "DISPONIBLE",
     "categoria": "Activos",
@@ -144,8 +59,8 @@ RESPONDE SOLO CON JSON EN ESTE FORMATO:
     "diferencia_fiscal": "No",
     "activo": "Sí",
     "nivel_agrupacion": "Grupo"
-  }},
-  {{
+  },
+  {
     "codigo": "1105",
     "nombre": "CAJA",
     "categoria": "Caja - Bancos",
@@ -155,8 +70,8 @@ RESPONDE SOLO CON JSON EN ESTE FORMATO:
     "diferencia_fiscal": "No",
     "activo": "Sí",
     "nivel_agrupacion": "Cuenta"
-  }},
-  {{
+  },
+  {
     "codigo": "110505",
     "nombre": "Caja general",
     "categoria": "Caja - Bancos",
@@ -166,8 +81,8 @@ RESPONDE SOLO CON JSON EN ESTE FORMATO:
     "diferencia_fiscal": "No",
     "activo": "Sí",
     "nivel_agrupacion": "Subcuenta"
-  }},
-  {{
+  },
+  {
     "codigo": "11050501",
     "nombre": "Efectivo caja principal",
     "categoria": "Caja - Bancos",
@@ -177,58 +92,190 @@ RESPONDE SOLO CON JSON EN ESTE FORMATO:
     "diferencia_fiscal": "No",
     "activo": "Sí",
     "nivel_agrupacion": "Transaccional"
-  }}
+  }
 ]
 
 Genera la jerarquía COMPLETA para TODOS los códigos seleccionados."""
+
+_BASIC_META_DEFAULT = ("Otros", "Otros", "No")
+
+
+class PUCCatalogGenerator:
+    """
+    Genera un catálogo completo de cuentas PUC usando Gemini AI.
+    Toma los códigos seleccionados y genera toda la estructura jerárquica.
+    """
+
+    # (categoría, clase, activo) según el primer dígito del código
+    _BASIC_META = {
+        "1": ("Activos", "Activo Corriente", "Sí"),
+        "2": ("Pasivos", "Pasivo Corriente", "No"),
+        "3": ("Patrimonio", "Otros", "No"),
+        "4": ("Ingresos", "Ingresos Operacionales", "No"),
+        "5": ("Gastos", "Gastos Operacionales", "No"),
+        "6": ("Costos", "Costos", "No"),
+    }
+    
+    def __init__(self, api_key: str):
+        self.api_key = api_key
+        self._initialized = False
+        self._model: Any = None
+        # Los usuarios suelen elegir los mismos subconjuntos del PUC: se reutiliza la respuesta
+        self._cache = InMemoryLLMCache(ttl_seconds=3600, max_entries=512)
         
-        return prompt
+        if genai and api_key:
+            try:
+                genai.configure(api_key=api_key)
+                # Un único modelo reutilizado entre llamadas (mantiene vivo el canal)
+                self._model = genai.GenerativeModel(_CATALOG_MODEL)
+                self._initialized = True
+                logger.info("✅ PUCCatalogGenerator inicializado con Gemini")
+            except Exception as e:
+                logger.error(f"❌ Error configurando Gemini: {e}")
+    
+    def generate_catalog(
+        self,
+        selected_codes: list[str],
+        suggestions_context: list[dict[str, Any]],
+    ) -> list[dict[str, Any]]:
+        """
+        Genera el catálogo completo de cuentas PUC incluyendo jerarquía.
+        
+        Args:
+            selected_codes: Lista de códigos PUC seleccionados (8 dígitos)
+            suggestions_context: Contexto de las sugerencias (rationale, invoice info)
+        
+        Returns:
+            Lista de cuentas con estructura completa para Excel
+        """
+        return list(self.iter_catalog(selected_codes, suggestions_context))
+
+    def iter_catalog(
+        self,
+        selected_codes: list[str],
+        suggestions_context: list[dict[str, Any]],
+    ) -> Iterator[dict[str, Any]]:
+        """
+        Igual que generate_catalog, pero entrega cada cuenta en cuanto Gemini
+        termina de escribirla (respuesta en streaming).
+        """
+        if not self._initialized or not genai or self._model is None:
+            logger.warning("Gemini no disponible, retornando estructura básica")
+            yield from self._generate_basic_catalog(selected_codes)
+            return
+        
+        cache_key = self._cache_key(selected_codes, suggestions_context)
+        cached = self._cache.get(cache_key)
+        if cached is not None:
+            logger.info("📋 Catálogo PUC servido desde caché (%d cuentas)", len(cached))
+            yield from (dict(account) for account in cached)
+            return
+
+        generated: list[dict[str, Any]] = []
+        received: list[str] = []
+        failed = False
+        try:
+            prompt = self._build_catalog_prompt(selected_codes, suggestions_context)
+            
+            logger.info(f"🤖 Generando catálogo PUC con Gemini para {len(selected_codes)} códigos")
+            stream = self._model.generate_content(prompt, generation_config=_CATALOG_GENERATION_CONFIG, stream=True)
+            scanner = JSONObjectStream()
+            for chunk in stream:
+                text = chunk_text(chunk)
+                received.append(text)
+                for account in scanner.feed(text):
+                    generated.append(account)
+                    yield account
+            
+        except Exception as e:
+            logger.error(f"❌ Error generando catálogo con IA: {e}")
+            failed = True
+
+        if not generated and received and not failed:
+            # Sin objetos reconocibles durante el streaming: parseo del texto completo
+            result = self._parse_catalog_text("".join(received))
+            if result is None:
+                logger.warning("Formato inesperado de respuesta, usando fallback")
+            else:
+                generated = result
+                yield from generated
+
+        if failed or not generated:
+            # Completar con la estructura básica los códigos que no alcanzaron a llegar
+            emitted = {str(account.get("codigo", "")) for account in generated}
+            yield from self._generate_basic_catalog([code for code in selected_codes if code not in emitted])
+            return
+
+        logger.info(f"✅ Catálogo generado: {len(generated)} cuentas")
+        self._cache.set(cache_key, [dict(account) for account in generated])
+
+    @staticmethod
+    def _parse_catalog_text(text: str) -> list[dict[str, Any]] | None:
+        # Limpiar markdown en una sola pasada
+        text = _FENCE_RE.sub("", text).strip()
+        
+        try:
+            catalog = orjson.loads(text.encode("utf-8"))
+        except ValueError:
+            return None
+        
+        if isinstance(catalog, dict) and "cuentas" in catalog:
+            return catalog["cuentas"]
+        if isinstance(catalog, list):
+            return catalog
+        return None
+    
+    @staticmethod
+    def _cache_key(
+        selected_codes: list[str],
+        suggestions_context: list[dict[str, Any]],
+    ) -> str:
+        """
+        Firma del catálogo: códigos ordenados + resumen del contexto que llega al prompt.
+        """
+        context_digest = [
+            [str(ctx.get("code", "")), str(ctx.get("rationale", ""))[:64]]
+            for ctx in suggestions_context[:10]
+        ]
+        raw = "|".join(sorted(selected_codes)).encode("utf-8") + b"::" + orjson.dumps(context_digest)
+        return hashlib.blake2b(raw, digest_size=16).hexdigest()
+
+    def _build_catalog_prompt(
+        self,
+        selected_codes: list[str],
+        suggestions_context: list[dict[str, Any]],
+    ) -> str:
+        """
+        Construye el prompt para que Gemini genere el catálogo completo.
+        """
+        context_lines = sorted(
+            f"- {ctx.get('code', 'N/A')}: {str(ctx.get('rationale', 'N/A')).strip()}"
+            for ctx in suggestions_context[:10]  # Limitar a 10 para no exceder tokens
+        )
+
+        return (
+            f"{_CATALOG_PROMPT_PREFIX}\n\n"
+            f"CÓDIGOS SELECCIONADOS:\n{', '.join(sorted(selected_codes))}\n\n"
+            f"CONTEXTO DE USO:\n{chr(10).join(context_lines)}"
+        )
     
     def _generate_basic_catalog(self, selected_codes: list[str]) -> list[dict[str, Any]]:
         """
         Genera un catálogo básico sin IA (fallback).
         """
+        meta = self._BASIC_META
         catalog = []
         for code in selected_codes:
+            categoria, clase, activo = meta.get(code[:1], _BASIC_META_DEFAULT)
             catalog.append({
                 "codigo": code,
                 "nombre": f"Cuenta {code}",
-                "categoria": self._get_basic_category(code),
-                "clase": self._get_basic_class(code),
+                "categoria": categoria,
+                "clase": clase,
                 "relacion_con": "Formas de pago",
                 "maneja_vencimientos": "No maneja vencimiento",
                 "diferencia_fiscal": "No",
-                "activo": "Sí" if code.startswith("1") else "No",
+                "activo": activo,
                 "nivel_agrupacion": "Transaccional",
             })
         return catalog
-    
-    def _get_basic_category(self, code: str) -> str:
-        """Categoría básica según primer dígito"""
-        if code.startswith("1"):
-            return "Activos"
-        elif code.startswith("2"):
-            return "Pasivos"
-        elif code.startswith("3"):
-            return "Patrimonio"
-        elif code.startswith("4"):
-            return "Ingresos"
-        elif code.startswith("5"):
-            return "Gastos"
-        elif code.startswith("6"):
-            return "Costos"
-        return "Otros"
-    
-    def _get_basic_class(self, code: str) -> str:
-        """Clase básica según código"""
-        if code.startswith("1"):
-            return "Activo Corriente"
-        elif code.startswith("2"):
-            return "Pasivo Corriente"
-        elif code.startswith("4"):
-            return "Ingresos Operacionales"
-        elif code.startswith("5"):
-            return "Gastos Operacionales"
-        elif code.startswith("6"):
-            return "Costos"
-        return "Otros"
@@ -3,8 +3,14 @@ Servicio para procesar archivos XLSX de PUC y convertirlos a entidades de domini
 """
 from __future__ import annotations
 
+import asyncio
 import logging
-from typing import BinaryIO
+import multiprocessing
+import unicodedata
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from threading import Lock
+from typing import Any, BinaryIO, Iterable, Sequence, Union
 
 from app.domain.puc import PUCAccount
 
@@ -17,6 +23,59 @@ except ModuleNotFoundError:
     openpyxl = None
     xlrd = None
 
+try:  # Lector en Rust: mucho más rápido que openpyxl y sin objetos por celda
+    from python_calamine import CalamineWorkbook
+except ModuleNotFoundError:
+    CalamineWorkbook = None
+
+# Archivos grandes ya volcados a disco se parsean en otro proceso: el parseo es CPU puro
+# y el GIL no se libera. Solo rutas: unos bytes grandes se copiarían (pickle) al hijo
+_PROCESS_POOL_MIN_BYTES = 5 * 1024 * 1024
+_process_pool: ProcessPoolExecutor | None = None
+_process_pool_lock = Lock()
+
+# Contenido en memoria o ruta a un archivo ya volcado a disco (subidas grandes)
+ExcelSource = Union[bytes, Path]
+
+_XLSX_MAGICS = (b'PK\x03\x04', b'PK\x05\x06')
+_XLS_MAGIC = b'\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1'
+
+
+def _read_magic(source: ExcelSource) -> bytes:
+    """Primeros bytes del archivo, sin leerlo completo si está en disco."""
+    if isinstance(source, Path):
+        with source.open("rb") as fp:
+            return fp.read(8)
+    return source[:8]
+
+
+def _calamine_value(value: Any) -> Any:
+    """Valores de calamine como los entrega openpyxl: None si está vacía, enteros sin ".0"."""
+    if value == "":
+        return None
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    return value
+
+
+def _source_size(source: ExcelSource) -> int:
+    return source.stat().st_size if isinstance(source, Path) else len(source)
+
+
+def _norm(value: object) -> str:
+    """Encabezado normalizado: sin tildes, sin espacios de borde y en minúsculas."""
+    return unicodedata.normalize("NFKD", str(value)).encode("ascii", "ignore").decode().strip().lower()
+
+
+def _get_process_pool() -> ProcessPoolExecutor:
+    global _process_pool
+    with _process_pool_lock:
+        if _process_pool is None:
+            # spawn y no fork: el worker de uvicorn ya tiene hilos de gRPC (Firestore) vivos,
+            # y hacer fork con esos hilos puede dejar al hijo bloqueado
+            _process_pool = ProcessPoolExecutor(max_workers=2, mp_context=multiprocessing.get_context("spawn"))
+        return _process_pool
+
 
 class PUCExcelParserService:
     """
@@ -44,17 +103,33 @@ class PUCExcelParserService:
         "nivel agrupación": "nivel_agrupacion",
         "nivel agrupacion": "nivel_agrupacion",
     }
+    # Claves normalizadas una sola vez (los encabezados llegan ya normalizados con _norm)
+    _NORM_COLUMN_MAPPING = {_norm(k): v for k, v in COLUMN_MAPPING.items()}
+    # Código de fila que en realidad es un encabezado repetido
+    _CODE_HEADER_TOKENS = frozenset({"codigo", "código"})
+    # Orden fijo de campos para el parseo por fila con índices precalculados
+    _ROW_FIELDS = (
+        "codigo",
+        "nombre",
+        "categoria",
+        "clase",
+        "relacion_con",
+        "maneja_vencimientos",
+        "diferencia_fiscal",
+        "activo",
+        "nivel_agrupacion",
+    )
     
     def __init__(self):
         if openpyxl is None:
             raise RuntimeError("openpyxl no está instalado. Ejecuta: pip install openpyxl xlrd")
     
-    def parse_excel(self, file_content: bytes, owner_id: str, filename: str = "") -> list[PUCAccount]:
+    def parse_excel(self, file_content: ExcelSource, owner_id: str, filename: str = "") -> list[PUCAccount]:
         """
         Detecta automáticamente el tipo de archivo Excel y lo parsea.
         
         Args:
-            file_content: Contenido del archivo en bytes
+            file_content: Contenido del archivo en bytes, o ruta al archivo en disco
             owner_id: ID del propietario/empresa
             filename: Nombre del archivo (para detectar extensión)
             
@@ -62,11 +137,12 @@ class PUCExcelParserService:
             Lista de entidades PUCAccount parseadas
         """
         # Detectar tipo de archivo por magic bytes
-        if file_content.startswith(b'PK\x03\x04') or file_content.startswith(b'PK\x05\x06'):
+        magic = _read_magic(file_content)
+        if magic.startswith(_XLSX_MAGICS):
             # Archivo ZIP (Excel .xlsx)
             logger.info("📊 Detectado formato .xlsx")
             return self.parse_xlsx(file_content, owner_id)
-        elif file_content.startswith(b'\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1'):
+        elif magic.startswith(_XLS_MAGIC):
             # Archivo OLE2 (Excel .xls antiguo)
             logger.info("📊 Detectado formato .xls (Excel antiguo)")
             return self.parse_xls(file_content, owner_id)
@@ -84,8 +160,25 @@ class PUCExcelParserService:
                     "Por favor, asegúrate de que sea un archivo Excel válido (.xlsx o .xls)"
                 )
     
+    async def parse_excel_async(
+        self,
+        file_content: ExcelSource,
+        owner_id: str,
+        filename: str = "",
+    ) -> list[PUCAccount]:
+        """
+        Variante asíncrona de parse_excel: el parseo corre fuera del event loop,
+        en un hilo o, para archivos grandes en disco, en un proceso aparte (solo
+        viaja la ruta, no el contenido). Los bytes en memoria siempre van a un hilo.
+        """
+        if not isinstance(file_content, Path) or _source_size(file_content) < _PROCESS_POOL_MIN_BYTES:
+            return await asyncio.to_thread(self.parse_excel, file_content, owner_id, filename)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            _get_process_pool(), self.parse_excel, file_content, owner_id, filename
+        )
     
-    def parse_xls(self, file_content: bytes, owner_id: str) -> list[PUCAccount]:
+    def parse_xls(self, file_content: ExcelSource, owner_id: str) -> list[PUCAccount]:
         """
         Lee un archivo .xls (Excel antiguo) usando xlrd.
         """
@@ -93,59 +186,69 @@ class PUCExcelParserService:
             raise ValueError("Soporte para archivos .xls no disponible. Instala: pip install xlrd")
         
         try:
-            from io import BytesIO
-            workbook = xlrd.open_workbook(file_contents=file_content)
-            sheet = workbook.sheet_by_index(0)
-            
-            if sheet.nrows == 0:
-                raise ValueError("El archivo Excel está vacío")
-            
-            # Buscar la fila de encabezados en las primeras 20 filas
-            header_row_idx = None
-            headers = []
-            
-            for row_idx in range(min(20, sheet.nrows)):
-                potential_headers = []
-                for col_idx in range(sheet.ncols):
-                    cell_value = sheet.cell_value(row_idx, col_idx)
-                    potential_headers.append(str(cell_value).strip().lower() if cell_value else "")
+            if isinstance(file_content, Path):
+                # xlrd mapea el archivo en memoria (mmap) en lugar de copiarlo
+                workbook = xlrd.open_workbook(filename=str(file_content), on_demand=True)
+            else:
+                workbook = xlrd.open_workbook(file_contents=file_content, on_demand=True)
+            try:
+                sheet = workbook.sheet_by_index(0)
                 
-                # Verificar si esta fila contiene "código" o "codigo"
-                if any("codigo" in h or "código" in h for h in potential_headers):
-                    header_row_idx = row_idx
-                    headers = potential_headers
-                    logger.info(f"📋 Encabezados encontrados en fila {row_idx + 1}")
-                    break
-            
-            if header_row_idx is None:
-                raise ValueError(
-                    "No se encontró la fila de encabezados. "
-                    "Asegúrate de que el archivo tenga una fila con al menos las columnas 'Código' y 'Nombre'"
-                )
-            
-            # Mapear índices de columnas
-            column_indices = self._map_column_indices(headers)
-            
-            if "codigo" not in column_indices or "nombre" not in column_indices:
-                raise ValueError(
-                    "El archivo debe tener al menos las columnas 'Código' y 'Nombre'"
-                )
-            
-            # Leer las filas de datos
-            accounts = []
-            for row_idx in range(header_row_idx + 1, sheet.nrows):
-                try:
-                    row_values = []
-                    for col_idx in range(sheet.ncols):
-                        cell_value = sheet.cell_value(row_idx, col_idx)
-                        row_values.append(cell_value)
+                if sheet.nrows == 0:
+                    raise ValueError("El archivo Excel está vacío")
+                
+                # Un solo recorrido de filas: encabezados y datos salen del mismo generador
+                rows = enumerate(sheet.get_rows())
+                
+                # Buscar la fila de encabezados en las primeras 20 filas
+                header_row_idx = None
+                headers = []
+                
+                for row_idx, row in rows:
+                    if row_idx >= 20:
+                        break
+                    potential_headers = [_norm(cell.value) if cell.value else "" for cell in row]
                     
-                    account = self._parse_row(tuple(row_values), column_indices, owner_id)
-                    if account:
-                        accounts.append(account)
-                except Exception as e:
-                    logger.warning(f"⚠️ Error parseando fila {row_idx + 1}: {e}")
-                    continue
+                    # Verificar si esta fila contiene "código" o "codigo"
+                    if self._is_header_row(potential_headers):
+                        header_row_idx = row_idx
+                        headers = potential_headers
+                        logger.info(f"📋 Encabezados encontrados en fila {row_idx + 1}")
+                        break
+                
+                if header_row_idx is None:
+                    raise ValueError(
+                        "No se encontró la fila de encabezados. "
+                        "Asegúrate de que el archivo tenga una fila con al menos las columnas 'Código' y 'Nombre'"
+                    )
+                
+                # Mapear índices de columnas
+                column_indices = self._map_column_indices(headers)
+                
+                if "codigo" not in column_indices or "nombre" not in column_indices:
+                    raise ValueError(
+                        "El archivo debe tener al menos las columnas 'Código' y 'Nombre'"
+                    )
+                
+                # Leer las filas de datos (el generador continúa tras los encabezados)
+                indices = self._resolve_indices(column_indices)
+                codigo_idx = column_indices["codigo"]
+                nombre_idx = column_indices["nombre"]
+                required_width = max(codigo_idx, nombre_idx) + 1
+                accounts = []
+                for row_idx, row in rows:
+                    # Descartar filas vacías (habituales al final de la hoja) sin materializarlas
+                    if len(row) < required_width or row[codigo_idx].value == "" or row[nombre_idx].value == "":
+                        continue
+                    try:
+                        account = self._parse_row_fast(tuple(cell.value for cell in row), indices, owner_id)
+                        if account:
+                            accounts.append(account)
+                    except Exception as e:
+                        logger.warning(f"⚠️ Error parseando fila {row_idx + 1}: {e}")
+                        continue
+            finally:
+                workbook.release_resources()
             
             logger.info(f"✅ Parseadas {len(accounts)} cuentas PUC del archivo .xls")
             return accounts
@@ -154,12 +257,12 @@ class PUCExcelParserService:
             logger.error(f"❌ Error parseando archivo .xls: {e}")
             raise ValueError(f"Error procesando archivo .xls: {str(e)}") from e
     
-    def parse_xlsx(self, file_content: bytes | BinaryIO, owner_id: str) -> list[PUCAccount]:
+    def parse_xlsx(self, file_content: ExcelSource | BinaryIO, owner_id: str) -> list[PUCAccount]:
         """
         Lee un archivo XLSX y retorna una lista de entidades PUCAccount.
         
         Args:
-            file_content: Contenido del archivo XLSX en bytes o archivo abierto
+            file_content: Contenido del archivo XLSX en bytes, ruta en disco o archivo abierto
             owner_id: ID del propietario/empresa
             
         Returns:
@@ -170,72 +273,41 @@ class PUCExcelParserService:
         """
         try:
             # Validar que sea un archivo Excel válido verificando el magic number
-            if isinstance(file_content, bytes):
+            if isinstance(file_content, (bytes, Path)):
                 # ZIP magic numbers (Excel es un ZIP)
-                if not (file_content.startswith(b'PK\x03\x04') or file_content.startswith(b'PK\x05\x06')):
+                if not _read_magic(file_content).startswith(_XLSX_MAGICS):
                     raise ValueError(
                         "El archivo no parece ser un Excel válido. "
                         "Por favor, verifica que el archivo se pueda abrir con Excel y guárdalo nuevamente."
                     )
             
+            if CalamineWorkbook is not None:
+                accounts = self._parse_xlsx_calamine(file_content, owner_id)
+                logger.info(f"✅ Parseadas {len(accounts)} cuentas PUC del archivo Excel")
+                return accounts
+            
+            if isinstance(file_content, Path):
+                # Desde disco: zipfile lee cada parte bajo demanda, sin cargar el archivo
+                with file_content.open("rb") as fp:
+                    return self.parse_xlsx(fp, owner_id)
+            
             # Cargar el workbook con más opciones de compatibilidad
             from io import BytesIO
             if isinstance(file_content, bytes):
                 file_content = BytesIO(file_content)
             
-            workbook = openpyxl.load_workbook(
-                file_content, 
-                data_only=True,
-                read_only=False  # Cambiar a False para mejor compatibilidad
-            )
-            sheet = workbook.active
-            
-            if sheet is None:
-                raise ValueError("El archivo Excel no tiene hojas")
-            
-            # Buscar la fila de encabezados en las primeras 20 filas
-            header_row_idx = None
-            headers = []
-            
-            for row_idx in range(1, min(21, sheet.max_row + 1)):
-                potential_headers = []
-                for cell in sheet[row_idx]:
-                    if cell.value:
-                        potential_headers.append(str(cell.value).strip().lower())
-                    else:
-                        potential_headers.append("")
+            # Modo streaming: no se construye el grafo completo de celdas en memoria
+            workbook = openpyxl.load_workbook(file_content, data_only=True, read_only=True)
+            try:
+                sheet = workbook.active
                 
-                # Verificar si esta fila contiene "código" o "codigo"
-                if any("codigo" in h or "código" in h for h in potential_headers):
-                    header_row_idx = row_idx
-                    headers = potential_headers
-                    logger.info(f"📋 Encabezados encontrados en fila {row_idx}")
-                    break
-            
-            if header_row_idx is None:
-                raise ValueError(
-                    "No se encontró la fila de encabezados. "
-                    "Asegúrate de que el archivo tenga una fila con al menos las columnas 'Código' y 'Nombre'"
-                )
-            
-            # Mapear índices de columnas
-            column_indices = self._map_column_indices(headers)
-            
-            if "codigo" not in column_indices or "nombre" not in column_indices:
-                raise ValueError(
-                    "El archivo debe tener al menos las columnas 'Código' y 'Nombre'"
-                )
-            
-            # Leer las filas de datos (desde después de los encabezados)
-            accounts = []
-            for row_idx, row in enumerate(sheet.iter_rows(min_row=header_row_idx + 1, values_only=True), start=header_row_idx + 1):
-                try:
-                    account = self._parse_row(row, column_indices, owner_id)
-                    if account:
-                        accounts.append(account)
-                except Exception as e:
-                    logger.warning(f"⚠️ Error parseando fila {row_idx}: {e}")
-                    continue
+                if sheet is None:
+                    raise ValueError("El archivo Excel no tiene hojas")
+                
+                accounts = self._accounts_from_rows(sheet.iter_rows(values_only=True), owner_id)
+            finally:
+                # En read_only el workbook mantiene abierto el archivo subyacente
+                workbook.close()
             
             logger.info(f"✅ Parseadas {len(accounts)} cuentas PUC del archivo Excel")
             return accounts
@@ -263,70 +335,136 @@ class PUCExcelParserService:
             else:
                 raise ValueError(f"Error al procesar el archivo: {error_msg}") from e
     
+    def _parse_xlsx_calamine(self, file_content: ExcelSource | BinaryIO, owner_id: str) -> list[PUCAccount]:
+        """Lee la primera hoja con calamine; openpyxl queda como respaldo si no está instalado."""
+        from io import BytesIO
+        if isinstance(file_content, Path):
+            workbook = CalamineWorkbook.from_path(str(file_content))
+        else:
+            workbook = CalamineWorkbook.from_filelike(
+                BytesIO(file_content) if isinstance(file_content, bytes) else file_content
+            )
+        try:
+            sheet = workbook.get_sheet_by_index(0)
+            rows = ([_calamine_value(value) for value in row] for row in sheet.iter_rows())
+            return self._accounts_from_rows(rows, owner_id)
+        finally:
+            workbook.close()
+    
+    def _accounts_from_rows(self, values: Iterable[Sequence[Any]], owner_id: str) -> list[PUCAccount]:
+        """
+        Busca los encabezados y convierte las filas siguientes en cuentas.
+        `values` son las filas como secuencias de valores (None o "" para celdas vacías).
+        """
+        # Un solo recorrido de filas: encabezados y datos salen del mismo generador
+        rows = enumerate(values, start=1)
+        
+        # Buscar la fila de encabezados en las primeras 20 filas
+        header_row_idx = None
+        headers = []
+        
+        for row_idx, row in rows:
+            if row_idx > 20:
+                break
+            potential_headers = [_norm(value) if value else "" for value in row]
+            
+            # Verificar si esta fila contiene "código" o "codigo"
+            if self._is_header_row(potential_headers):
+                header_row_idx = row_idx
+                headers = potential_headers
+                logger.info(f"📋 Encabezados encontrados en fila {row_idx}")
+                break
+        
+        if header_row_idx is None:
+            raise ValueError(
+                "No se encontró la fila de encabezados. "
+                "Asegúrate de que el archivo tenga una fila con al menos las columnas 'Código' y 'Nombre'"
+            )
+        
+        # Mapear índices de columnas
+        column_indices = self._map_column_indices(headers)
+        
+        if "codigo" not in column_indices or "nombre" not in column_indices:
+            raise ValueError(
+                "El archivo debe tener al menos las columnas 'Código' y 'Nombre'"
+            )
+        
+        # Leer las filas de datos (el generador continúa tras los encabezados)
+        indices = self._resolve_indices(column_indices)
+        accounts = []
+        for row_idx, row in rows:
+            try:
+                account = self._parse_row_fast(row, indices, owner_id)
+                if account:
+                    accounts.append(account)
+            except Exception as e:
+                logger.warning(f"⚠️ Error parseando fila {row_idx}: {e}")
+                continue
+        return accounts
+    
+    def _is_header_row(self, headers: list[str]) -> bool:
+        """Indica si la fila contiene la columna de código (encabezados ya sin tildes)."""
+        return any("codigo" in h for h in headers)
+
     def _map_column_indices(self, headers: list[str]) -> dict[str, int]:
         """
         Mapea los nombres de columnas a sus índices.
         Retorna un diccionario {nombre_campo: índice_columna}
         """
+        mapping = self._NORM_COLUMN_MAPPING
         indices = {}
         for idx, header in enumerate(headers):
-            field_name = self.COLUMN_MAPPING.get(header.strip().lower())
+            field_name = mapping.get(header)
             if field_name:
                 indices[field_name] = idx
         
         logger.debug(f"Columnas mapeadas: {indices}")
         return indices
     
-    def _parse_row(
-        self, 
-        row: tuple, 
-        column_indices: dict[str, int], 
-        owner_id: str
+    def _resolve_indices(self, column_indices: dict[str, int]) -> tuple[int | None, ...]:
+        """Índices de columna en el orden de _ROW_FIELDS, resueltos una sola vez por archivo."""
+        return tuple(column_indices.get(name) for name in self._ROW_FIELDS)
+
+    def _parse_row_fast(
+        self,
+        row: tuple,
+        indices: tuple[int | None, ...],
+        owner_id: str,
     ) -> PUCAccount | None:
         """
         Parsea una fila del Excel y retorna una entidad PUCAccount.
         Retorna None si la fila está vacía o no es válida.
         """
-        # Obtener valores de las columnas
-        codigo = self._get_cell_value(row, column_indices.get("codigo"))
-        nombre = self._get_cell_value(row, column_indices.get("nombre"))
+        width = len(row)
+        values = [
+            "" if idx is None or idx >= width or row[idx] is None else str(row[idx]).strip()
+            for idx in indices
+        ]
+        codigo, nombre = values[0], values[1]
         
         # Validar campos obligatorios
         if not codigo or not nombre:
             return None
         
-        # Si el código no es numérico o alfanumérico, es probablemente un encabezado repetido
-        codigo_str = str(codigo).strip()
-        if not codigo_str or codigo_str.lower() in ["código", "codigo"]:
+        # Si el código es el texto del encabezado, es un encabezado repetido
+        if codigo.lower() in self._CODE_HEADER_TOKENS:
             return None
         
+        # Una sola grafía para el nivel transaccional: el repositorio lo filtra por igualdad exacta
+        nivel_agrupacion = values[8]
+        if nivel_agrupacion.lower() == "transaccional":
+            nivel_agrupacion = "Transaccional"
+        
         # Crear la entidad
         return PUCAccount.create(
             owner_id=owner_id,
-            codigo=codigo_str,
-            nombre=str(nombre).strip(),
-            categoria=self._get_cell_value(row, column_indices.get("categoria"), ""),
-            clase=self._get_cell_value(row, column_indices.get("clase"), ""),
-            relacion_con=self._get_cell_value(row, column_indices.get("relacion_con"), ""),
-            maneja_vencimientos=self._get_cell_value(row, column_indices.get("maneja_vencimientos"), ""),
-            diferencia_fiscal=self._get_cell_value(row, column_indices.get("diferencia_fiscal"), ""),
-            activo=self._get_cell_value(row, column_indices.get("activo"), ""),
-            nivel_agrupacion=self._get_cell_value(row, column_indices.get("nivel_agrupacion"), ""),
+            codigo=codigo,
+            nombre=nombre,
+            categoria=values[2],
+            clase=values[3],
+            relacion_con=values[4],
+            maneja_vencimientos=values[5],
+            diferencia_fiscal=values[6],
+            activo=values[7],
+            nivel_agrupacion=nivel_agrupacion,
         )
-    
-    def _get_cell_value(self, row: tuple, column_idx: int | None, default: str = "") -> str:
-        """
-        Obtiene el valor de una celda de forma segura.
-        Retorna default si el índice es None o está fuera de rango.
-        """
-        if column_idx is None:
-            return default
-        
-        if column_idx >= len(row):
-            return default
-        
-        value = row[column_idx]
-        if value is None:
-            return default
-        
-        return str(value).strip()
@@ -3,20 +3,96 @@ Servicio para mapear códigos PUC de 4 dígitos a códigos específicos de 8 dí
 """
 from __future__ import annotations
 
-import json
+import asyncio
+import hashlib
 import logging
-from dataclasses import dataclass
+import re
+import sys
+import time
+from bisect import bisect_left
+from collections import OrderedDict, defaultdict
+from dataclasses import dataclass, field
+from functools import lru_cache
+from threading import Lock
 from typing import Any
 
+import orjson
+
+from .ai import GeminiAISuggestionService
+from .gemini_common import CachedPrefixModels, JSONObjectStream, chunk_text
+from .llm_cache import InMemoryLLMCache
+
 logger = logging.getLogger(__name__)
 
+# Fence markdown (```json ... ```) al inicio o al final de la respuesta
+_FENCE_RE = re.compile(r"^\s*```(?:json)?\s*|\s*```\s*$")
+
 try:
     import google.generativeai as genai
 except ModuleNotFoundError:
     genai = None
 
+# Longitudes válidas de prefijo en el PUC: clase, grupo, cuenta, subcuenta y auxiliar
+_PREFIX_LENGTHS = frozenset({1, 2, 4, 6, 8})
+_RATIONALE_MAX_CHARS = 200
+
+# Vigencia de las cuentas cacheadas por owner (se invalidan además al subir un PUC nuevo)
+_ACCOUNTS_TTL_SECONDS = 300
+_ACCOUNTS_CACHE_MAX_OWNERS = 128
+_PROJECTION_FIELDS = ("codigo", "nombre", "categoria", "clase", "nivel_agrupacion")
+
+_MAPPING_MODEL = "gemini-2.5-flash"
+
+# Salida reservada por ítem: un bloque de 16 ítems ocupa el máximo de 8192 tokens
+_MAX_TOKENS_PER_ITEM = 512
+_BATCH_MAX_ITEMS = 16
+
+# Instrucciones y esquema fijos: siempre al inicio del prompt para aprovechar la caché de prefijos
+_MAPPING_INSTRUCTIONS = "\n".join([
+    "Eres un experto contador. Para CADA ítem selecciona la cuenta PUC MÁS APROPIADA "
+    "entre las cuentas disponibles cuyo código empieza por su código genérico.",
+    "",
+    "RESPONDE SOLO CON UN ARRAY JSON, un objeto por ítem:",
+    '[',
+    '  {',
+    '    "item": 1,',
+    '    "code": "11050501",',
+    '    "name": "Efectivo CL 72",',
+    '    "confidence": 0.95,',
+    '    "explanation": "Razón de la selección"',
+    '  }',
+    ']',
+])
+
+# Cobertura mínima del nombre de la cuenta por la descripción para resolver sin IA
+_LOCAL_MATCH_THRESHOLD = 0.9
+
+# Candidatas que se envían al modelo por ítem, tras ordenarlas por afinidad textual
+_PRERANK_TOP_K = 8
+# Tope de cuentas listadas por código genérico (unión de las candidatas de sus ítems)
+_MAX_PROMPT_CANDIDATES = 20
+
+# Vigencia de los mapeos cacheados (la huella del catálogo ya cubre los cambios de PUC)
+_MAPPING_CACHE_TTL_SECONDS = 24 * 3600
+
+# Llamadas simultáneas por defecto en la variante asíncrona (acotadas por la cuota RPM)
+_DEFAULT_CONCURRENCY = 8
+
+
+@lru_cache(maxsize=32)
+def _mapping_config(max_output_tokens: int) -> Any:
+    """Configuración de generación reutilizable por tamaño de salida."""
+    return genai.types.GenerationConfig(temperature=0.1, max_output_tokens=max_output_tokens)
+
+
+def _intern(value: Any) -> Any:
+    """Comparte una sola copia de los textos repetidos (categoría, clase, nivel)."""
+    return sys.intern(value) if isinstance(value, str) else value
+
 
-@dataclass
+# Slots y congelada: sin __dict__ por cuenta y hashable para las cachés por cuenta.
+# Categoría, clase y nivel se internan al cargar: pocos valores distintos compartidos.
+@dataclass(slots=True, frozen=True)
 class PUCAccount:
     """Cuenta del PUC de la empresa"""
     code: str  # Código completo (ej: "11050501")
@@ -26,6 +102,56 @@ class PUCAccount:
     level: str  # Nivel de agrupación
 
 
+@dataclass(slots=True)
+class _OwnerAccounts:
+    loaded_at: float
+    accounts: list[PUCAccount]
+    by_prefix: dict[str, list[PUCAccount]]  # prefijo PUC válido -> cuentas que lo comparten
+    catalog_prefix: str | None = None  # instrucciones + catálogo completo, para la caché de Gemini
+    fingerprint: str = ""  # huella del catálogo: un PUC nuevo invalida los mapeos cacheados
+    # Códigos ordenados y sus cuentas en el mismo orden: prefijos de cualquier largo por bisección
+    sorted_codes: list[str] = field(default_factory=list)
+    sorted_accounts: list[PUCAccount] = field(default_factory=list)
+
+
+# Ítem pendiente de selección por IA: (posición en el lote, request, candidatas, clave de caché)
+_PendingItem = tuple[int, dict[str, Any], list[PUCAccount], str | None]
+
+# Plantillas precompiladas del prompt de mapeo: la parte fija no se rearma en cada llamada
+_BATCH_PROMPT_HEADER = _MAPPING_INSTRUCTIONS + "\n\nCUENTAS DISPONIBLES POR CÓDIGO GENÉRICO:\n"
+_ITEM_TEMPLATE = (
+    "\nITEM {item}:\n"
+    "  CÓDIGO GENÉRICO: {generic_code}\n"
+    "  DESCRIPCIÓN: {description}\n"
+    "  JUSTIFICACIÓN: {rationale}"
+)
+
+
+@lru_cache(maxsize=8192)
+def _account_words(account: PUCAccount) -> frozenset[str]:
+    """Palabras de nombre y categoría de la cuenta; se calculan una vez por cuenta."""
+    return frozenset(GeminiAISuggestionService._tokenize(f"{account.name} {account.category}"))
+
+
+@lru_cache(maxsize=1024)
+def _candidate_block(generic_code: str, ranked: tuple[tuple[PUCAccount, ...], ...]) -> str:
+    """
+    Bloque de cuentas de un código genérico; las candidatas de un owner se repiten entre lotes.
+    `ranked` trae la lista ya ordenada por afinidad de cada ítem que usa el código.
+    """
+    # El tope se aplica por turnos sobre las listas de cada ítem: todos conservan sus mejores candidatas
+    chosen: dict[str, PUCAccount] = {}
+    for rank in range(max(map(len, ranked), default=0)):
+        for candidates in ranked:
+            if rank < len(candidates) and len(chosen) < _MAX_PROMPT_CANDIDATES:
+                chosen.setdefault(candidates[rank].code, candidates[rank])
+    # Entradas canónicas: mismos datos producen exactamente el mismo prompt
+    unique = sorted(chosen.values(), key=lambda acc: acc.code)
+    lines = [f"CÓDIGO {generic_code}:"]
+    lines.extend(f"   {idx}. {acc.code} - {acc.name} ({acc.category})" for idx, acc in enumerate(unique, 1))
+    return "\n".join(lines)
+
+
 class PUCMapperService:
     """
     Servicio que mapea códigos PUC genéricos (4 dígitos) a códigos específicos
@@ -38,10 +164,19 @@ class PUCMapperService:
         self.puc_repository = puc_repository
         self.api_key = api_key
         self._initialized = False
+        self._model: Any = None
+        # Cuentas transaccionales por owner, con su índice por prefijo
+        self._accounts_cache: OrderedDict[str, _OwnerAccounts] = OrderedDict()
+        self._accounts_lock = Lock()
+        self._prefix_models = CachedPrefixModels(_MAPPING_MODEL)  # catálogo del owner cacheado en Gemini
+        # Mapeos ya resueltos por Gemini para descripciones equivalentes
+        self._mapping_cache = InMemoryLLMCache(ttl_seconds=_MAPPING_CACHE_TTL_SECONDS, max_entries=4096)
         
         if api_key and genai:
             try:
                 genai.configure(api_key=api_key)
+                # Un único modelo reutilizado entre llamadas (mantiene vivo el canal)
+                self._model = genai.GenerativeModel(_MAPPING_MODEL)
                 self._initialized = True
                 logger.info("✅ PUCMapperService inicializado con Gemini")
             except Exception as e:
@@ -50,45 +185,137 @@ class PUCMapperService:
     def load_accounts_for_owner(self, owner_id: str) -> list[PUCAccount]:
         """
         Carga las cuentas PUC del owner desde el repositorio.
+        Se cachean por owner durante _ACCOUNTS_TTL_SECONDS para no releer Firestore en cada mapeo.
         
         Returns:
             Lista de PUCAccount con las cuentas del owner
         """
+        return self._owner_accounts(owner_id).accounts
+
+    def _owner_accounts(self, owner_id: str) -> _OwnerAccounts:
+        """Cuentas del owner junto con su índice por prefijo, ambos cacheados."""
         if not self.puc_repository:
             logger.warning("⚠️ No hay repositorio PUC configurado")
-            return []
+            return _OwnerAccounts(0.0, [], {})
+        
+        now = time.monotonic()
+        with self._accounts_lock:
+            cached = self._accounts_cache.get(owner_id)
+            if cached is not None and now - cached.loaded_at < _ACCOUNTS_TTL_SECONDS:
+                self._accounts_cache.move_to_end(owner_id)
+                return cached
         
         try:
-            # Obtener todas las cuentas del owner (sin paginación)
-            accounts_domain, _ = self.puc_repository.list_by_owner(
-                owner_id=owner_id,
-                search=None,
-                limit=10000,
-                offset=0,
-            )
-            
-            # Convertir a formato interno
-            accounts = []
-            for acc in accounts_domain:
-                # Solo tomar cuentas transaccionales
-                if acc.nivel_agrupacion.lower() == "transaccional":
-                    accounts.append(PUCAccount(
-                        code=acc.codigo,
-                        name=acc.nombre,
-                        category=acc.categoria,
-                        class_type=acc.clase,
-                        level=acc.nivel_agrupacion,
-                    ))
+            iter_transactional = getattr(self.puc_repository, "iter_transactional_projection", None)
+            iter_projection = getattr(self.puc_repository, "iter_projection", None)
+            if iter_transactional is not None:
+                # El repositorio filtra las transaccionales: solo viajan las cuentas usadas
+                accounts = [
+                    PUCAccount(
+                        code=row["codigo"],
+                        name=row["nombre"],
+                        category=_intern(row["categoria"]),
+                        class_type=_intern(row["clase"]),
+                        level=_intern(row["nivel_agrupacion"]),
+                    )
+                    for row in iter_transactional(owner_id, _PROJECTION_FIELDS)
+                    if row["codigo"]
+                ]
+            elif iter_projection is not None:
+                # Proyección liviana: solo los cinco campos usados, sin construir entidades
+                accounts = [
+                    PUCAccount(
+                        code=row["codigo"],
+                        name=row["nombre"],
+                        category=_intern(row["categoria"]),
+                        class_type=_intern(row["clase"]),
+                        level=_intern(row["nivel_agrupacion"]),
+                    )
+                    for row in iter_projection(owner_id, _PROJECTION_FIELDS)
+                    # Solo tomar cuentas transaccionales
+                    if row["codigo"] and str(row["nivel_agrupacion"]).lower() == "transaccional"
+                ]
+            else:
+                # Obtener todas las cuentas del owner (sin paginación)
+                accounts_domain, _ = self.puc_repository.list_by_owner(
+                    owner_id=owner_id,
+                    search=None,
+                    limit=10000,
+                    offset=0,
+                )
+                
+                # Convertir a formato interno
+                accounts = []
+                for acc in accounts_domain:
+                    # Solo tomar cuentas transaccionales
+                    if acc.nivel_agrupacion.lower() == "transaccional":
+                        accounts.append(PUCAccount(
+                            code=acc.codigo,
+                            name=acc.nombre,
+                            category=_intern(acc.categoria),
+                            class_type=_intern(acc.clase),
+                            level=_intern(acc.nivel_agrupacion),
+                        ))
             
             logger.info(f"✅ Cargadas {len(accounts)} cuentas PUC para owner {owner_id}")
-            return accounts
             
         except Exception as e:
             logger.error(f"❌ Error cargando PUC para owner {owner_id}: {e}")
-            return []
+            return _OwnerAccounts(0.0, [], {})
+        
+        sorted_accounts = sorted(accounts, key=lambda acc: acc.code)
+        entry = _OwnerAccounts(
+            now,
+            accounts,
+            self.build_prefix_index(accounts),
+            fingerprint=self._fingerprint(accounts),
+            sorted_codes=[acc.code for acc in sorted_accounts],
+            sorted_accounts=sorted_accounts,
+        )
+        with self._accounts_lock:
+            self._accounts_cache[owner_id] = entry
+            self._accounts_cache.move_to_end(owner_id)
+            while len(self._accounts_cache) > _ACCOUNTS_CACHE_MAX_OWNERS:
+                self._accounts_cache.popitem(last=False)
+        return entry
+    
+    def invalidate(self, owner_id: str | None = None) -> None:
+        """Descarta las cuentas cacheadas de un owner (o de todos si no se indica)."""
+        with self._accounts_lock:
+            if owner_id is None:
+                self._accounts_cache.clear()
+            else:
+                self._accounts_cache.pop(owner_id, None)
     
-    def get_accounts_by_prefix(self, accounts: list[PUCAccount], prefix: str) -> list[PUCAccount]:
-        """Obtiene todas las cuentas que empiezan con el prefijo dado"""
+    def build_prefix_index(self, accounts: list[PUCAccount]) -> dict[str, list[PUCAccount]]:
+        """Indexa las cuentas por cada prefijo válido del PUC (búsqueda O(1) por código genérico)"""
+        index: defaultdict[str, list[PUCAccount]] = defaultdict(list)
+        for acc in accounts:
+            code = acc.code
+            for length in _PREFIX_LENGTHS:
+                if len(code) >= length:
+                    index[code[:length]].append(acc)
+        return dict(index)
+
+    def get_accounts_by_prefix(
+        self,
+        accounts: list[PUCAccount],
+        prefix: str,
+        index: dict[str, list[PUCAccount]] | None = None,
+        sorted_codes: list[str] | None = None,
+        sorted_accounts: list[PUCAccount] | None = None,
+    ) -> list[PUCAccount]:
+        """
+        Obtiene todas las cuentas que empiezan con el prefijo dado. Con el índice
+        es O(1) para los largos del PUC; con los códigos ordenados, O(log N + M)
+        para cualquier otro prefijo (resultado en orden de código).
+        """
+        if index is not None and len(prefix) in _PREFIX_LENGTHS:
+            return index.get(prefix, [])
+        if sorted_codes is not None and sorted_accounts is not None:
+            lo = bisect_left(sorted_codes, prefix)
+            hi = bisect_left(sorted_codes, prefix + "\uffff", lo)
+            return sorted_accounts[lo:hi]
         return [acc for acc in accounts if acc.code.startswith(prefix)]
     
     def map_to_specific_account(
@@ -116,127 +343,375 @@ class PUCMapperService:
                 "explanation": "..."
             }
         """
-        # Cargar cuentas del owner
-        accounts = self.load_accounts_for_owner(owner_id)
+        request = {"generic_code": generic_code, "description": description, "rationale": rationale}
+        return self.map_to_specific_accounts_batch(owner_id, [request])[0]
+
+    def map_to_specific_accounts_batch(
+        self,
+        owner_id: str,
+        requests: list[dict[str, Any]],
+    ) -> list[dict[str, Any]]:
+        """
+        Mapea varios códigos genéricos con una sola llamada a Gemini.
+        
+        Args:
+            owner_id: ID del propietario/empresa
+            requests: Lista de {"generic_code", "description", "rationale"}
+        
+        Returns:
+            Un resultado por request, en el mismo orden (ver map_to_specific_account)
+        """
+        results, pending = self._resolve_locally(owner_id, requests)
+        for chunk in self._chunk_pending(pending):
+            # Usar IA para seleccionar la más apropiada de todos los ítems pendientes del bloque
+            self._apply_selections(results, chunk, self._select_with_ai(owner_id, chunk))
+        return results  # type: ignore[return-value]
+
+    async def amap_to_specific_accounts_batch(
+        self,
+        owner_id: str,
+        requests: list[dict[str, Any]],
+        concurrency: int = _DEFAULT_CONCURRENCY,
+    ) -> list[dict[str, Any]]:
+        """
+        Variante asíncrona: los bloques que no caben en una sola respuesta se envían
+        a Gemini en paralelo, con un máximo de `concurrency` llamadas en vuelo.
+        """
+        # La carga de cuentas es bloqueante (repositorio): fuera del event loop
+        results, pending = await asyncio.to_thread(self._resolve_locally, owner_id, requests)
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def bounded(chunk: list[_PendingItem]) -> dict[int, dict[str, Any]]:
+            async with semaphore:
+                return await self._aselect_with_ai(owner_id, chunk)
+
+        chunks = self._chunk_pending(pending)
+        selections = await asyncio.gather(*(bounded(chunk) for chunk in chunks))
+        for chunk, by_item in zip(chunks, selections):
+            self._apply_selections(results, chunk, by_item)
+        return results  # type: ignore[return-value]
+
+    def _resolve_locally(
+        self,
+        owner_id: str,
+        requests: list[dict[str, Any]],
+    ) -> tuple[list[dict[str, Any] | None], list[_PendingItem]]:
+        """
+        Resuelve sin IA los ítems triviales; los demás quedan como None en los
+        resultados y se devuelven como pendientes (posición, request, candidatos).
+        """
+        if not requests:
+            return [], []
+
+        # Cargar cuentas del owner (y su índice) una sola vez para todo el lote
+        owner_accounts = self._owner_accounts(owner_id)
+        accounts, index = owner_accounts.accounts, owner_accounts.by_prefix
         
         if not accounts:
             logger.warning(f"⚠️ Owner {owner_id} no tiene PUC cargado")
-            return {
-                "specific_code": generic_code,
-                "account_name": "Cuenta genérica (sin PUC personalizado)",
-                "confidence": 0.3,
-                "explanation": "El usuario no ha cargado un PUC personalizado",
-            }
+            return [
+                {
+                    "specific_code": request["generic_code"],
+                    "account_name": "Cuenta genérica (sin PUC personalizado)",
+                    "confidence": 0.3,
+                    "explanation": "El usuario no ha cargado un PUC personalizado",
+                }
+                for request in requests
+            ], []
         
-        if not self._initialized or genai is None:
-            # Fallback: devolver el primer código que coincida
-            candidates = self.get_accounts_by_prefix(accounts, generic_code)
-            if candidates:
-                return {
+        use_ai = self._initialized and genai is not None and self._model is not None
+        results: list[dict[str, Any] | None] = []
+        pending: list[_PendingItem] = []
+
+        for position, request in enumerate(requests):
+            generic_code = request["generic_code"]
+            # Obtener candidatos que empiecen con el código genérico
+            candidates = self.get_accounts_by_prefix(
+                accounts,
+                generic_code,
+                index,
+                owner_accounts.sorted_codes,
+                owner_accounts.sorted_accounts,
+            )
+            
+            if not use_ai:
+                # Fallback: devolver el primer código que coincida
+                if candidates:
+                    results.append({
+                        "specific_code": candidates[0].code,
+                        "account_name": candidates[0].name,
+                        "confidence": 0.5,
+                        "explanation": f"Selección automática sin IA: {candidates[0].name}",
+                    })
+                else:
+                    results.append({
+                        "specific_code": generic_code,
+                        "account_name": "Cuenta genérica",
+                        "confidence": 0.3,
+                        "explanation": "No se encontró cuenta específica",
+                    })
+            elif not candidates:
+                results.append({
+                    "specific_code": generic_code,
+                    "account_name": "Cuenta genérica",
+                    "confidence": 0.3,
+                    "explanation": "No hay cuentas específicas disponibles",
+                })
+            elif len(candidates) == 1:
+                # Solo hay una opción
+                results.append({
+                    "specific_code": candidates[0].code,
+                    "account_name": candidates[0].name,
+                    "confidence": 0.9,
+                    "explanation": f"Única cuenta disponible: {candidates[0].name}",
+                })
+            else:
+                match = self._local_match(request.get("description") or "", candidates)
+                if match is not None:
+                    # Coincidencia evidente entre descripción y nombre: no hace falta Gemini
+                    results.append({
+                        "specific_code": match.code,
+                        "account_name": match.name,
+                        "confidence": 0.9,
+                        "explanation": f"Coincidencia directa con la descripción: {match.name}",
+                    })
+                    continue
+                cache_key = self._mapping_key(owner_accounts.fingerprint, generic_code, request.get("description") or "")
+                cached = self._mapping_cache.get(cache_key) if cache_key else None
+                if cached is not None:
+                    results.append(dict(cached))
+                    continue
+                results.append(None)
+                pending.append((position, request, candidates, cache_key))
+
+        return results, pending
+
+    @staticmethod
+    def _fingerprint(accounts: list[PUCAccount]) -> str:
+        digest = hashlib.blake2b(digest_size=16)
+        for acc in sorted(accounts, key=lambda acc: acc.code):
+            digest.update(f"{acc.code}\x1f{acc.name}\x1e".encode("utf-8"))
+        return digest.hexdigest()
+
+    @staticmethod
+    def _mapping_key(fingerprint: str, generic_code: str, description: str) -> str | None:
+        """
+        Clave de caché para descripciones equivalentes: mismas palabras sin importar
+        orden, tildes, mayúsculas, stopwords ni números (fechas, consecutivos).
+        """
+        words = sorted(
+            word for word in GeminiAISuggestionService._tokenize(description) if not word.isdigit()
+        )
+        if not words:
+            return None
+        return f"{fingerprint}|{generic_code}|{' '.join(words)}"
+
+    @staticmethod
+    def _local_match(description: str, candidates: list[PUCAccount]) -> PUCAccount | None:
+        """
+        Candidata cuyo nombre queda cubierto por las palabras de la descripción
+        (sin tildes ni stopwords). Solo se acepta si es la única con la mejor cobertura.
+        """
+        words = GeminiAISuggestionService._tokenize(description)
+        if not words:
+            return None
+        best: PUCAccount | None = None
+        best_score = 0.0
+        tied = False
+        for acc in candidates:
+            name_words = GeminiAISuggestionService._tokenize(acc.name)
+            if not name_words:
+                continue
+            score = len(words & name_words) / len(name_words)
+            if score > best_score:
+                best, best_score, tied = acc, score, False
+            elif score == best_score:
+                tied = True
+        if best is None or tied or best_score < _LOCAL_MATCH_THRESHOLD:
+            return None
+        return best
+
+    @staticmethod
+    def _rank_candidates(
+        request: dict[str, Any],
+        candidates: list[PUCAccount],
+        limit: int = _PRERANK_TOP_K,
+    ) -> list[PUCAccount]:
+        """
+        Las `limit` candidatas con más palabras en común con descripción y justificación.
+        Sin ninguna coincidencia se conservan todas (el bloque del prompt limita a 20).
+        """
+        if len(candidates) <= limit:
+            return candidates
+        words = GeminiAISuggestionService._tokenize(
+            f"{request.get('description') or ''} {request.get('rationale') or ''}"
+        )
+        scored = [(len(words & _account_words(acc)), acc) for acc in candidates]
+        if not any(score for score, _ in scored):
+            return candidates
+        scored.sort(key=lambda pair: (-pair[0], pair[1].code))
+        return [acc for _, acc in scored[:limit]]
+
+    @staticmethod
+    def _chunk_pending(pending: list[_PendingItem]) -> list[list[_PendingItem]]:
+        """Bloques de hasta _BATCH_MAX_ITEMS ítems: lo que cabe en el presupuesto de salida."""
+        return [pending[i:i + _BATCH_MAX_ITEMS] for i in range(0, len(pending), _BATCH_MAX_ITEMS)]
+
+    def _apply_selections(
+        self,
+        results: list[dict[str, Any] | None],
+        chunk: list[_PendingItem],
+        by_item: dict[int, dict[str, Any]],
+    ) -> None:
+        for item, (position, _, candidates, cache_key) in enumerate(chunk, 1):
+            selected = by_item.get(item)
+            account = candidates[0]
+            if selected is not None and "code" in selected:
+                # El código y el nombre salen de la candidata validada, no del texto del modelo
+                code = str(selected["code"])
+                account = next((acc for acc in candidates if acc.code == code), None)
+                if account is None:
+                    # El modelo eligió una cuenta fuera de las candidatas del ítem
+                    selected = None
+            if selected is None:
+                results[position] = {
                     "specific_code": candidates[0].code,
                     "account_name": candidates[0].name,
                     "confidence": 0.5,
-                    "explanation": f"Selección automática sin IA: {candidates[0].name}",
+                    "explanation": f"Error en IA, usando: {candidates[0].name}",
                 }
-            return {
-                "specific_code": generic_code,
-                "account_name": "Cuenta genérica",
-                "confidence": 0.3,
-                "explanation": "No se encontró cuenta específica",
-            }
-        
-        # Obtener candidatos que empiecen con el código genérico
-        candidates = self.get_accounts_by_prefix(accounts, generic_code)
-        
-        if not candidates:
-            return {
-                "specific_code": generic_code,
-                "account_name": "Cuenta genérica",
-                "confidence": 0.3,
-                "explanation": "No hay cuentas específicas disponibles",
-            }
-        
-        if len(candidates) == 1:
-            # Solo hay una opción
-            return {
-                "specific_code": candidates[0].code,
-                "account_name": candidates[0].name,
-                "confidence": 0.9,
-                "explanation": f"Única cuenta disponible: {candidates[0].name}",
-            }
-        
-        # Usar IA para seleccionar la más apropiada
+            else:
+                results[position] = {
+                    "specific_code": account.code,
+                    "account_name": account.name,
+                    "confidence": selected.get("confidence", 0.7),
+                    "explanation": selected.get("explanation", "Selección por IA"),
+                }
+                if cache_key:
+                    self._mapping_cache.set(cache_key, dict(results[position]))
+
+    def _select_with_ai(self, owner_id: str, pending: list[_PendingItem]) -> dict[int, dict[str, Any]]:
+        """Una sola llamada a Gemini para todos los ítems; devuelve la selección por número de ítem."""
+        # Cada selección se reconoce en cuanto el modelo cierra su objeto
+        scanner = JSONObjectStream()
+        received: list[str] = []
+        streamed: list[dict[str, Any]] = []
         try:
-            prompt = self._build_mapping_prompt(generic_code, description, rationale, candidates)
-            model = genai.GenerativeModel("gemini-2.5-flash")
-            response = model.generate_content(
-                prompt,
-                generation_config=genai.types.GenerationConfig(
-                    temperature=0.1,
-                    max_output_tokens=512,
-                ),
+            model, contents = self._mapping_request(owner_id, pending)
+            stream = model.generate_content(
+                contents,
+                generation_config=_mapping_config(_MAX_TOKENS_PER_ITEM * len(pending)),
+                stream=True,
             )
             
-            text = response.text.strip()
-            
-            # Limpiar markdown si existe
-            if text.startswith("```json"):
-                text = text[7:]
-            if text.startswith("```"):
-                text = text[3:]
-            if text.endswith("```"):
-                text = text[:-3]
-            text = text.strip()
-            
-            result = json.loads(text)
-            
-            return {
-                "specific_code": result.get("code", candidates[0].code),
-                "account_name": result.get("name", candidates[0].name),
-                "confidence": result.get("confidence", 0.7),
-                "explanation": result.get("explanation", "Selección por IA"),
-            }
+            missing = set(range(1, len(pending) + 1))
+            for chunk in stream:
+                text = chunk_text(chunk)
+                received.append(text)
+                for entry in scanner.feed(text):
+                    streamed.append(entry)
+                    missing.discard(entry.get("item") if isinstance(entry, dict) else None)
+                if not missing:
+                    # Ya llegaron todas las selecciones: no se espera el resto del stream
+                    break
+            return self._selections(streamed, "".join(received))
         
         except Exception as e:
             logger.error(f"❌ Error en mapeo con IA: {e}")
-            # Fallback: devolver la primera
-            return {
-                "specific_code": candidates[0].code,
-                "account_name": candidates[0].name,
-                "confidence": 0.5,
-                "explanation": f"Error en IA, usando: {candidates[0].name}",
-            }
+            # Se conservan las selecciones que alcanzaron a llegar; el resto usará su primera candidata
+            return self._selections(streamed, "") if streamed else {}
+
+    async def _aselect_with_ai(self, owner_id: str, pending: list[_PendingItem]) -> dict[int, dict[str, Any]]:
+        """Igual que _select_with_ai, con el cliente asíncrono de Gemini."""
+        try:
+            # Crear el CachedContent del catálogo es una llamada de red bloqueante: fuera del event loop
+            model, contents = await asyncio.to_thread(self._mapping_request, owner_id, pending)
+            response = await model.generate_content_async(
+                contents,
+                generation_config=_mapping_config(_MAX_TOKENS_PER_ITEM * len(pending)),
+            )
+            text = chunk_text(response)
+            return self._selections(JSONObjectStream().feed(text), text)
+        
+        except Exception as e:
+            logger.error(f"❌ Error en mapeo con IA: {e}")
+            # Fallback: cada ítem usará su primera candidata
+            return {}
+
+    @staticmethod
+    def _selections(objects: list[dict[str, Any]], text: str) -> dict[int, dict[str, Any]]:
+        """Indexa las selecciones por número de ítem; sin objetos en array, parsea el texto completo."""
+        result: Any = objects
+        if not result:
+            # Limpiar markdown en una sola pasada
+            text = _FENCE_RE.sub("", text).strip()
+            
+            result = orjson.loads(text.encode("utf-8"))
+            if isinstance(result, dict):
+                result = [result]
+        
+        selections: dict[int, dict[str, Any]] = {}
+        for position, entry in enumerate(result, 1):
+            if not isinstance(entry, dict):
+                continue
+            try:
+                item = int(entry.get("item", position))
+            except (TypeError, ValueError):
+                # Un "item" ilegible solo descarta esa selección, no el lote completo
+                logger.warning(f"⚠️ Selección con ítem inválido ignorada: {entry.get('item')!r}")
+                continue
+            selections[item] = entry
+        return selections
     
-    def _build_mapping_prompt(
+    def _build_batch_mapping_prompt(
         self,
-        generic_code: str,
-        description: str,
-        rationale: str,
-        candidates: list[PUCAccount],
+        items: list[tuple[dict[str, Any], list[PUCAccount]]],
     ) -> str:
-        """Construye el prompt para que IA seleccione la cuenta específica"""
-        prompt_lines = [
-            "Eres un experto contador. Selecciona la cuenta PUC MÁS APROPIADA para esta transacción.",
-            "",
-            f"CÓDIGO GENÉRICO: {generic_code}",
-            f"DESCRIPCIÓN: {description}",
-            f"JUSTIFICACIÓN: {rationale}",
-            "",
-            "CUENTAS DISPONIBLES:",
-        ]
-        
-        for idx, acc in enumerate(candidates[:20], 1):  # Limitar a 20 para no exceder tokens
-            prompt_lines.append(f"{idx}. {acc.code} - {acc.name} ({acc.category})")
-        
-        prompt_lines.extend([
-            "",
-            "RESPONDE SOLO CON JSON:",
-            '{',
-            '  "code": "11050501",',
-            '  "name": "Efectivo CL 72",',
-            '  "confidence": 0.95,',
-            '  "explanation": "Razón de la selección"',
-            '}',
-        ])
-        
-        return "\n".join(prompt_lines)
+        """Construye un único prompt numerado para seleccionar la cuenta de cada ítem"""
+        # Ítems con el mismo código genérico comparten candidatas: se listan una sola vez
+        groups: dict[str, list[tuple[PUCAccount, ...]]] = {}
+        for request, candidates in items:
+            groups.setdefault(request["generic_code"], []).append(tuple(self._rank_candidates(request, candidates)))
+
+
+        blocks = "\n".join(_candidate_block(code, tuple(groups[code])) for code in sorted(groups))
+        return _BATCH_PROMPT_HEADER + blocks + self._items_block(items)
+
+    @staticmethod
+    def _items_block(items: list[tuple[dict[str, Any], list[PUCAccount]]]) -> str:
+        """Parte variable del prompt: siempre al final, después de instrucciones y cuentas."""
+        return "\n".join(
+            _ITEM_TEMPLATE.format(
+                item=item,
+                generic_code=request["generic_code"],
+                description=request.get("description", ""),
+                rationale=(request.get("rationale") or "")[:_RATIONALE_MAX_CHARS],
+            )
+            for item, (request, _) in enumerate(items, 1)
+        )
+
+    def _mapping_request(self, owner_id: str, pending: list[_PendingItem]) -> tuple[Any, str]:
+        """
+        Modelo y contenido a enviar. Si el catálogo completo del owner está cacheado
+        en Gemini como prefijo, solo viajan los ítems; si no, el prompt completo.
+        """
+        items = [(request, candidates) for _, request, candidates, _ in pending]
+        with self._accounts_lock:
+            entry = self._accounts_cache.get(owner_id)
+        if entry is not None:
+            if entry.catalog_prefix is None:
+                entry.catalog_prefix = self._catalog_prefix(entry.accounts)
+            cached_model = self._prefix_models.get(entry.catalog_prefix)
+            if cached_model is not None:
+                return cached_model, self._items_block(items).lstrip("\n")
+        return self._model, self._build_batch_mapping_prompt(items)
+
+    @staticmethod
+    def _catalog_prefix(accounts: list[PUCAccount]) -> str:
+        """Prefijo estable por owner: instrucciones y todas sus cuentas, ordenadas por código."""
+        lines = [_MAPPING_INSTRUCTIONS, "", "CUENTAS DISPONIBLES DEL PUC DE LA EMPRESA:"]
+        lines.extend(
+            f"{acc.code} - {acc.name} ({acc.category})"
+            for acc in sorted({acc.code: acc for acc in accounts}.values(), key=lambda acc: acc.code)
+        )
+        return "\n".join(lines) + "\n"
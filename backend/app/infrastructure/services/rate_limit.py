@@ -0,0 +1,70 @@
+from __future__ import annotations
+
+from threading import Condition
+import time
+
+
+class TokenBucket:
+    """
+    Cubeta de tokens segura entre hilos para respetar cuotas por minuto (RPM/TPM).
+    `acquire` bloquea al hilo llamador hasta que haya saldo; `refund` devuelve
+    la diferencia entre lo estimado y lo consumido realmente.
+    """
+
+    def __init__(self, per_minute: float) -> None:
+        self._capacity = float(per_minute)
+        self._rate = self._capacity / 60.0
+        self._available = self._capacity
+        self._updated_at = time.monotonic()
+        self._condition = Condition()
+
+    @property
+    def capacity(self) -> float:
+        return self._capacity
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self._available = min(self._capacity, self._available + (now - self._updated_at) * self._rate)
+        self._updated_at = now
+
+    def acquire(self, amount: float = 1.0) -> None:
+        # Una petición mayor que la cubeta nunca cabría: se limita a la capacidad
+        amount = min(float(amount), self._capacity)
+        with self._condition:
+            self._refill()
+            while self._available < amount:
+                self._condition.wait((amount - self._available) / self._rate)
+                self._refill()
+            self._available -= amount
+
+    def refund(self, amount: float) -> None:
+        """Ajusta el saldo: positivo devuelve tokens sobrantes, negativo cobra el exceso."""
+        if not amount:
+            return
+        with self._condition:
+            self._refill()
+            self._available = min(self._capacity, self._available + amount)
+            self._condition.notify_all()
+
+
+class GeminiRateLimiter:
+    """Combina las cuotas de peticiones y de tokens por minuto de Gemini."""
+
+    def __init__(self, requests_per_minute: float, tokens_per_minute: float) -> None:
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+
+    @staticmethod
+    def estimate_tokens(prompt: str, max_output_tokens: int = 0) -> int:
+        # ~4 caracteres por token en español/JSON, más la salida reservada
+        return len(prompt) // 4 + max_output_tokens
+
+    def acquire(self, estimated_tokens: int) -> None:
+        self.requests.acquire()
+        self.tokens.acquire(estimated_tokens)
+
+    def settle(self, estimated_tokens: int, usage_metadata: object) -> None:
+        """Corrige la reserva con `usage_metadata.total_token_count` de la respuesta."""
+        actual = getattr(usage_metadata, "total_token_count", None)
+        if isinstance(actual, int) and actual > 0:
+            self.tokens.refund(min(estimated_tokens, self.tokens.capacity) - actual)
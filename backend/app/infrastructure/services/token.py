@@ -1,14 +1,28 @@
+from collections import OrderedDict
 from datetime import datetime, timedelta, timezone
+from threading import Lock
 from typing import Any
+import time
 
-from jose import JWTError, jwt
+import jwt
+from jwt.exceptions import PyJWTError
 
 
 class JWTTokenService:
-    def __init__(self, secret_key: str, algorithm: str = "HS256", expires_minutes: int = 60) -> None:
+    def __init__(
+        self,
+        secret_key: str,
+        algorithm: str = "HS256",
+        expires_minutes: int = 60,
+        cache_size: int = 4096,
+    ) -> None:
         self._secret_key = secret_key
         self._algorithm = algorithm
         self._expires_minutes = expires_minutes
+        # Tokens ya verificados: token -> (payload, exp). Evita HMAC + JSON en cada petición
+        self._cache: OrderedDict[str, tuple[dict[str, Any], float]] = OrderedDict()
+        self._cache_size = cache_size
+        self._lock = Lock()
 
     def create_access_token(self, subject: str) -> str:
         expire = datetime.now(timezone.utc) + timedelta(minutes=self._expires_minutes)
@@ -16,10 +30,29 @@ class JWTTokenService:
         return jwt.encode(payload, self._secret_key, algorithm=self._algorithm)
 
     def verify_token(self, token: str) -> dict[str, Any]:
+        now = time.time()
+        with self._lock:
+            hit = self._cache.get(token)
+            if hit is not None:
+                if now < hit[1]:
+                    self._cache.move_to_end(token)
+                    return dict(hit[0])
+                # Vencido: se descarta y jwt.decode reporta la expiración
+                del self._cache[token]
+
         try:
-            return jwt.decode(token, self._secret_key, algorithms=[self._algorithm])
-        except JWTError as exc:  # pragma: no cover - defensive programming
+            payload = jwt.decode(token, self._secret_key, algorithms=[self._algorithm])
+        except PyJWTError as exc:  # pragma: no cover - defensive programming
             raise ValueError("Invalid token") from exc
 
+        # Solo se cachean tokens con vencimiento: sin "exp" serían válidos indefinidamente
+        expires_at = payload.get("exp")
+        if isinstance(expires_at, (int, float)):
+            with self._lock:
+                self._cache[token] = (dict(payload), float(expires_at))
+                while len(self._cache) > self._cache_size:
+                    self._cache.popitem(last=False)
+        return payload
+
 
 __all__ = ["JWTTokenService"]
@@ -5,7 +5,6 @@ from typing import Annotated
 from fastapi import Depends, HTTPException, Request, status
 from fastapi.security import HTTPAuthorizationCredentials, HTTPBearer
 
-from app.config.security import resolve_user_from_token
 from app.domain import User
 
 # Define el esquema de seguridad Bearer para Swagger
@@ -13,33 +12,18 @@ security = HTTPBearer(auto_error=False)
 
 
 def _get_user_from_state(request: Request) -> User | None:
+    # AuthenticationMiddleware es el único punto que verifica el token
     user = getattr(request.state, "user", None)
     if isinstance(user, User):
         return user
     return None
 
 
-def _resolve_user_from_request(request: Request) -> User | None:
-    user = _get_user_from_state(request)
-    if user is not None:
-        return user
-
-    authorization = request.headers.get("Authorization", "")
-    if authorization.startswith("Bearer "):
-        token = authorization[len("Bearer ") :].strip()
-        if token:
-            user = resolve_user_from_token(token)
-            if user is not None:
-                request.state.user = user
-                return user
-    return None
-
-
 def require_authenticated_user(
     request: Request,
     credentials: HTTPAuthorizationCredentials | None = Depends(security),
 ) -> User:
-    user = _resolve_user_from_request(request)
+    user = _get_user_from_state(request)
     if user is None:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
@@ -53,7 +37,7 @@ def get_optional_user(
     request: Request,
     credentials: HTTPAuthorizationCredentials | None = Depends(security),
 ) -> User | None:
-    return _resolve_user_from_request(request)
+    return _get_user_from_state(request)
 
 
 AuthenticatedUser = Annotated[User, Depends(require_authenticated_user)]
@@ -1,29 +1,36 @@
 from __future__ import annotations
 
-from typing import Awaitable, Callable
-
-from fastapi import Request
-from starlette.middleware.base import BaseHTTPMiddleware
-from starlette.responses import Response
+from starlette.types import ASGIApp, Receive, Scope, Send
 
 from app.config.security import resolve_user_from_token
 
-
-class AuthenticationMiddleware(BaseHTTPMiddleware):
-    async def dispatch(
-        self,
-        request: Request,
-        call_next: Callable[[Request], Awaitable[Response]],
-    ) -> Response:
-        authorization = request.headers.get("Authorization", "")
-        if authorization.startswith("Bearer "):
-            token = authorization[len("Bearer ") :].strip()
-            if token:
-                user = resolve_user_from_token(token)
-                if user is not None:
-                    request.state.user = user
-
-        return await call_next(request)
+_BEARER_PREFIX = b"Bearer "
+
+
+class AuthenticationMiddleware:
+    """
+    Middleware ASGI puro: lee `Authorization` directamente de `scope["headers"]`
+    y deja el usuario en `scope["state"]`, sin el task group ni el stream de memoria
+    que añade `BaseHTTPMiddleware` en cada petición.
+    """
+
+    def __init__(self, app: ASGIApp) -> None:
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] == "http":
+            for name, value in scope.get("headers", ()):
+                if name != b"authorization":
+                    continue
+                if value.startswith(_BEARER_PREFIX):
+                    token = value[len(_BEARER_PREFIX) :].decode("latin-1").strip()
+                    if token:
+                        user = resolve_user_from_token(token)
+                        if user is not None:
+                            scope.setdefault("state", {})["user"] = user
+                break
+
+        await self.app(scope, receive, send)
 
 
 __all__ = ["AuthenticationMiddleware"]
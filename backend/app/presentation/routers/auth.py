@@ -1,3 +1,5 @@
+import asyncio
+
 from fastapi import APIRouter, Depends, HTTPException, status
 
 from app.application.use_cases.auth import InvalidCredentialsError, UserAlreadyExistsError
@@ -17,24 +19,25 @@ router = APIRouter(prefix="/auth", tags=["auth"])
 
 
 @router.post("/register", response_model=UserResponse, status_code=status.HTTP_201_CREATED)
-def register_user(
+async def register_user(
     payload: RegisterRequest,
     use_case=Depends(get_register_user_use_case),
 ):
     try:
-        user = use_case.execute(email=payload.email, password=payload.password)
+        # bcrypt y Firestore son bloqueantes: fuera del event loop, igual que en facturas
+        user = await asyncio.to_thread(use_case.execute, email=payload.email, password=payload.password)
     except UserAlreadyExistsError as exc:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Email already registered") from exc
     return UserResponse.model_validate(user, from_attributes=True)
 
 
 @router.post("/login", response_model=TokenResponse)
-def login(
+async def login(
     payload: LoginRequest,
     use_case=Depends(get_authenticate_user_use_case),
 ):
     try:
-        user, token = use_case.execute(email=payload.email, password=payload.password)
+        user, token = await asyncio.to_thread(use_case.execute, email=payload.email, password=payload.password)
     except InvalidCredentialsError as exc:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid email or password") from exc
 
@@ -1,4 +1,4 @@
-from io import BytesIO
+import asyncio
 
 from fastapi import APIRouter, BackgroundTasks, Depends, File, HTTPException, UploadFile, status
 from fastapi.responses import StreamingResponse
@@ -16,6 +16,7 @@ from app.config.dependencies import (
     get_list_invoices_use_case,
     get_generate_accounting_suggestions_use_case,
     get_export_invoices_use_case,
+    get_settings,
     get_upload_invoice_use_case,
 )
 from app.presentation.schemas.invoices import (
@@ -27,13 +28,42 @@ from app.presentation.dependencies.security import AuthenticatedUser
 
 router = APIRouter(prefix="/invoices", tags=["invoices"])
 
+_UPLOAD_CHUNK_BYTES = 64 * 1024
+_XML_CONTENT_TYPES = frozenset({"application/xml", "text/xml"})
+# Un XML (la declaración <?xml es opcional) empieza por "<" tras un BOM o espacios;
+# los BOM UTF-16 se dejan pasar para que el parser decida
+_UTF8_BOM = b"\xef\xbb\xbf"
+_UTF16_BOMS = (b"\xff\xfe", b"\xfe\xff")
+_SNIFF_BYTES = 64
+
+
+def _looks_like_xml(head: bytes) -> bool:
+    if head.startswith(_UTF16_BOMS):
+        return True
+    head = head.removeprefix(_UTF8_BOM).lstrip()
+    # Vacío: se deja al caso de uso, que responde "El archivo está vacío"
+    return not head or head.startswith(b"<")
+
+
+async def _read_capped(file: UploadFile, max_bytes: int) -> bytes:
+    """Lee el archivo por bloques y corta con 413 apenas supera `max_bytes`."""
+    buffer = bytearray()
+    while chunk := await file.read(_UPLOAD_CHUNK_BYTES):
+        buffer.extend(chunk)
+        if len(buffer) > max_bytes:
+            raise HTTPException(
+                status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                detail="El archivo XML supera el tamaño máximo permitido",
+            )
+    return bytes(buffer)
+
 
 @router.get("", response_model=list[InvoiceSummaryResponse])
 async def list_invoices(
     current_user: AuthenticatedUser,
     use_case: ListInvoices = Depends(get_list_invoices_use_case),
 ) -> list[InvoiceSummaryResponse]:
-    items = use_case.execute(owner_id=current_user.id)
+    items = await asyncio.to_thread(use_case.execute, owner_id=current_user.id)
     return [InvoiceSummaryResponse.from_domain(item.invoice, status=item.status) for item in items]
 
 
@@ -45,13 +75,21 @@ async def upload_invoice(
     use_case=Depends(get_upload_invoice_use_case),
     generate_suggestions_use_case: GenerateAccountingSuggestions = Depends(get_generate_accounting_suggestions_use_case),
 ):
-    if file.content_type not in {"application/xml", "text/xml"}:
+    if file.content_type not in _XML_CONTENT_TYPES:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Solo se permiten archivos XML")
 
-    content = await file.read()
+    # Rechazo temprano de binarios disfrazados, antes de leer el resto o invocar al parser
+    head = await file.read(_SNIFF_BYTES)
+    if not _looks_like_xml(head):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="El archivo no es un XML válido")
+    await file.seek(0)
+
+    content = await _read_capped(file, get_settings().max_invoice_upload_bytes)
 
     try:
-        invoice = use_case.execute(
+        # Parseo del XML y escritura en Firestore: fuera del event loop
+        invoice = await asyncio.to_thread(
+            use_case.execute,
             owner_id=current_user.id,
             filename=file.filename or "factura.xml",
             content=content,
@@ -63,7 +101,7 @@ async def upload_invoice(
 
     # Disparar generación de sugerencias en segundo plano
     background_tasks.add_task(
-        generate_suggestions_use_case.execute,
+        generate_suggestions_use_case.aexecute,
         owner_id=current_user.id,
         invoice_id=invoice.id,
     )
@@ -77,11 +115,11 @@ async def export_invoices(
     use_case=Depends(get_export_invoices_use_case),
 ):
     try:
-        payload = use_case.execute(owner_id=current_user.id)
+        # El libro se arma fuera del event loop; la respuesta lo lee por bloques
+        stream = await asyncio.to_thread(use_case.execute_iter, owner_id=current_user.id)
     except NoInvoicesToExportError as exc:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=str(exc)) from exc
 
-    stream = BytesIO(payload)
     headers = {"Content-Disposition": 'attachment; filename="facturas.xlsx"'}
     return StreamingResponse(
         stream,
@@ -101,14 +139,14 @@ async def get_suggestions(
     Si no hay sugerencias, retorna lista vacía.
     """
     try:
-        detail = detail_use_case.execute(owner_id=current_user.id, invoice_id=invoice_id)
+        detail = await asyncio.to_thread(detail_use_case.execute, owner_id=current_user.id, invoice_id=invoice_id)
     except InvoiceNotFoundError as exc:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=str(exc)) from exc
     
     # GetInvoiceDetail ya carga las sugerencias del repositorio
     from app.config.dependencies import get_ai_suggestion_repository
     suggestion_repo = get_ai_suggestion_repository()
-    suggestions = suggestion_repo.list_for_invoice(invoice_id)
+    suggestions = await asyncio.to_thread(suggestion_repo.list_for_invoice, invoice_id)
     
     return AccountingSuggestionsResponse.from_domain(invoice_id=invoice_id, suggestions=suggestions)
 
@@ -124,7 +162,7 @@ async def regenerate_suggestions(
     Usar este endpoint cuando el usuario haga clic en "Recalcular".
     """
     try:
-        suggestions = use_case.execute(owner_id=current_user.id, invoice_id=invoice_id)
+        suggestions = await use_case.aexecute(owner_id=current_user.id, invoice_id=invoice_id)
     except InvoiceNotFoundError as exc:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=str(exc)) from exc
 
@@ -138,7 +176,7 @@ async def get_invoice(
     use_case=Depends(get_invoice_detail_use_case),
 ):
     try:
-        detail = use_case.execute(owner_id=current_user.id, invoice_id=invoice_id)
+        detail = await asyncio.to_thread(use_case.execute, owner_id=current_user.id, invoice_id=invoice_id)
     except InvoiceNotFoundError as exc:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=str(exc)) from exc
 
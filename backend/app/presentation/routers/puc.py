@@ -1,7 +1,14 @@
 """
 Router de PUC (Plan Único de Cuentas) personalizado por empresa.
 """
+import asyncio
+import tempfile
+from itertools import islice
+from pathlib import Path
+from typing import Iterator
+
 from fastapi import APIRouter, Depends, File, HTTPException, Query, UploadFile, status
+from fastapi.responses import StreamingResponse
 
 from app.application.use_cases.puc import (
     GetPUCForAI,
@@ -18,7 +25,9 @@ from app.config.dependencies import (
 )
 from app.presentation.dependencies.security import AuthenticatedUser
 from app.presentation.schemas.puc import (
+    PUC_EXPORT_ADAPTER,
     PUCAccountResponse,
+    PUCExportAccount,
     PUCListResponse,
     PUCStatsResponse,
     PUCUploadResponse,
@@ -26,6 +35,39 @@ from app.presentation.schemas.puc import (
 
 router = APIRouter(prefix="/puc", tags=["puc"])
 
+_UPLOAD_CHUNK_BYTES = 64 * 1024
+_EXPORT_BATCH_ROWS = 500
+_EXCEL_CONTENT_TYPES = frozenset({
+    "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+    "application/vnd.ms-excel",
+})
+# Firmas de .xlsx (ZIP) y .xls (OLE2): cualquier otra cosa fallaría igual en el parser
+_EXCEL_MAGICS = (b"PK\x03\x04", b"PK\x05\x06", b"\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1")
+
+
+async def _spool_to_disk(file: UploadFile) -> Path:
+    """Copia la subida a un archivo temporal en bloques, sin materializarla en un solo bytes."""
+    with tempfile.NamedTemporaryFile(prefix="puc-", delete=False) as tmp:
+        try:
+            while chunk := await file.read(_UPLOAD_CHUNK_BYTES):
+                tmp.write(chunk)
+        except BaseException:
+            tmp.close()
+            Path(tmp.name).unlink(missing_ok=True)
+            raise
+    return Path(tmp.name)
+
+
+def _iter_json_array(rows: Iterator[dict], batch_size: int = _EXPORT_BATCH_ROWS) -> Iterator[bytes]:
+    """Emite un arreglo JSON por lotes de filas: memoria constante y primer byte inmediato."""
+    yield b"["
+    separator = b""
+    while batch := list(islice(rows, batch_size)):
+        # dump_json del lote devuelve "[...]": se quitan los corchetes y se encadena
+        yield separator + PUC_EXPORT_ADAPTER.dump_json(batch)[1:-1]
+        separator = b","
+    yield b"]"
+
 
 @router.post("/upload", response_model=PUCUploadResponse, status_code=status.HTTP_201_CREATED)
 async def upload_puc(
@@ -50,22 +92,28 @@ async def upload_puc(
     **Nota:** Este endpoint reemplazará cualquier PUC previamente cargado.
     """
     # Validar tipo de archivo
-    if file.content_type not in {
-        "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-        "application/vnd.ms-excel",
-    }:
+    if file.content_type not in _EXCEL_CONTENT_TYPES:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="Solo se permiten archivos Excel (.xlsx o .xls)",
         )
     
-    # Leer contenido del archivo
-    content = await file.read()
+    # Validar la firma antes de volcar a disco y de invocar al parser
+    head = await file.read(8)
+    if not head.startswith(_EXCEL_MAGICS):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="El archivo no parece ser un Excel válido (.xlsx o .xls)",
+        )
+    await file.seek(0)
+    
+    # Volcar la subida a disco por bloques: el parser la lee desde el archivo
+    spooled_path = await _spool_to_disk(file)
     
     try:
-        result = use_case.execute(
+        result = await use_case.aexecute(
             owner_id=current_user.id,
-            file_content=content,
+            file_content=spooled_path,
             filename=file.filename or "puc.xlsx",
         )
         
@@ -76,6 +124,8 @@ async def upload_puc(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail=str(exc),
         ) from exc
+    finally:
+        spooled_path.unlink(missing_ok=True)
 
 
 @router.get("", response_model=PUCListResponse)
@@ -94,14 +144,15 @@ async def list_puc(
     - **page**: Número de página (inicia en 1)
     - **page_size**: Cantidad de resultados por página (1-200)
     """
-    result = use_case.execute(
+    result = await asyncio.to_thread(
+        use_case.execute,
         owner_id=current_user.id,
         search=search,
         page=page,
         page_size=page_size,
     )
     
-    return PUCListResponse(
+    return PUCListResponse.model_construct(
         cuentas=[PUCAccountResponse.from_domain(acc) for acc in result["cuentas"]],
         total=result["total"],
         page=result["page"],
@@ -121,11 +172,11 @@ async def get_puc_stats(
     Útil para verificar si el usuario tiene un PUC cargado
     antes de generar sugerencias contables.
     """
-    result = use_case.execute(owner_id=current_user.id)
+    result = await asyncio.to_thread(use_case.execute, owner_id=current_user.id)
     return PUCStatsResponse(**result)
 
 
-@router.get("/export-json", response_model=list[dict])
+@router.get("/export-json", response_model=list[PUCExportAccount])
 async def export_puc_for_ai(
     current_user: AuthenticatedUser,
     use_case: GetPUCForAI = Depends(get_puc_for_ai_use_case),
@@ -139,4 +190,8 @@ async def export_puc_for_ai(
     **Nota:** Este endpoint puede retornar una gran cantidad de datos
     dependiendo del tamaño del PUC.
     """
-    return use_case.execute(owner_id=current_user.id)
+    # El iterador es síncrono (cursor de Firestore): Starlette lo consume en el threadpool
+    return StreamingResponse(
+        _iter_json_array(use_case.iter_accounts(current_user.id)),
+        media_type="application/json",
+    )
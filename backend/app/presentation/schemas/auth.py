@@ -1,31 +1,28 @@
 from datetime import datetime
+from typing import Annotated
 
-from pydantic import BaseModel, ConfigDict, field_validator
+from pydantic import AfterValidator, BaseModel, ConfigDict
+
+
+def _validate_email(value: str) -> str:
+    if "@" not in value:
+        raise ValueError("Correo inválido")
+    return value
+
+
+# Validación compartida por registro y login, compilada una sola vez en el esquema
+EmailAddress = Annotated[str, AfterValidator(_validate_email)]
 
 
 class RegisterRequest(BaseModel):
-    email: str
+    email: EmailAddress
     password: str
 
-    @field_validator("email")
-    @classmethod
-    def validate_email(cls, value: str) -> str:
-        if "@" not in value:
-            raise ValueError("Correo inválido")
-        return value
-
 
 class LoginRequest(BaseModel):
-    email: str
+    email: EmailAddress
     password: str
 
-    @field_validator("email")
-    @classmethod
-    def validate_email(cls, value: str) -> str:
-        if "@" not in value:
-            raise ValueError("Correo inválido")
-        return value
-
 
 class UserResponse(BaseModel):
     model_config = ConfigDict(from_attributes=True)
@@ -2,11 +2,21 @@ from datetime import date
 from decimal import Decimal
 
 from pydantic import BaseModel
+from typing_extensions import TypedDict
 
 from app.domain import AISuggestion, Invoice, InvoiceLine
 
+# Los from_domain usan model_construct: los datos ya vienen tipados del dominio, así que
+# no se validan campo a campo; FastAPI acepta la instancia tal cual y la serializa en Rust.
+
+
+class InvoiceLineResponse(TypedDict):
+    """
+    Línea de factura como dict plano: una factura trae cientos de líneas y crear un
+    BaseModel por cada una dominaba el costo de la respuesta. Pydantic la serializa
+    igual (y la documenta igual en OpenAPI) a partir del TypedDict.
+    """
 
-class InvoiceLineResponse(BaseModel):
     line_id: str
     description: str
     quantity: Decimal
@@ -14,20 +24,20 @@ class InvoiceLineResponse(BaseModel):
     line_extension_amount: Decimal
     tax_amount: Decimal
 
-    @classmethod
-    def from_domain(cls, line: InvoiceLine) -> "InvoiceLineResponse":
-        base_amount = line.unit_price * line.quantity
-        tax_amount = line.line_extension_amount - base_amount
-        if tax_amount < Decimal("0"):
-            tax_amount = Decimal("0")
-        return cls(
-            line_id=line.line_id,
-            description=line.description,
-            quantity=line.quantity,
-            unit_price=line.unit_price,
-            line_extension_amount=line.line_extension_amount,
-            tax_amount=tax_amount,
-        )
+
+_ZERO = Decimal("0")
+
+
+def invoice_line_to_dict(line: InvoiceLine) -> InvoiceLineResponse:
+    tax_amount = line.line_extension_amount - line.unit_price * line.quantity
+    return {
+        "line_id": line.line_id,
+        "description": line.description,
+        "quantity": line.quantity,
+        "unit_price": line.unit_price,
+        "line_extension_amount": line.line_extension_amount,
+        "tax_amount": tax_amount if tax_amount >= _ZERO else _ZERO,
+    }
 
 
 class InvoiceSummaryResponse(BaseModel):
@@ -41,7 +51,7 @@ class InvoiceSummaryResponse(BaseModel):
 
     @classmethod
     def from_domain(cls, invoice: Invoice, *, status: str) -> "InvoiceSummaryResponse":
-        return cls(
+        return cls.model_construct(
             id=invoice.id,
             external_id=invoice.external_id,
             issue_date=invoice.issue_date,
@@ -69,9 +79,9 @@ class InvoiceDetailResponse(InvoiceSummaryResponse):
     @classmethod
     def from_domain(cls, invoice: Invoice, *, status: str) -> "InvoiceDetailResponse":
         taxes: list[InvoiceTaxResponse] = []
-        if invoice.tax_amount > Decimal("0"):
-            taxes.append(InvoiceTaxResponse(type="IVA", amount=invoice.tax_amount))
-        return cls(
+        if invoice.tax_amount > _ZERO:
+            taxes.append(InvoiceTaxResponse.model_construct(type="IVA", amount=invoice.tax_amount))
+        return cls.model_construct(
             id=invoice.id,
             external_id=invoice.external_id,
             issue_date=invoice.issue_date,
@@ -84,7 +94,7 @@ class InvoiceDetailResponse(InvoiceSummaryResponse):
             customer_tax_id=invoice.customer_tax_id,
             tax_amount=invoice.tax_amount,
             original_filename=invoice.original_filename,
-            lines=[InvoiceLineResponse.from_domain(line) for line in invoice.lines],
+            lines=[invoice_line_to_dict(line) for line in invoice.lines],
             taxes=taxes,
         )
 
@@ -101,7 +111,7 @@ class AISuggestionResponse(BaseModel):
 
     @classmethod
     def from_domain(cls, suggestion: AISuggestion) -> "AISuggestionResponse":
-        return cls(
+        return cls.model_construct(
             account_code=suggestion.account_code,
             rationale=suggestion.rationale,
             confidence=suggestion.confidence,
@@ -124,7 +134,7 @@ class AccountingSuggestionsResponse(BaseModel):
         invoice_id: str,
         suggestions: list[AISuggestion],
     ) -> "AccountingSuggestionsResponse":
-        return cls(
+        return cls.model_construct(
             invoice_id=invoice_id,
             suggestions=[AISuggestionResponse.from_domain(item) for item in suggestions],
         )
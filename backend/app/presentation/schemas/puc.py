@@ -4,7 +4,8 @@ Schemas para las APIs de PUC (Plan Único de Cuentas).
 from __future__ import annotations
 
 from datetime import datetime
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, TypeAdapter
+from typing_extensions import TypedDict
 
 from app.domain.puc import PUCAccount
 
@@ -26,8 +27,11 @@ class PUCAccountResponse(BaseModel):
     
     @classmethod
     def from_domain(cls, account: PUCAccount) -> "PUCAccountResponse":
-        """Convierte entidad de dominio a schema de respuesta"""
-        return cls(
+        """
+        Convierte entidad de dominio a schema de respuesta. Sin validación
+        (model_construct): la entidad ya está tipada y una página trae cientos.
+        """
+        return cls.model_construct(
             id=account.id,
             codigo=account.codigo,
             nombre=account.nombre,
@@ -64,3 +68,22 @@ class PUCStatsResponse(BaseModel):
     
     total_cuentas: int = Field(description="Total de cuentas PUC del usuario")
     tiene_puc: bool = Field(description="Indica si el usuario tiene PUC cargado")
+
+
+class PUCExportAccount(TypedDict):
+    """Cuenta PUC tal como la exporta /puc/export-json (contexto para la IA)"""
+
+    codigo: str
+    nombre: str
+    categoria: str
+    clase: str
+    relacion_con: str
+    maneja_vencimientos: str
+    diferencia_fiscal: str
+    activo: str
+    nivel_agrupacion: str
+
+
+# Adaptador construido una sola vez al importar: el export puede traer miles de cuentas y
+# se serializa directo a JSON, sin la copia/validación de cada dict que haría FastAPI.
+PUC_EXPORT_ADAPTER = TypeAdapter(list[PUCExportAccount])
@@ -0,0 +1,19 @@
+import os
+
+# bcrypt con el costo mínimo en las pruebas: el costo de producción (12) no aporta nada aquí
+# y domina el tiempo de cada prueba que registra o autentica usuarios.
+os.environ.setdefault("PASSWORD_HASH_ROUNDS", "4")
+
+
+def pytest_configure(config) -> None:
+    # Registrada aquí para que la marca no genere advertencias cuando pytest-xdist no está instalado
+    config.addinivalue_line("markers", "xdist_group(name): ejecuta las pruebas del grupo en un mismo worker de xdist")
+
+
+def pytest_addoption(parser) -> None:
+    parser.addoption(
+        "--live-ai",
+        action="store_true",
+        default=False,
+        help="Llama a Gemini de verdad (requiere GEMINI_API_KEY) y regraba las respuestas de tests/cassettes",
+    )
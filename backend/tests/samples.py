@@ -0,0 +1,32 @@
+from functools import lru_cache
+from pathlib import Path
+from types import SimpleNamespace
+
+ASSESSMENT_FILES = Path(__file__).resolve().parents[1] / "app" / "assessment-files"
+
+
+@lru_cache(maxsize=None)
+def read_sample_xml(name: str) -> bytes:
+    """XML de ejemplo leído una sola vez por sesión de pytest (los bytes son inmutables)."""
+    return (ASSESSMENT_FILES / name).read_bytes()
+
+
+class TextlessChunk:
+    """Fragmento de streaming sin partes de texto: `text` lanza ValueError como en el SDK."""
+
+    @property
+    def text(self) -> str:
+        raise ValueError("El fragmento no tiene partes de texto")
+
+
+class FailingStreamModel:
+    """Modelo cuyo stream entrega `text` y luego se corta con un error de conexión."""
+
+    def __init__(self, text: str) -> None:
+        self.text = text
+        self.calls = 0
+
+    def generate_content(self, prompt, generation_config=None, stream=False):
+        self.calls += 1
+        yield SimpleNamespace(text=self.text)
+        raise RuntimeError("conexión interrumpida")
@@ -0,0 +1,369 @@
+from types import SimpleNamespace
+
+import pytest
+
+from app.infrastructure.services.ai import (
+    _INVOICE_HEADER,
+    GeminiAISuggestionService,
+    _generation_config,
+    _output_token_budget,
+)
+from app.infrastructure.services.gemini_common import CachedPrefixModels
+from tests.samples import FailingStreamModel
+
+
+@pytest.fixture
+def anyio_backend() -> str:
+    return "asyncio"
+
+
+def build_payload(*descriptions: str) -> dict[str, object]:
+    return {
+        "external_id": "FE-1",
+        "supplier": {"name": "Proveedor", "tax_id": "900"},
+        "customer": {"name": "Cliente", "tax_id": "800"},
+        "currency": "COP",
+        "total_amount": 1000.0,
+        "lines": [
+            {"description": description, "amount": 100.0, "quantity": 1.0}
+            for description in descriptions
+        ],
+    }
+
+
+def test_keyword_fast_path_skips_model_when_all_lines_match() -> None:
+    service = GeminiAISuggestionService(api_key="")
+
+    result = service.generate_suggestions(
+        build_payload("Servicio de RESTAURANTE ejecutivo", "Fletes terrestres Bogotá")
+    )
+
+    assert [item["line_number"] for item in result] == [1, 2]
+    assert [item["account_code"] for item in result] == ["4140", "4145"]
+    assert all(item["confidence"] > 0.5 for item in result)
+
+
+def test_keyword_fast_path_leaves_unknown_lines_unresolved() -> None:
+    service = GeminiAISuggestionService(api_key="")
+    payload = build_payload("Hospedaje en hotel", "Licencia de software")
+
+    direct, unresolved = service._prefilter(payload["lines"], service._load_puc_fallback())
+
+    assert [item["account_code"] for item in direct] == ["4140"]
+    assert unresolved == [2]
+
+
+def test_generate_suggestions_many_preserves_order() -> None:
+    service = GeminiAISuggestionService(api_key="")
+
+    result = service.generate_suggestions_many(
+        [build_payload("Arriendo local comercial"), build_payload("Honorarios contables")]
+    )
+
+    assert [[item["account_code"] for item in batch] for batch in result] == [["4220"], ["4230"]]
+
+
+def test_try_parse_json_extracts_fenced_and_embedded_payloads() -> None:
+    service = GeminiAISuggestionService(api_key="")
+
+    fenced = service._try_parse_json('```json\n[{"account_code": "4135"}]\n```')
+    embedded = service._try_parse_json('Aquí está: {"suggestions": []} listo')
+
+    assert fenced == [{"account_code": "4135"}]
+    assert embedded == {"suggestions": []}
+
+
+def test_cached_response_is_reused_for_equivalent_invoice() -> None:
+    service = GeminiAISuggestionService(api_key="")
+    payload = build_payload("Licencia de software")
+    catalog = service._catalog_entry(None)
+    cached = [{"line_number": 1, "account_code": "4135", "confidence": 0.8}]
+    service.response_cache.set(service._cache_key(payload, None, catalog), cached)
+
+    equivalent = {**payload, "external_id": "FE-2"}
+    result = service.generate_suggestions(equivalent)
+
+    assert result == cached
+    assert result[0] is not cached[0]
+
+
+def test_cache_key_uses_the_catalog_fingerprint() -> None:
+    service = GeminiAISuggestionService(api_key="", puc_repository=LargePUCRepository())
+    payload = build_payload("Licencia de software")
+    catalog = service._catalog_entry("owner-large")
+    changed = service._catalog_entry(None)
+
+    assert catalog.fingerprint == service._catalog_fingerprint(catalog.accounts)
+    assert service._cache_key(payload, "owner-large", catalog) == service._cache_key(payload, "owner-large", catalog)
+    assert service._cache_key(payload, "owner-large", catalog) != service._cache_key(payload, "owner-large", changed)
+
+
+def test_batch_prompt_renders_catalog_once_for_all_invoices() -> None:
+    service = GeminiAISuggestionService(api_key="")
+    catalog = service._load_puc_fallback()
+    first = build_payload("Licencia de software")
+    second = build_payload("Soporte técnico", "Capacitación")
+
+    prompt = service._build_batch_prompt([(first, set()), (second, {2})], catalog)
+
+    assert "FACTURA 1:" in prompt and "FACTURA 2:" in prompt
+    assert prompt.count("CATÁLOGO COMPLETO de cuentas PUC") == 1
+    assert '"Capacitación"' not in prompt
+    assert '"invoice_index": 1' in prompt
+
+
+def test_parse_batch_response_groups_by_invoice_index() -> None:
+    service = GeminiAISuggestionService(api_key="")
+
+    grouped = service._parse_batch_response(
+        '[{"invoice_index": 2, "suggestions": [{"line_number": 1, "account_code": "4135"}]}]'
+    )
+
+    assert grouped == {2: [{"line_number": 1, "account_code": "4135"}]}
+
+
+@pytest.mark.anyio
+async def test_agenerate_suggestions_many_runs_concurrently() -> None:
+    service = GeminiAISuggestionService(api_key="")
+
+    result = await service.agenerate_suggestions_many(
+        [build_payload("Transporte de carga"), build_payload("Comisiones por ventas")],
+        concurrency=2,
+    )
+
+    assert [[item["account_code"] for item in batch] for batch in result] == [["4145"], ["4225"]]
+
+
+class CountingPUCRepository:
+    def __init__(self) -> None:
+        self.calls = 0
+
+    def iter_projection(self, owner_id, fields=()):
+        self.calls += 1
+        yield {"id": "acc-1", "codigo": "41350501", "nombre": "Venta de equipos"}
+
+
+def test_owner_catalog_is_cached_until_invalidated() -> None:
+    repository = CountingPUCRepository()
+    service = GeminiAISuggestionService(api_key="", puc_repository=repository)
+
+    first = service._catalog_entry("owner-1")
+    second = service._catalog_entry("owner-1")
+    service.invalidate("owner-1")
+    service._catalog_entry("owner-1")
+
+    assert first is second
+    assert repository.calls == 2
+    assert '"codigo":"41350501"' in first.puc_json
+
+
+class FlakyPUCRepository:
+    def __init__(self) -> None:
+        self.calls = 0
+
+    def iter_projection(self, owner_id, fields=()):
+        self.calls += 1
+        if self.calls == 1:
+            raise RuntimeError("deadline exceeded")
+        yield {"id": "acc-1", "codigo": "41350501", "nombre": "Venta de equipos"}
+
+
+def test_repository_error_fallback_is_not_cached() -> None:
+    repository = FlakyPUCRepository()
+    service = GeminiAISuggestionService(api_key="", puc_repository=repository)
+
+    first = service._catalog_entry("owner-1")
+    second = service._catalog_entry("owner-1")
+
+    assert '"codigo":"41350501"' not in first.puc_json
+    assert '"codigo":"41350501"' in second.puc_json
+    assert repository.calls == 2
+
+
+class LargePUCRepository:
+    def iter_projection(self, owner_id, fields=()):
+        for idx in range(300):
+            yield {"id": f"acc-{idx}", "codigo": f"4135{idx:04d}", "nombre": f"Venta de mercancía {idx}"}
+        yield {"id": "acc-sw", "codigo": "41359999", "nombre": "Licencias de software"}
+        yield {"id": "acc-misc", "codigo": "42950501", "nombre": "Ingresos diversos"}
+
+
+def test_large_catalog_is_trimmed_to_relevant_accounts() -> None:
+    service = GeminiAISuggestionService(api_key="", puc_repository=LargePUCRepository())
+    catalog = service._catalog_entry("owner-large")
+
+    relevant = service._relevant_accounts(catalog, [build_payload("Renovación licencia software contable")])
+
+    codes = {account["codigo"] for account in relevant}
+    assert "41359999" in codes
+    assert "42950501" in codes
+    assert len(relevant) <= 60
+    assert "MÁS RELEVANTES" in service._catalog_block(relevant, trimmed=True)
+    assert "CATÁLOGO COMPLETO" in catalog.prompt_block
+
+
+class UnrelatedPUCRepository:
+    def iter_projection(self, owner_id, fields=()):
+        for idx in range(300):
+            yield {"id": f"acc-{idx}", "codigo": f"4135{idx:04d}", "nombre": f"Venta de mercancía {idx}"}
+
+
+def test_large_catalog_without_overlap_is_sent_in_full() -> None:
+    service = GeminiAISuggestionService(api_key="", puc_repository=UnrelatedPUCRepository())
+    catalog = service._catalog_entry("owner-unrelated")
+
+    relevant = service._relevant_accounts(catalog, [build_payload("Licencia software anual")])
+
+    assert relevant is None
+    assert "No se ha cargado un PUC personalizado" not in catalog.prompt_block
+
+
+class StreamingModelStub:
+    def __init__(self, chunks: list[str]) -> None:
+        self.chunks = chunks
+
+    def generate_content(self, prompt, generation_config=None, stream=False):
+        return [SimpleNamespace(text=chunk) for chunk in self.chunks]
+
+
+def test_iter_suggestions_yields_objects_as_chunks_arrive() -> None:
+    service = GeminiAISuggestionService(api_key="")
+    service._initialized = True
+    service._model = StreamingModelStub(
+        ['[{"line_number": 1, "account_code": "41', '35", "rationale": "a {b}"},', ' {"line_number": 2, "account_code": "4295"}]']
+    )
+
+    stream = service.iter_suggestions(build_payload("Licencia de software", "Soporte"))
+    first = next(stream)
+
+    assert first["account_code"] == "4135"
+    assert [item["account_code"] for item in stream] == ["4295"]
+
+
+def test_parse_from_text_reads_pipe_separated_lines() -> None:
+    service = GeminiAISuggestionService(api_key="")
+
+    result = list(service._parse_from_text("- 4135 | Venta de bienes | 0.9\nsin formato\n4295 | | alta"))
+
+    assert result == [
+        {"account_code": "4135", "rationale": "Venta de bienes", "confidence": 0.9},
+        {"account_code": "4295"},
+    ]
+
+
+def test_generation_config_uses_json_mode_and_scales_with_lines() -> None:
+    config = _generation_config(_output_token_budget(2), batch=False)
+
+    assert config.response_mime_type == "application/json"
+    assert config.max_output_tokens == 1536
+    assert _output_token_budget(100) == 8192
+
+
+def test_prompt_keeps_invoice_after_the_shared_prefix() -> None:
+    service = GeminiAISuggestionService(api_key="")
+    catalog = service._catalog_entry(None)
+
+    first = service._build_prompt(build_payload("Licencia de software"), catalog.accounts, catalog_block=catalog.prompt_block)
+    second = service._build_prompt(build_payload("Soporte técnico"), catalog.accounts, catalog_block=catalog.prompt_block)
+    prefix = service._prompt_prefix(catalog.prompt_block)
+
+    assert first.startswith(prefix) and second.startswith(prefix)
+    assert "Licencia de software" in first[len(prefix):]
+
+
+def test_repeated_lines_are_sent_once_and_broadcast_back() -> None:
+    service = GeminiAISuggestionService(api_key="")
+    service._initialized = True
+    service._model = StreamingModelStub(['[{"line_number": 1, "account_code": "4135"}, {"line_number": 2, "account_code": "4295"}]'])
+    payload = build_payload("Licencia de software", "Soporte", "LICENCIA DE SOFTWARE")
+
+    prompt = service._build_prompt(payload, [])
+    result = list(service.iter_suggestions(payload))
+
+    assert prompt.count("Licencia de software") == 1
+    assert '"Licencia de software" - $200.00 (x2)' in prompt
+    assert sorted((item["line_number"], item["account_code"]) for item in result) == [
+        (1, "4135"),
+        (2, "4295"),
+        (3, "4135"),
+    ]
+
+
+def test_services_with_same_key_share_one_model_client() -> None:
+    first = GeminiAISuggestionService(api_key="test-key")
+    second = GeminiAISuggestionService(api_key="test-key")
+
+    assert first._initialized and second._initialized
+    assert first._model is second._model
+
+
+class RecordingStreamModel(StreamingModelStub):
+    def __init__(self, chunks: list[str]) -> None:
+        super().__init__(chunks)
+        self.contents: list[str] = []
+
+    def generate_content(self, prompt, generation_config=None, stream=False):
+        self.contents.append(prompt)
+        return super().generate_content(prompt, generation_config, stream)
+
+
+class RecordingRateLimiter:
+    def __init__(self) -> None:
+        self.settled: list[int] = []
+
+    def estimate_tokens(self, prompt, max_output_tokens=0):
+        return 100
+
+    def acquire(self, estimated_tokens):
+        pass
+
+    def settle(self, estimated_tokens, usage_metadata):
+        self.settled.append(estimated_tokens)
+
+
+def test_truncated_stream_is_not_cached() -> None:
+    service = GeminiAISuggestionService(api_key="", rate_limiter=RecordingRateLimiter())
+    service._initialized = True
+    service._model = FailingStreamModel('[{"line_number": 1, "account_code": "4135"},')
+    payload = build_payload("Licencia de software", "Soporte")
+
+    first = service.generate_suggestions(payload)
+    second = service.generate_suggestions(payload)
+
+    assert [item["account_code"] for item in first] == ["4135"]
+    assert [item["account_code"] for item in second] == ["4135"]
+    assert service._model.calls == 2
+    assert service.rate_limiter.settled == [100, 100]
+
+
+def test_large_catalog_is_trimmed_when_no_prefix_cache(monkeypatch) -> None:
+    service = GeminiAISuggestionService(api_key="", puc_repository=LargePUCRepository())
+    service._initialized = True
+    service._model = RecordingStreamModel(['[{"line_number": 1, "account_code": "41359999"}]'])
+    monkeypatch.setattr(CachedPrefixModels, "get", lambda self, prefix: None)
+
+    result = service.generate_suggestions(build_payload("Renovación licencia software contable"), owner_id="owner-large")
+
+    assert [item["account_code"] for item in result] == ["41359999"]
+    assert "MÁS RELEVANTES" in service._model.contents[0]
+
+
+def test_large_catalog_uses_cached_full_prefix_instead_of_trimming(monkeypatch) -> None:
+    service = GeminiAISuggestionService(api_key="", puc_repository=LargePUCRepository())
+    service._initialized = True
+    service._model = RecordingStreamModel([])
+    cached_model = RecordingStreamModel(['[{"line_number": 1, "account_code": "41359999"}]'])
+    prefixes: list[str] = []
+
+    def get(self, prefix):
+        prefixes.append(prefix)
+        return cached_model
+
+    monkeypatch.setattr(CachedPrefixModels, "get", get)
+
+    result = service.generate_suggestions(build_payload("Renovación licencia software contable"), owner_id="owner-large")
+
+    assert [item["account_code"] for item in result] == ["41359999"]
+    assert "CATÁLOGO COMPLETO" in prefixes[0] and '"codigo":"41350000"' in prefixes[0]
+    assert service._model.contents == []
+    assert cached_model.contents[0].startswith(_INVOICE_HEADER)
@@ -0,0 +1,96 @@
+from datetime import date
+from decimal import Decimal
+from io import BytesIO
+from zipfile import ZipFile
+
+from app.domain import AISuggestion, Invoice
+from app.domain.invoices import InvoiceLine
+from app.infrastructure.services.excel_exporter import SpreadsheetInvoiceWorkbookBuilder
+
+
+def build_invoice() -> Invoice:
+    return Invoice(
+        id="inv-1",
+        owner_id="owner-1",
+        external_id="FE-100",
+        issue_date=date(2024, 5, 1),
+        supplier_name="Proveedor & Cía",
+        supplier_tax_id="900",
+        customer_name="Cliente",
+        customer_tax_id="800",
+        currency="COP",
+        total_amount=Decimal("119.00"),
+        tax_amount=Decimal("19.00"),
+        lines=(
+            InvoiceLine("1", "Licencia de software", Decimal("1"), Decimal("60"), Decimal("60")),
+            InvoiceLine("2", "Soporte técnico", Decimal("2"), Decimal("20"), Decimal("40")),
+        ),
+    )
+
+
+def build_suggestions() -> dict[str, list[AISuggestion]]:
+    return {
+        "inv-1": [
+            AISuggestion(account_code="4295", rationale="baja", confidence=0.4, line_number=1),
+            AISuggestion(account_code="4135", rationale="alta", confidence=0.9, line_number=1),
+        ]
+    }
+
+
+def read_sheets(payload: bytes) -> tuple[str, str]:
+    with ZipFile(BytesIO(payload)) as archive:
+        return (
+            archive.read("xl/worksheets/sheet1.xml").decode("utf-8"),
+            archive.read("xl/worksheets/sheet2.xml").decode("utf-8"),
+        )
+
+
+def test_workbook_contains_summary_and_best_line_suggestion() -> None:
+    builder = SpreadsheetInvoiceWorkbookBuilder()
+
+    resumen, productos = read_sheets(builder.build([build_invoice()], build_suggestions()))
+
+    assert "FE-100" in resumen and "Proveedor &amp; Cía" in resumen
+    assert "Soporte técnico" in productos
+    assert "4135" in productos and "4295" not in productos
+
+
+def test_minimal_writer_matches_sheet_layout() -> None:
+    builder = SpreadsheetInvoiceWorkbookBuilder()
+
+    buffer = BytesIO()
+    builder._write_with_minimal_writer(buffer, [build_invoice()], build_suggestions())
+    resumen, productos = read_sheets(buffer.getvalue())
+
+    assert resumen.count("<row ") == 2
+    assert productos.count("<row ") == 3
+    assert "Proveedor &amp; Cía" in resumen
+    assert "<v>0.9</v>" in productos
+
+
+def test_build_to_writes_the_same_workbook_into_a_file(tmp_path) -> None:
+    builder = SpreadsheetInvoiceWorkbookBuilder()
+    target = tmp_path / "facturas.xlsx"
+
+    with target.open("wb") as fp:
+        builder.build_to(fp, [build_invoice()], build_suggestions())
+
+    resumen, _ = read_sheets(target.read_bytes())
+    assert "FE-100" in resumen
+
+
+def test_untrusted_text_is_written_as_literal_strings() -> None:
+    invoice = build_invoice()
+    invoice.lines = (
+        InvoiceLine("1", '=HYPERLINK("http://evil.test","x")', Decimal("1"), Decimal("60"), Decimal("60")),
+        InvoiceLine("2", "https://proveedor.test/soporte", Decimal("2"), Decimal("20"), Decimal("40")),
+    )
+    payload = SpreadsheetInvoiceWorkbookBuilder().build([invoice], build_suggestions())
+
+    _, productos = read_sheets(payload)
+    with ZipFile(BytesIO(payload)) as archive:
+        names = archive.namelist()
+
+    assert "<f>" not in productos and "HYPERLINK" in productos
+    assert "<hyperlink" not in productos
+    assert not any(name.startswith("xl/worksheets/_rels/") for name in names)
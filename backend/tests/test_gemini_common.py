@@ -0,0 +1,95 @@
+import threading
+import time
+from types import SimpleNamespace
+
+from app.infrastructure.services import gemini_common
+from app.infrastructure.services.gemini_common import CachedPrefixModels, JSONObjectStream
+
+
+def test_json_object_stream_yields_objects_split_across_chunks() -> None:
+    scanner = JSONObjectStream()
+
+    first = scanner.feed('[{"item": 1, "text": "a}b"}, {"item"')
+    second = scanner.feed(': 2}]')
+
+    assert first == [{"item": 1, "text": "a}b"}]
+    assert second == [{"item": 2}]
+
+
+def test_concurrent_prefix_misses_create_one_cached_content(monkeypatch) -> None:
+    created: list[str] = []
+
+    def create(model, contents, ttl):
+        time.sleep(0.05)
+        created.append(model)
+        return SimpleNamespace(name="cache-1")
+
+    fake_genai = SimpleNamespace(
+        caching=SimpleNamespace(CachedContent=SimpleNamespace(create=create)),
+        GenerativeModel=SimpleNamespace(from_cached_content=lambda cached: cached),
+    )
+    monkeypatch.setattr(gemini_common, "genai", fake_genai)
+    cache = CachedPrefixModels("gemini-2.5-flash")
+    prefix = "x" * gemini_common.CACHED_PREFIX_MIN_CHARS
+    models: list[object] = []
+
+    threads = [threading.Thread(target=lambda: models.append(cache.get(prefix))) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(created) == 1
+    assert len(models) == 4 and all(model is models[0] for model in models)
+
+
+def fake_caching(create):
+    return SimpleNamespace(
+        caching=SimpleNamespace(CachedContent=SimpleNamespace(create=create)),
+        GenerativeModel=SimpleNamespace(from_cached_content=lambda cached: cached),
+    )
+
+
+def test_prefix_misses_for_different_catalogs_do_not_queue(monkeypatch) -> None:
+    started = threading.Barrier(2, timeout=2)
+
+    def create(model, contents, ttl):
+        # Ambas creaciones deben estar en vuelo a la vez; con un candado global esto expira
+        started.wait()
+        return SimpleNamespace(name=contents[0][:1])
+
+    monkeypatch.setattr(gemini_common, "genai", fake_caching(create))
+    cache = CachedPrefixModels("gemini-2.5-flash")
+    size = gemini_common.CACHED_PREFIX_MIN_CHARS
+    models: list[object] = []
+
+    threads = [threading.Thread(target=lambda p=p: models.append(cache.get(p * size))) for p in "ab"]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert sorted(model.name for model in models) == ["a", "b"]
+
+
+def test_failed_prefix_is_retried_after_a_short_backoff(monkeypatch) -> None:
+    attempts: list[str] = []
+
+    def create(model, contents, ttl):
+        attempts.append(model)
+        if len(attempts) == 1:
+            raise RuntimeError("503 servicio no disponible")
+        return SimpleNamespace(name="cache-1")
+
+    clock = [1000.0]
+    monkeypatch.setattr(gemini_common, "genai", fake_caching(create))
+    monkeypatch.setattr(gemini_common.time, "monotonic", lambda: clock[0])
+    cache = CachedPrefixModels("gemini-2.5-flash")
+    prefix = "x" * gemini_common.CACHED_PREFIX_MIN_CHARS
+
+    assert cache.get(prefix) is None
+    assert cache.get(prefix) is None
+    clock[0] += gemini_common.CACHED_PREFIX_RETRY_SECONDS + 1
+
+    assert cache.get(prefix).name == "cache-1"
+    assert len(attempts) == 2
@@ -3,13 +3,48 @@ Test de integración completo: Parser + AI Suggestions + Excel Export
 Valida el flujo completo desde XML hasta sugerencias PUC
 """
 
+import json
 import os
+import sys
+from pathlib import Path
+from types import SimpleNamespace
+
+import pytest
+
 from app.infrastructure.services.invoice_parser import UBLInvoiceParser
 from app.infrastructure.services.ai import GeminiAISuggestionService
 from app.domain.invoices import Invoice, InvoiceLine
 
+# Respuesta grabada de Gemini; se regraba con `pytest tests/test_integration.py --live-ai`
+CASSETTE = Path(__file__).parent / "cassettes" / "test_integration_flow.json"
+
+
+class ReplayModel:
+    """Reproduce los fragmentos grabados como si fueran el streaming de Gemini."""
+
+    def __init__(self, chunks: list[str]) -> None:
+        self.chunks = chunks
+
+    def generate_content(self, prompt, generation_config=None, stream=False):
+        return [SimpleNamespace(text=chunk, usage_metadata=None) for chunk in self.chunks]
+
 
-def test_integration_flow():
+class RecordingModel:
+    """Envuelve el modelo real y guarda el texto de cada fragmento recibido."""
+
+    def __init__(self, model) -> None:
+        self.model = model
+        self.chunks: list[str] = []
+
+    def generate_content(self, prompt, generation_config=None, stream=False):
+        for chunk in self.model.generate_content(prompt, generation_config=generation_config, stream=stream):
+            self.chunks.append(chunk.text)
+            yield chunk
+
+
+# Con --live-ai consume la cuota de Gemini: siempre en el mismo worker de xdist, nunca en paralelo
+@pytest.mark.xdist_group("serial")
+def test_integration_flow(pytestconfig):
     """
     Simula el flujo completo:
     1. Parsear un AttachedDocument (standard-invoice-2.xml)
@@ -47,7 +82,7 @@ def test_integration_flow():
     
     invoice = Invoice(
         id="test-invoice-001",
-        user_id="test-user",
+        owner_id="test-user",
         external_id=parsed_data['external_id'],
         issue_date=parsed_data['issue_date'],
         supplier_name=parsed_data['supplier']['name'],
@@ -58,7 +93,7 @@ def test_integration_flow():
         total_amount=parsed_data['total_amount'],
         tax_amount=parsed_data['tax_amount'],
         lines=parsed_data['lines'],
-        raw_xml=parsed_data['raw_xml'],
+        raw_xml=parsed_data['raw_xml'].decode('utf-8', errors='ignore'),
     )
     
     print(f"✅ Invoice creada con {len(invoice.lines)} líneas")
@@ -71,18 +106,48 @@ def test_integration_flow():
     print(f"\n🤖 PASO 3: Generando sugerencias PUC con Gemini AI")
     print("-" * 70)
     
-    # Verificar que existe la API key
-    api_key = os.getenv("GEMINI_API_KEY")
-    if not api_key:
-        print("⚠️  GEMINI_API_KEY no configurada. Saltando prueba de AI.")
-        print("   Para probar AI, ejecutar:")
-        print("   $env:GEMINI_API_KEY='tu-api-key'; python test_integration.py")
-        return
-    
-    ai_service = GeminiAISuggestionService()
+    live = pytestconfig.getoption("live_ai")
+    recorder = None
+    if live:
+        # Llamada real a Gemini: regraba el cassette para las siguientes ejecuciones
+        api_key = os.getenv("GEMINI_API_KEY")
+        if not api_key:
+            pytest.skip("--live-ai requiere GEMINI_API_KEY")
+        ai_service = GeminiAISuggestionService(api_key=api_key)
+        recorder = ai_service._model = RecordingModel(ai_service._model)
+    else:
+        # Por defecto se reproduce la respuesta grabada: sin red ni consumo de cuota
+        recorded = json.loads(CASSETTE.read_text(encoding="utf-8"))
+        ai_service = GeminiAISuggestionService(api_key="", model_name=recorded["model"])
+        ai_service._model = ReplayModel(recorded["chunks"])
+        ai_service._initialized = True
+        print(f"📼 Reproduciendo respuesta grabada ({CASSETTE.name})")
+    # Todas las líneas viajan en una sola llamada a Gemini (salida JSON con esquema)
+    payload = {
+        "external_id": invoice.external_id,
+        "supplier": {"name": invoice.supplier_name, "tax_id": invoice.supplier_tax_id},
+        "customer": {"name": invoice.customer_name, "tax_id": invoice.customer_tax_id},
+        "currency": invoice.currency,
+        "total_amount": float(invoice.total_amount),
+        "tax_amount": float(invoice.tax_amount),
+        "lines": [
+            {
+                "description": line.description,
+                "amount": float(line.line_extension_amount),
+                "quantity": float(line.quantity),
+            }
+            for line in invoice.lines
+        ],
+    }
     
+    suggestions = []
     try:
-        suggestions = ai_service.generate_suggestions_for_invoice(invoice)
+        suggestions = ai_service.generate_suggestions(payload)
+        if recorder is not None and recorder.chunks:
+            CASSETTE.write_text(
+                json.dumps({"model": ai_service.model_name, "chunks": recorder.chunks}, ensure_ascii=False, indent=2) + "\n",
+                encoding="utf-8",
+            )
         
         print(f"✅ Sugerencias generadas: {len(suggestions)}")
         
@@ -92,18 +157,18 @@ def test_integration_flow():
         
         all_valid = True
         for i, suggestion in enumerate(suggestions[:5], 1):
-            code = suggestion.puc_code_4_digits
+            code = str(suggestion.get("account_code", ""))
             is_income = code.startswith("4")
             status = "✅" if is_income else "❌"
             
             print(f"{status} Sugerencia {i}:")
             print(f"   Código PUC: {code}")
-            print(f"   Nombre: {suggestion.puc_code_name}")
+            print(f"   Nombre: {suggestion.get('account_name', '')}")
             print(f"   Clase: {'INGRESOS (correcto)' if is_income else 'ERROR - No es ingreso'}")
             
             if not is_income:
                 all_valid = False
-                print(f"   ⚠️  Razón: {suggestion.reasoning}")
+                print(f"   ⚠️  Razón: {suggestion.get('rationale', '')}")
         
         if len(suggestions) > 5:
             print(f"   ... y {len(suggestions) - 5} sugerencias más")
@@ -122,6 +187,11 @@ def test_integration_flow():
         import traceback
         traceback.print_exc()
 
+    if not live:
+        # La respuesta grabada cubre todas las líneas con cuentas de ingresos (clase 4)
+        assert len(suggestions) == len(invoice.lines)
+        assert all(str(item["account_code"]).startswith("4") for item in suggestions)
+
 
 if __name__ == "__main__":
-    test_integration_flow()
+    sys.exit(pytest.main([__file__, "-s", *sys.argv[1:]]))
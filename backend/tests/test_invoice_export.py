@@ -1,27 +1,19 @@
 from io import BytesIO
-from pathlib import Path
+from types import SimpleNamespace
 from zipfile import ZipFile
 
 import pytest
+from openpyxl import load_workbook
 
-from app.application.use_cases.invoices import NoInvoicesToExportError
+from app.application.use_cases.invoices import ExportInvoicesToExcel, NoInvoicesToExportError
 from app.config import dependencies
 from app.domain import User
 from app.presentation.routers import invoices
+from tests.samples import read_sample_xml
 
 
 def setup_function() -> None:
-    dependencies.get_invoice_repository.cache_clear()
-    dependencies.get_ai_suggestion_repository.cache_clear()
-    dependencies.get_invoice_parser.cache_clear()
-    dependencies.get_ai_suggestion_service.cache_clear()
-    dependencies.get_invoice_workbook_builder.cache_clear()
-
-
-def read_sample_xml() -> bytes:
-    root = Path(__file__).resolve().parents[1]
-    xml_path = root / "app" / "assessment-files" / "sales-invoice-1.xml"
-    return xml_path.read_bytes()
+    dependencies.reset_repositories()
 
 
 @pytest.fixture
@@ -44,17 +36,50 @@ def test_export_invoices_use_case_generates_workbook() -> None:
     invoice = uploader.execute(
         owner_id=owner_id,
         filename="sales-invoice-1.xml",
-        content=read_sample_xml(),
+        content=read_sample_xml("sales-invoice-1.xml"),
     )
     suggestions.execute(owner_id=owner_id, invoice_id=invoice.id)
 
     payload = exporter.execute(owner_id=owner_id)
     assert payload
 
-    with ZipFile(BytesIO(payload)) as archive:
-        sheet = archive.read("xl/worksheets/sheet1.xml")
-    assert invoice.external_id.encode() in sheet
-    assert invoice.supplier_name.encode() in sheet
+    # Se comparan los valores de las celdas, no el XML crudo de la hoja (escapes, strings compartidos)
+    workbook = load_workbook(BytesIO(payload), read_only=True, data_only=True)
+    try:
+        cells = {value for row in workbook.worksheets[0].iter_rows(values_only=True) for value in row}
+    finally:
+        workbook.close()
+    assert invoice.external_id in cells
+    assert invoice.supplier_name in cells
+
+
+class StubWorkbookBuilder:
+    def build_to(self, fp, invoices, suggestions_map) -> None:
+        fp.write(b"x" * 150_000)
+
+
+def test_execute_iter_yields_bounded_chunks() -> None:
+    invoice = SimpleNamespace(id="inv-1", issue_date="2024-01-01")
+    use_case = ExportInvoicesToExcel(
+        invoice_repository=SimpleNamespace(list_for_user=lambda owner_id: [invoice]),
+        suggestion_repository=SimpleNamespace(list_for_invoice=lambda invoice_id: []),
+        workbook_builder=StubWorkbookBuilder(),
+    )
+
+    chunks = list(use_case.execute_iter(owner_id="user-1", chunk_size=64 * 1024))
+
+    assert [len(chunk) for chunk in chunks] == [65536, 65536, 18928]
+
+
+def test_execute_iter_validates_before_streaming() -> None:
+    use_case = ExportInvoicesToExcel(
+        invoice_repository=SimpleNamespace(list_for_user=lambda owner_id: []),
+        suggestion_repository=SimpleNamespace(list_for_invoice=lambda invoice_id: []),
+        workbook_builder=StubWorkbookBuilder(),
+    )
+
+    with pytest.raises(NoInvoicesToExportError):
+        use_case.execute_iter(owner_id="user-empty")
 
 
 @pytest.mark.anyio
@@ -67,7 +92,7 @@ async def test_export_invoices_router_streams_file() -> None:
     invoice = uploader.execute(
         owner_id=user.id,
         filename="sales-invoice-1.xml",
-        content=read_sample_xml(),
+        content=read_sample_xml("sales-invoice-1.xml"),
     )
     suggestions.execute(owner_id=user.id, invoice_id=invoice.id)
 
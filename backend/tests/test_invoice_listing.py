@@ -1,22 +1,17 @@
-from pathlib import Path
-
 import pytest
 
+from app.application.use_cases.invoices import UploadInvoice
 from app.config import dependencies
 from app.domain import AISuggestion, User
+from app.infrastructure.repositories.in_memory_invoices import InMemoryInvoiceRepository
+from app.infrastructure.services import UBLInvoiceParser
 from app.presentation.routers import invoices
+from app.presentation.schemas.invoices import InvoiceDetailResponse
+from tests.samples import read_sample_xml
 
 
 def setup_function() -> None:
-    dependencies.get_invoice_repository.cache_clear()
-    dependencies.get_invoice_parser.cache_clear()
-    dependencies.get_ai_suggestion_repository.cache_clear()
-
-
-def read_sample_xml() -> bytes:
-    root = Path(__file__).resolve().parents[1]
-    xml_path = root / "app" / "assessment-files" / "sales-invoice-2.xml"
-    return xml_path.read_bytes()
+    dependencies.reset_repositories()
 
 
 @pytest.fixture
@@ -33,7 +28,7 @@ async def test_list_invoices_reflects_suggestion_status() -> None:
     invoice = upload_use_case.execute(
         owner_id=user.id,
         filename="sales-invoice-2.xml",
-        content=read_sample_xml(),
+        content=read_sample_xml("sales-invoice-2.xml"),
     )
 
     first_response = await invoices.list_invoices(current_user=user, use_case=list_use_case)
@@ -65,7 +60,7 @@ async def test_get_invoice_detail_includes_lines_and_status() -> None:
     invoice = upload_use_case.execute(
         owner_id=user.id,
         filename="sales-invoice-2.xml",
-        content=read_sample_xml(),
+        content=read_sample_xml("sales-invoice-2.xml"),
     )
 
     suggestion_repo = dependencies.get_ai_suggestion_repository()
@@ -90,3 +85,22 @@ async def test_get_invoice_detail_includes_lines_and_status() -> None:
     assert response.status == "procesada"
     assert response.lines
     assert isinstance(response.taxes, list)
+
+
+
+def test_invoice_detail_from_domain_serializes_like_validated_model() -> None:
+    invoice = UploadInvoice(
+        invoice_repository=InMemoryInvoiceRepository(),
+        invoice_parser=UBLInvoiceParser(),
+    ).execute(
+        owner_id="owner-1",
+        filename="sales-invoice-2.xml",
+        content=read_sample_xml("sales-invoice-2.xml"),
+    )
+
+    response = InvoiceDetailResponse.from_domain(invoice, status="procesada")
+    validated = InvoiceDetailResponse.model_validate_json(response.model_dump_json())
+
+    assert validated.model_dump() == response.model_dump()
+    assert validated.lines[0]["line_id"] == invoice.lines[0].line_id
+    assert all(line["tax_amount"] >= 0 for line in response.lines)
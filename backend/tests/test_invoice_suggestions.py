@@ -1,22 +1,21 @@
-from pathlib import Path
-
 import pytest
 
-from app.application.use_cases.invoices import GenerateAccountingSuggestions, InvoiceNotFoundError
+from app.application.use_cases.invoices import (
+    GenerateAccountingSuggestions,
+    InvoiceNotFoundError,
+    UploadInvoice,
+)
 from app.config import dependencies
+from app.infrastructure.repositories.in_memory_ai_suggestions import InMemoryAISuggestionRepository
+from app.infrastructure.repositories.in_memory_invoices import InMemoryInvoiceRepository
+from app.infrastructure.services import UBLInvoiceParser
 from app.domain import User
 from app.presentation.routers import invoices
+from tests.samples import read_sample_xml
 
 
 def setup_function() -> None:
-    dependencies.get_invoice_repository.cache_clear()
-    dependencies.get_invoice_parser.cache_clear()
-    dependencies.get_ai_suggestion_repository.cache_clear()
-
-
-def read_sample_xml(name: str = "sales-invoice-2.xml") -> bytes:
-    root = Path(__file__).resolve().parents[1]
-    return (root / "app" / "assessment-files" / name).read_bytes()
+    dependencies.reset_repositories()
 
 
 class StubAISuggestionService:
@@ -110,3 +109,35 @@ async def test_router_returns_serialized_suggestions() -> None:
     # Verifica que devuelve el código del AI stub
     assert response.suggestions[0].account_code == "5305"
     assert response.suggestions[0].source == "ai"
+
+
+class AsyncStubAISuggestionService(StubAISuggestionService):
+    async def agenerate_suggestions(
+        self, invoice_payload: dict[str, object], owner_id: str | None = None
+    ) -> list[dict[str, object]]:
+        self.called_with = invoice_payload
+        return self.payload
+
+
+@pytest.mark.anyio
+async def test_aexecute_awaits_the_async_ai_service() -> None:
+    invoice_repository = InMemoryInvoiceRepository()
+    suggestion_repository = InMemoryAISuggestionRepository()
+    invoice = UploadInvoice(invoice_repository=invoice_repository, invoice_parser=UBLInvoiceParser()).execute(
+        owner_id="user-async", filename="sales-invoice-2.xml", content=read_sample_xml("sales-invoice-2.xml")
+    )
+    ai_service = AsyncStubAISuggestionService()
+    use_case = GenerateAccountingSuggestions(
+        invoice_repository=invoice_repository,
+        suggestion_repository=suggestion_repository,
+        ai_service=ai_service,
+    )
+
+    result = await use_case.aexecute(owner_id="user-async", invoice_id=invoice.id)
+
+    assert [item.account_code for item in result] == ["5305"]
+    assert ai_service.called_with is not None
+    assert suggestion_repository.list_for_invoice(invoice.id) == result
+
+    with pytest.raises(InvoiceNotFoundError):
+        await use_case.aexecute(owner_id="other-user", invoice_id=invoice.id)
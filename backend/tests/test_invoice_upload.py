@@ -1,5 +1,4 @@
 from io import BytesIO
-from pathlib import Path
 from unittest.mock import Mock
 
 import pytest
@@ -13,18 +12,11 @@ from app.application.use_cases.invoices import (
 from app.config import dependencies
 from app.domain import User
 from app.presentation.routers import invoices
+from tests.samples import read_sample_xml
 
 
 def setup_function() -> None:
-    dependencies.get_invoice_repository.cache_clear()
-    dependencies.get_invoice_parser.cache_clear()
-    dependencies.get_ai_suggestion_repository.cache_clear()
-
-
-def read_sample_xml() -> bytes:
-    root = Path(__file__).resolve().parents[1]
-    xml_path = root / "app" / "assessment-files" / "sales-invoice-1.xml"
-    return xml_path.read_bytes()
+    dependencies.reset_repositories()
 
 
 @pytest.fixture
@@ -39,7 +31,7 @@ def test_upload_invoice_use_case_persists_data() -> None:
     invoice = use_case.execute(
         owner_id=owner_id,
         filename="sales-invoice-1.xml",
-        content=read_sample_xml(),
+        content=read_sample_xml("sales-invoice-1.xml"),
     )
 
     stored = dependencies.get_invoice_repository().list_for_user(owner_id)
@@ -51,7 +43,7 @@ def test_upload_invoice_use_case_persists_data() -> None:
 def test_upload_invoice_use_case_prevents_duplicates() -> None:
     use_case = dependencies.get_upload_invoice_use_case()
     owner_id = "user-dup"
-    payload = dict(owner_id=owner_id, filename="sales-invoice-1.xml", content=read_sample_xml())
+    payload = dict(owner_id=owner_id, filename="sales-invoice-1.xml", content=read_sample_xml("sales-invoice-1.xml"))
 
     use_case.execute(**payload)
     with pytest.raises(InvoiceAlreadyExistsError):
@@ -87,13 +79,59 @@ async def test_upload_invoice_router_validates_content_type() -> None:
     assert exc.value.detail == "Solo se permiten archivos XML"
 
 
+@pytest.mark.anyio
+async def test_upload_invoice_router_rejects_oversized_file(monkeypatch) -> None:
+    user = User.create(email="router-big@example.com", hashed_password="secret")
+    monkeypatch.setattr(invoices, "get_settings", lambda: Mock(max_invoice_upload_bytes=100_000))
+    use_case = Mock()
+
+    file = UploadFile(
+        BytesIO(b"<Invoice>" + b" " * 200_000 + b"</Invoice>"),
+        filename="invoice.xml",
+        headers=Headers({"content-type": "application/xml"}),
+    )
+    with pytest.raises(HTTPException) as exc:
+        await invoices.upload_invoice(
+            file=file,
+            current_user=user,
+            background_tasks=Mock(),
+            use_case=use_case,
+            generate_suggestions_use_case=Mock(),
+        )
+    assert exc.value.status_code == 413
+    use_case.execute.assert_not_called()
+
+
+@pytest.mark.anyio
+async def test_upload_invoice_router_rejects_non_xml_signature() -> None:
+    user = User.create(email="router-zip@example.com", hashed_password="secret")
+    use_case = Mock()
+
+    file = UploadFile(
+        BytesIO(b"PK\x03\x04" + b"\x00" * 64),
+        filename="invoice.xml",
+        headers=Headers({"content-type": "application/xml"}),
+    )
+    with pytest.raises(HTTPException) as exc:
+        await invoices.upload_invoice(
+            file=file,
+            current_user=user,
+            background_tasks=Mock(),
+            use_case=use_case,
+            generate_suggestions_use_case=Mock(),
+        )
+    assert exc.value.status_code == 400
+    assert exc.value.detail == "El archivo no es un XML válido"
+    use_case.execute.assert_not_called()
+
+
 @pytest.mark.anyio
 async def test_upload_invoice_router_returns_invoice_response() -> None:
     user = User.create(email="router2@example.com", hashed_password="secret")
     use_case = dependencies.get_upload_invoice_use_case()
 
     file = UploadFile(
-        BytesIO(read_sample_xml()),
+        BytesIO(read_sample_xml("sales-invoice-1.xml")),
         filename="sales-invoice-1.xml",
         headers=Headers({"content-type": "application/xml"}),
     )
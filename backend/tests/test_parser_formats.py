@@ -2,6 +2,9 @@
 Test para verificar que el parser funciona con diferentes formatos de XML de la DIAN
 """
 from pathlib import Path
+
+import pytest
+
 from app.infrastructure.services.invoice_parser import UBLInvoiceParser
 
 def test_all_formats():
@@ -46,5 +49,46 @@ def test_all_formats():
             import traceback
             traceback.print_exc()
 
+def test_streaming_path_matches_tree_path(monkeypatch):
+    from app.infrastructure.services import invoice_parser
+
+    parser = UBLInvoiceParser()
+    for filename in ("sales-invoice-1.xml", "credit-note-2.xml", "standard-invoice-2.xml"):
+        xml_bytes = Path(f"app/assessment-files/{filename}").read_bytes()
+        expected = parser.parse(xml_bytes)
+
+        monkeypatch.setattr(invoice_parser, "_STREAMING_MIN_BYTES", 0)
+        streamed = parser.parse(xml_bytes)
+        monkeypatch.undo()
+
+        assert streamed == expected
+
+def test_attached_document_single_pass_matches_tree_path(monkeypatch):
+    from app.infrastructure.services import invoice_parser
+
+    parser = UBLInvoiceParser()
+    for filename in ("credit-note-2.xml", "credit-note-3.xml", "standard-invoice-2.xml"):
+        xml_bytes = Path(f"app/assessment-files/{filename}").read_bytes()
+        single_pass = parser.parse(xml_bytes)
+
+        # Sin bytes para detectar la raíz se usa el árbol completo del contenedor
+        monkeypatch.setattr(invoice_parser, "_ROOT_SNIFF_BYTES", 0)
+        from_tree = parser.parse(xml_bytes)
+        monkeypatch.undo()
+
+        assert single_pass == from_tree
+
+def test_attached_document_without_invoice_is_rejected():
+    xml_bytes = (
+        b'<?xml version="1.0"?>'
+        b'<AttachedDocument xmlns:cac="urn:oasis:names:specification:ubl:schema:xsd:CommonAggregateComponents-2"'
+        b' xmlns:cbc="urn:oasis:names:specification:ubl:schema:xsd:CommonBasicComponents-2">'
+        b"<cac:Attachment><cac:ExternalReference><cbc:Description>sin factura</cbc:Description>"
+        b"</cac:ExternalReference></cac:Attachment></AttachedDocument>"
+    )
+
+    with pytest.raises(ValueError, match="factura embebida"):
+        UBLInvoiceParser().parse(xml_bytes)
+
 if __name__ == "__main__":
     test_all_formats()
@@ -0,0 +1,18 @@
+from app.infrastructure.services.password import BcryptPasswordHasher
+
+
+def test_hash_roundtrip_and_rejects_wrong_password() -> None:
+    hasher = BcryptPasswordHasher(rounds=4)
+
+    hashed = hasher.hash("clave-segura")
+
+    assert hashed.startswith("$2b$04$")
+    assert hasher.verify("clave-segura", hashed)
+    assert not hasher.verify("otra-clave", hashed)
+
+
+def test_verify_falls_back_to_plain_comparison_for_legacy_values() -> None:
+    hasher = BcryptPasswordHasher(rounds=4)
+
+    assert hasher.verify("legacy", "legacy")
+    assert not hasher.verify("legacy", "otro")
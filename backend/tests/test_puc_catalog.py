@@ -0,0 +1,92 @@
+from types import SimpleNamespace
+
+from app.infrastructure.services import puc_catalog
+from app.infrastructure.services.puc_catalog import PUCCatalogGenerator
+from tests.samples import FailingStreamModel, TextlessChunk
+
+
+class CountingModel:
+    calls = 0
+
+    def __init__(self, *args, **kwargs) -> None:
+        pass
+
+    def generate_content(self, prompt, generation_config=None, stream=False):
+        CountingModel.calls += 1
+        return [
+            SimpleNamespace(text='[{"codigo": "41350501", "nom'),
+            SimpleNamespace(text='bre": "Venta de equipos"}]'),
+        ]
+
+
+def test_catalog_is_reused_for_same_code_signature() -> None:
+    CountingModel.calls = 0
+    generator = PUCCatalogGenerator(api_key="")
+    generator._initialized = True
+    generator._model = CountingModel()
+    context = [{"code": "41350501", "rationale": "Venta"}]
+
+    first = generator.generate_catalog(["41350501", "11050501"], context)
+    second = generator.generate_catalog(["11050501", "41350501"], context)
+
+    assert CountingModel.calls == 1
+    assert first == second
+    assert first[0] is not second[0]
+
+
+def test_catalog_prompt_starts_with_static_prefix_and_sorts_codes() -> None:
+    generator = PUCCatalogGenerator(api_key="")
+
+    first = generator._build_catalog_prompt(["41350501", "11050501"], [])
+    second = generator._build_catalog_prompt(["11050501", "41350501"], [])
+
+    assert first == second
+    assert first.startswith(puc_catalog._CATALOG_PROMPT_PREFIX)
+    assert "11050501, 41350501" in first[len(puc_catalog._CATALOG_PROMPT_PREFIX):]
+
+
+def test_basic_catalog_uses_first_digit_metadata() -> None:
+    catalog = PUCCatalogGenerator(api_key="")._generate_basic_catalog(["11050501", "31050501", "91050501"])
+
+    assert [(item["categoria"], item["clase"], item["activo"]) for item in catalog] == [
+        ("Activos", "Activo Corriente", "Sí"),
+        ("Patrimonio", "Otros", "No"),
+        ("Otros", "Otros", "No"),
+    ]
+
+
+def test_interrupted_stream_completes_missing_codes_with_basic_catalog() -> None:
+    generator = PUCCatalogGenerator(api_key="")
+    generator._initialized = True
+    generator._model = FailingStreamModel('[{"codigo": "41350501", "nombre": "Venta de equipos"},')
+
+    catalog = generator.generate_catalog(["41350501", "11050501"], [])
+
+    assert [(item["codigo"], item["nombre"]) for item in catalog] == [
+        ("41350501", "Venta de equipos"),
+        ("11050501", "Cuenta 11050501"),
+    ]
+
+
+def test_textless_chunk_does_not_discard_streamed_accounts() -> None:
+    class FinalChunkModel:
+        calls = 0
+
+        def generate_content(self, prompt, generation_config=None, stream=False):
+            self.calls += 1
+            return [
+                SimpleNamespace(text='[{"codigo": "41350501", "nombre": "Venta de equipos"},'),
+                SimpleNamespace(text=' {"codigo": "11050501", "nombre": "Caja general"}]'),
+                TextlessChunk(),
+            ]
+
+    generator = PUCCatalogGenerator(api_key="")
+    generator._initialized = True
+    generator._model = FinalChunkModel()
+
+    catalog = generator.generate_catalog(["41350501", "11050501"], [])
+    generator.generate_catalog(["41350501", "11050501"], [])
+
+    assert [account["nombre"] for account in catalog] == ["Venta de equipos", "Caja general"]
+    # La respuesta se tomó como completa: queda en caché y no se vuelve a pedir
+    assert generator._model.calls == 1
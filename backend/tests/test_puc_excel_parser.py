@@ -0,0 +1,111 @@
+from io import BytesIO
+
+import openpyxl
+import pytest
+
+from app.infrastructure.services import puc_excel_parser
+from app.infrastructure.services.puc_excel_parser import PUCExcelParserService
+
+
+def build_xlsx(*rows: tuple) -> bytes:
+    workbook = openpyxl.Workbook()
+    sheet = workbook.active
+    for row in rows:
+        sheet.append(list(row))
+    buffer = BytesIO()
+    workbook.save(buffer)
+    return buffer.getvalue()
+
+
+def test_parse_xlsx_finds_headers_after_title_rows() -> None:
+    content = build_xlsx(
+        ("Plan Único de Cuentas",),
+        (),
+        ("Código", "Nombre", "Categoría", "Nivel agrupación"),
+        ("11050501", "Efectivo caja principal", "Caja - Bancos", "Transaccional"),
+        (None, None),
+        (41350501, "Venta de equipos"),
+        ("Código", "Nombre"),
+    )
+
+    accounts = PUCExcelParserService().parse_excel(content, "owner-1", "puc.xlsx")
+
+    assert [(account.codigo, account.nombre) for account in accounts] == [
+        ("11050501", "Efectivo caja principal"),
+        ("41350501", "Venta de equipos"),
+    ]
+    assert accounts[0].categoria == "Caja - Bancos"
+    assert accounts[0].nivel_agrupacion == "Transaccional"
+    assert accounts[1].categoria == ""
+
+
+@pytest.fixture
+def anyio_backend() -> str:
+    return "asyncio"
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize("min_bytes", [10**9, 0])
+async def test_parse_excel_async_matches_sync_parse(monkeypatch, min_bytes: int) -> None:
+    monkeypatch.setattr(puc_excel_parser, "_PROCESS_POOL_MIN_BYTES", min_bytes)
+    # Los bytes en memoria nunca se copian a otro proceso, por grandes que sean
+    monkeypatch.setattr(puc_excel_parser, "_get_process_pool", lambda: pytest.fail("bytes enviados al pool"))
+    content = build_xlsx(("Código", "Nombre"), ("11050501", "Efectivo caja principal"))
+    parser = PUCExcelParserService()
+
+    accounts = await parser.parse_excel_async(content, "owner-1", "puc.xlsx")
+
+    assert [(account.codigo, account.nombre) for account in accounts] == [("11050501", "Efectivo caja principal")]
+
+
+def test_headers_match_with_or_without_accents() -> None:
+    content = build_xlsx(("CÓDIGO ", "Nombre", "Categoria", "NIVEL AGRUPACIÓN"), ("1105", "Caja", "Caja - Bancos", "Cuenta"))
+
+    accounts = PUCExcelParserService().parse_excel(content, "owner-1", "puc.xlsx")
+
+    assert [(a.codigo, a.categoria, a.nivel_agrupacion) for a in accounts] == [("1105", "Caja - Bancos", "Cuenta")]
+
+
+def test_transactional_level_is_stored_with_one_spelling() -> None:
+    content = build_xlsx(
+        ("Código", "Nombre", "Nivel agrupación"),
+        ("11050501", "Caja", "Transaccional "),
+        ("11050502", "Caja menor", "TransAccional"),
+        ("1105", "Caja general", "Cuenta"),
+    )
+
+    accounts = PUCExcelParserService().parse_excel(content, "owner-1", "puc.xlsx")
+
+    assert [a.nivel_agrupacion for a in accounts] == ["Transaccional", "Transaccional", "Cuenta"]
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize("min_bytes", [10**9, 0])
+async def test_parse_excel_reads_spooled_upload_from_disk(monkeypatch, tmp_path, min_bytes: int) -> None:
+    monkeypatch.setattr(puc_excel_parser, "_PROCESS_POOL_MIN_BYTES", min_bytes)
+    path = tmp_path / "upload.tmp"
+    path.write_bytes(build_xlsx(("Código", "Nombre"), ("11050501", "Efectivo caja principal")))
+
+    accounts = await PUCExcelParserService().parse_excel_async(path, "owner-1", "puc.xlsx")
+
+    assert [(account.codigo, account.nombre) for account in accounts] == [("11050501", "Efectivo caja principal")]
+
+
+def test_openpyxl_fallback_matches_calamine(monkeypatch) -> None:
+    content = build_xlsx(
+        ("Código", "Nombre", "Nivel agrupación"),
+        (41350501, "Venta de equipos", "Transaccional"),
+        ("", None, None),
+        ("11050501", "Caja general", None),
+    )
+    parser = PUCExcelParserService()
+    default = parser.parse_excel(content, "owner-1", "puc.xlsx")
+
+    monkeypatch.setattr(puc_excel_parser, "CalamineWorkbook", None)
+    fallback = parser.parse_excel(content, "owner-1", "puc.xlsx")
+
+    summary = lambda accounts: [(a.codigo, a.nombre, a.nivel_agrupacion) for a in accounts]
+    assert summary(default) == summary(fallback) == [
+        ("41350501", "Venta de equipos", "Transaccional"),
+        ("11050501", "Caja general", ""),
+    ]
@@ -0,0 +1,37 @@
+import orjson
+
+from app.application.use_cases.puc import GetPUCForAI
+from app.presentation.routers.puc import _iter_json_array
+
+
+class ProjectionPUCRepository:
+    def __init__(self, total: int) -> None:
+        self.total = total
+
+    def list_by_owner(self, owner_id, search=None, limit=100, offset=0):
+        raise AssertionError("la exportación debe recorrer la proyección, no list_by_owner")
+
+    def iter_projection(self, owner_id, fields=()):
+        for idx in range(self.total):
+            row = {"id": f"acc-{idx}"}
+            row.update({name: "" for name in fields})
+            row["codigo"] = f"4135{idx:04d}"
+            yield row
+
+
+def test_export_streams_a_json_array_in_batches() -> None:
+    use_case = GetPUCForAI(puc_repository=ProjectionPUCRepository(total=5))
+
+    chunks = list(_iter_json_array(use_case.iter_accounts("owner-1"), batch_size=2))
+    accounts = orjson.loads(b"".join(chunks))
+
+    assert len(chunks) == 5  # "[", tres lotes, "]"
+    assert [account["codigo"] for account in accounts] == [f"4135{idx:04d}" for idx in range(5)]
+    assert "id" not in accounts[0]
+    assert list(accounts[0]) == list(use_case.execute("owner-1")[0])
+
+
+def test_export_of_empty_catalog_is_an_empty_array() -> None:
+    use_case = GetPUCForAI(puc_repository=ProjectionPUCRepository(total=0))
+
+    assert b"".join(_iter_json_array(use_case.iter_accounts("owner-1"))) == b"[]"
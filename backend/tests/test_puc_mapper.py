@@ -0,0 +1,387 @@
+import threading
+from types import SimpleNamespace
+
+import pytest
+
+from app.infrastructure.services import gemini_common, puc_mapper
+from app.infrastructure.services.puc_mapper import PUCMapperService
+from tests.samples import TextlessChunk
+
+
+def account(codigo: str, nombre: str) -> SimpleNamespace:
+    return SimpleNamespace(
+        codigo=codigo,
+        nombre=nombre,
+        categoria="Ingresos",
+        clase="Ingresos Operacionales",
+        nivel_agrupacion="Transaccional",
+    )
+
+
+class StubPUCRepository:
+    def list_by_owner(self, owner_id, search=None, limit=10000, offset=0):
+        accounts = [
+            account("41350501", "Venta de equipos"),
+            account("41350502", "Venta de licencias"),
+            account("42950501", "Ingresos diversos"),
+            account("51350501", "Servicios públicos"),
+            account("51350502", "Aseo y vigilancia"),
+        ]
+        return accounts, len(accounts)
+
+
+class RecordingModel:
+    prompts: list[str] = []
+
+    def __init__(self, *args, **kwargs) -> None:
+        pass
+
+    def generate_content(self, prompt, generation_config=None, stream=False):
+        RecordingModel.prompts.append(prompt)
+        return [
+            SimpleNamespace(text='[{"item": 2, "code": "51350502", "name": "Aseo y vigilancia"},'),
+            SimpleNamespace(text=' {"item": 1, "code": "41350502", "name": "Venta de licencias", "confidence": 0.9}]'),
+        ]
+
+
+def test_batch_mapping_uses_one_model_call_and_keeps_order() -> None:
+    RecordingModel.prompts = []
+    service = PUCMapperService(puc_repository=StubPUCRepository())
+    service._initialized = True
+    service._model = RecordingModel()
+
+    result = service.map_to_specific_accounts_batch(
+        "owner-1",
+        [
+            {"generic_code": "4135", "description": "Licencia anual", "rationale": "Venta"},
+            {"generic_code": "4295", "description": "Otros", "rationale": "Diversos"},
+            {"generic_code": "5135", "description": "Servicio de aseo", "rationale": "Gasto"},
+        ],
+    )
+
+    assert len(RecordingModel.prompts) == 1
+    assert "ITEM 2:" in RecordingModel.prompts[0] and "ITEM 3:" not in RecordingModel.prompts[0]
+    assert [item["specific_code"] for item in result] == ["41350502", "42950501", "51350502"]
+    assert result[1]["confidence"] == 0.9
+
+
+def test_textless_chunk_and_bad_item_keep_the_other_selections() -> None:
+    class PartialModel:
+        def generate_content(self, prompt, generation_config=None, stream=False):
+            return [
+                SimpleNamespace(text='[{"item": 1, "code": "41350502", "name": "Venta de licencias"},'),
+                TextlessChunk(),
+                SimpleNamespace(text=' {"item": "dos", "code": "51350501"}, {"item": 2, "code": "51350502"}]'),
+            ]
+
+    service = PUCMapperService(puc_repository=StubPUCRepository())
+    service._initialized = True
+    service._model = PartialModel()
+
+    result = service.map_to_specific_accounts_batch(
+        "owner-1",
+        [
+            {"generic_code": "4135", "description": "Licencia anual", "rationale": "Venta"},
+            {"generic_code": "5135", "description": "Servicio de aseo", "rationale": "Gasto"},
+        ],
+    )
+
+    assert [item["specific_code"] for item in result] == ["41350502", "51350502"]
+    assert all(not item["explanation"].startswith("Error en IA") for item in result)
+
+
+def test_selection_takes_code_and_name_from_the_matched_candidate() -> None:
+    class LooseModel:
+        def generate_content(self, prompt, generation_config=None, stream=False):
+            return [SimpleNamespace(text='[{"item": 1, "code": 41350502, "name": "Licencias (inventado)"}]')]
+
+    service = PUCMapperService(puc_repository=StubPUCRepository())
+    service._initialized = True
+    service._model = LooseModel()
+
+    result = service.map_to_specific_accounts_batch(
+        "owner-1", [{"generic_code": "4135", "description": "Licencia anual", "rationale": "Venta"}]
+    )
+
+    assert result[0]["specific_code"] == "41350502"
+    assert result[0]["account_name"] == "Venta de licencias"
+
+
+def test_streaming_stops_once_every_item_is_selected() -> None:
+    consumed: list[str] = []
+
+    class TrailingModel:
+        def generate_content(self, prompt, generation_config=None, stream=False):
+            for text in ('[{"item": 1, "code": "41350502"},', ' {"item": 2, "code": "51350502"}', "]", " texto adicional"):
+                consumed.append(text)
+                yield SimpleNamespace(text=text)
+
+    service = PUCMapperService(puc_repository=StubPUCRepository())
+    service._initialized = True
+    service._model = TrailingModel()
+
+    result = service.map_to_specific_accounts_batch(
+        "owner-1",
+        [
+            {"generic_code": "4135", "description": "Licencia anual"},
+            {"generic_code": "5135", "description": "Servicio de aseo"},
+        ],
+    )
+
+    assert [item["specific_code"] for item in result] == ["41350502", "51350502"]
+    assert len(consumed) == 2
+
+
+def test_prefix_index_matches_linear_scan() -> None:
+    service = PUCMapperService(puc_repository=StubPUCRepository())
+    accounts = service.load_accounts_for_owner("owner-1")
+    index = service.build_prefix_index(accounts)
+
+    for prefix in ("4", "41", "4135", "413505", "41350502", "513", "9999"):
+        assert service.get_accounts_by_prefix(accounts, prefix, index) == service.get_accounts_by_prefix(accounts, prefix)
+
+
+def test_bisect_lookup_matches_linear_scan_for_any_prefix_length() -> None:
+    service = PUCMapperService(puc_repository=StubPUCRepository())
+    entry = service._owner_accounts("owner-1")
+
+    for prefix in ("4", "413", "41350", "4135050", "5135050", "9", ""):
+        expected = sorted(service.get_accounts_by_prefix(entry.accounts, prefix), key=lambda acc: acc.code)
+        assert service.get_accounts_by_prefix(
+            entry.accounts, prefix, None, entry.sorted_codes, entry.sorted_accounts
+        ) == expected
+
+
+class ProjectionPUCRepository:
+    def __init__(self) -> None:
+        self.fields: tuple[str, ...] = ()
+
+    def iter_projection(self, owner_id, fields=()):
+        self.fields = tuple(fields)
+        yield {"id": "1", "codigo": "41350501", "nombre": "Venta", "categoria": "Ingresos", "clase": "", "nivel_agrupacion": "Transaccional"}
+        yield {"id": "2", "codigo": "4135", "nombre": "Comercio", "categoria": "Ingresos", "clase": "", "nivel_agrupacion": "Cuenta"}
+
+    def list_by_owner(self, *args, **kwargs):
+        raise AssertionError("list_by_owner no debería usarse si hay proyección")
+
+
+def test_accounts_are_loaded_through_the_projection() -> None:
+    repository = ProjectionPUCRepository()
+    accounts = PUCMapperService(puc_repository=repository).load_accounts_for_owner("owner-1")
+
+    assert [account.code for account in accounts] == ["41350501"]
+    assert "nivel_agrupacion" in repository.fields
+
+
+class TransactionalPUCRepository(ProjectionPUCRepository):
+    def iter_transactional_projection(self, owner_id, fields=()):
+        self.fields = tuple(fields)
+        yield {"id": "1", "codigo": "41350501", "nombre": "Venta", "categoria": "Ingresos", "clase": "", "nivel_agrupacion": "TRANSACCIONAL"}
+
+    def iter_projection(self, owner_id, fields=()):
+        raise AssertionError("el filtro transaccional debe resolverlo el repositorio")
+
+
+def test_transactional_filter_is_pushed_to_the_repository() -> None:
+    repository = TransactionalPUCRepository()
+    accounts = PUCMapperService(puc_repository=repository).load_accounts_for_owner("owner-1")
+
+    assert [account.code for account in accounts] == ["41350501"]
+    assert "codigo" in repository.fields
+
+
+def test_batch_prompt_dedupes_candidates_and_truncates_rationale() -> None:
+    service = PUCMapperService()
+    first = puc_mapper.PUCAccount("41350502", "Venta de licencias", "Ingresos", "", "Transaccional")
+    second = puc_mapper.PUCAccount("41350501", "Venta de equipos", "Ingresos", "", "Transaccional")
+    request = {"generic_code": "4135", "description": "Licencia", "rationale": "x" * 500}
+
+    prompt = service._build_batch_mapping_prompt([(request, [first, second, first])])
+
+    assert prompt.count("41350502") == 1
+    assert prompt.index("41350501") < prompt.index("41350502")
+    assert "x" * 200 in prompt and "x" * 201 not in prompt
+
+
+class AsyncRecordingModel:
+    def __init__(self) -> None:
+        self.prompts: list[str] = []
+
+    async def generate_content_async(self, prompt, generation_config=None):
+        self.prompts.append(prompt)
+        return SimpleNamespace(text='[{"item": 1, "code": "41350502", "name": "Venta de licencias"}]')
+
+
+@pytest.fixture
+def anyio_backend() -> str:
+    return "asyncio"
+
+
+@pytest.mark.anyio
+async def test_async_batch_mapping_splits_large_batches(monkeypatch) -> None:
+    monkeypatch.setattr(puc_mapper, "_BATCH_MAX_ITEMS", 2)
+    model = AsyncRecordingModel()
+    service = PUCMapperService(puc_repository=StubPUCRepository())
+    service._initialized = True
+    service._model = model
+    requests = [{"generic_code": "4135", "description": f"Licencia {i}", "rationale": ""} for i in range(3)]
+
+    result = await service.amap_to_specific_accounts_batch("owner-1", requests)
+
+    assert len(model.prompts) == 2
+    assert [item["specific_code"] for item in result] == ["41350502", "41350501", "41350502"]
+
+
+@pytest.mark.anyio
+async def test_async_mapping_resolves_cached_prefix_off_the_event_loop(monkeypatch) -> None:
+    loop_thread = threading.get_ident()
+    lookups: list[int] = []
+    monkeypatch.setattr(gemini_common.CachedPrefixModels, "get", lambda self, prefix: lookups.append(threading.get_ident()))
+    service = PUCMapperService(puc_repository=StubPUCRepository())
+    service._initialized = True
+    service._model = AsyncRecordingModel()
+
+    await service.amap_to_specific_accounts_batch(
+        "owner-1", [{"generic_code": "4135", "description": "Licencia", "rationale": ""}]
+    )
+
+    assert lookups and loop_thread not in lookups
+
+
+def test_obvious_description_match_skips_the_model() -> None:
+    RecordingModel.prompts = []
+    service = PUCMapperService(puc_repository=StubPUCRepository())
+    service._initialized = True
+    service._model = RecordingModel()
+
+    result = service.map_to_specific_account("owner-1", "5135", "Servicio de aseo y vigilancia", "Gasto")
+
+    assert RecordingModel.prompts == []
+    assert result["specific_code"] == "51350502"
+
+
+class CountingPUCRepository(StubPUCRepository):
+    def __init__(self) -> None:
+        self.calls = 0
+
+    def list_by_owner(self, owner_id, search=None, limit=10000, offset=0):
+        self.calls += 1
+        return super().list_by_owner(owner_id, search, limit, offset)
+
+
+def test_owner_accounts_are_cached_until_invalidated() -> None:
+    repository = CountingPUCRepository()
+    service = PUCMapperService(puc_repository=repository)
+
+    first = service.load_accounts_for_owner("owner-1")
+    second = service.load_accounts_for_owner("owner-1")
+    service.invalidate("owner-1")
+    service.load_accounts_for_owner("owner-1")
+
+    assert first is second
+    assert repository.calls == 2
+
+
+def test_batch_prompt_lists_shared_candidates_once_per_generic_code() -> None:
+    service = PUCMapperService()
+    candidates = [
+        puc_mapper.PUCAccount("41350501", "Venta de equipos", "Ingresos", "", "Transaccional"),
+        puc_mapper.PUCAccount("41350502", "Venta de licencias", "Ingresos", "", "Transaccional"),
+    ]
+    items = [({"generic_code": "4135", "description": f"Venta {i}", "rationale": ""}, candidates) for i in range(3)]
+
+    prompt = service._build_batch_mapping_prompt(items)
+
+    assert prompt.count("41350501 - Venta de equipos") == 1
+    assert prompt.count("CÓDIGO GENÉRICO: 4135") == 3
+
+
+def test_cached_owner_catalog_sends_only_the_items(monkeypatch) -> None:
+    cached_model = RecordingModel()
+    created: list[str] = []
+    monkeypatch.setattr(gemini_common, "CACHED_PREFIX_MIN_CHARS", 0)
+    monkeypatch.setattr(
+        puc_mapper.genai.caching.CachedContent, "create", lambda **kwargs: created.append(kwargs["contents"][0])
+    )
+    monkeypatch.setattr(puc_mapper.genai.GenerativeModel, "from_cached_content", lambda cached: cached_model)
+    RecordingModel.prompts = []
+    service = PUCMapperService(puc_repository=StubPUCRepository())
+    service._initialized = True
+    service._model = object()
+    requests = [
+        {"generic_code": "4135", "description": "Licencia anual", "rationale": "Venta"},
+        {"generic_code": "5135", "description": "Servicio", "rationale": "Gasto"},
+    ]
+
+    service.map_to_specific_accounts_batch("owner-1", requests)
+    service.map_to_specific_accounts_batch(
+        "owner-1", [{**request, "description": f"{request['description']} mensual"} for request in requests]
+    )
+
+    assert len(created) == 1 and "42950501 - Ingresos diversos" in created[0]
+    assert len(RecordingModel.prompts) == 2
+    assert RecordingModel.prompts[0].startswith("ITEM 1:") and "RESPONDE" not in RecordingModel.prompts[0]
+
+
+def test_equivalent_descriptions_reuse_the_cached_mapping() -> None:
+    RecordingModel.prompts = []
+    service = PUCMapperService(puc_repository=StubPUCRepository())
+    service._initialized = True
+    service._model = RecordingModel()
+
+    first = service.map_to_specific_account("owner-1", "4135", "Licencia anual 2024", "Venta")
+    second = service.map_to_specific_account("owner-1", "4135", "ANUAL licencia 2025", "Venta")
+
+    assert len(RecordingModel.prompts) == 1
+    assert second == first
+
+
+def test_prompt_keeps_only_the_most_related_candidates() -> None:
+    service = PUCMapperService()
+    filler = [
+        puc_mapper.PUCAccount(f"5135{idx:04d}", f"Gasto operativo {idx}", "Gastos", "", "Transaccional")
+        for idx in range(30)
+    ]
+    target = puc_mapper.PUCAccount("51359999", "Servicio de vigilancia", "Gastos", "", "Transaccional")
+    request = {"generic_code": "5135", "description": "Vigilancia nocturna", "rationale": "Servicio"}
+
+    prompt = service._build_batch_mapping_prompt([(request, filler + [target])])
+
+    assert "51359999 - Servicio de vigilancia" in prompt
+    assert prompt.count("Gasto operativo") == 7
+
+
+def test_shared_generic_code_keeps_each_items_best_candidates() -> None:
+    service = PUCMapperService()
+    candidates = [
+        puc_mapper.PUCAccount(f"5135{idx:04d}", f"Gasto tema{idx // 8} detalle{idx}", "Gastos", "", "Transaccional")
+        for idx in range(32)
+    ]
+    items = [
+        ({"generic_code": "5135", "description": f"Servicio tema{topic}", "rationale": ""}, candidates)
+        for topic in range(4)
+    ]
+
+    prompt = service._build_batch_mapping_prompt(items)
+
+    # 4 ítems × 8 candidatas afines > 20: cada ítem conserva al menos 5 de las suyas
+    for topic in range(4):
+        assert prompt.count(f"tema{topic} ") >= 5
+    assert prompt.count(" - Gasto tema") == 20
+
+
+def test_reset_repositories_rebuilds_the_mapper_with_the_new_repository(monkeypatch) -> None:
+    from app.config import dependencies
+
+    first_repository, second_repository = StubPUCRepository(), StubPUCRepository()
+    monkeypatch.setattr(dependencies, "get_puc_repository", lambda: first_repository)
+    dependencies.reset_repositories()
+    first = dependencies.get_puc_mapper()
+
+    monkeypatch.setattr(dependencies, "get_puc_repository", lambda: second_repository)
+    dependencies.reset_repositories()
+    second = dependencies.get_puc_mapper()
+    dependencies.reset_repositories()  # no dejar el mapper con el stub para las demás pruebas
+
+    assert first.puc_repository is first_repository
+    assert second is not first and second.puc_repository is second_repository
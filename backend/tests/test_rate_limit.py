@@ -0,0 +1,24 @@
+from types import SimpleNamespace
+
+from app.infrastructure.services.rate_limit import GeminiRateLimiter, TokenBucket
+
+
+def test_token_bucket_refund_restores_capacity() -> None:
+    bucket = TokenBucket(per_minute=600)
+
+    bucket.acquire(600)
+    bucket.refund(300)
+    bucket.acquire(250)
+
+    assert bucket._available < 60
+
+
+def test_rate_limiter_settles_with_actual_usage() -> None:
+    limiter = GeminiRateLimiter(requests_per_minute=10, tokens_per_minute=10_000)
+    estimated = limiter.estimate_tokens("x" * 4000, max_output_tokens=1000)
+
+    limiter.acquire(estimated)
+    limiter.settle(estimated, SimpleNamespace(total_token_count=500))
+
+    assert estimated == 2000
+    assert limiter.tokens._available >= 9_500
@@ -0,0 +1,37 @@
+import pytest
+from jwt.exceptions import ExpiredSignatureError
+
+from app.infrastructure.services.token import JWTTokenService
+
+
+def test_verify_token_reuses_cached_payload(monkeypatch) -> None:
+    service = JWTTokenService(secret_key="secreto")
+    token = service.create_access_token("user-1")
+    first = service.verify_token(token)
+
+    def fail_decode(*args, **kwargs):
+        raise AssertionError("no debería decodificarse de nuevo")
+
+    monkeypatch.setattr("app.infrastructure.services.token.jwt.decode", fail_decode)
+    second = service.verify_token(token)
+
+    assert second == first and second["sub"] == "user-1"
+    assert second is not first
+
+
+def test_expired_cached_token_is_verified_again(monkeypatch) -> None:
+    service = JWTTokenService(secret_key="secreto")
+    token = service.create_access_token("user-1")
+    service.verify_token(token)
+    calls: list[str] = []
+
+    def counting_decode(value, *args, **kwargs):
+        calls.append(value)
+        raise ExpiredSignatureError("Signature has expired")
+
+    monkeypatch.setattr("app.infrastructure.services.token.time.time", lambda: 4_000_000_000.0)
+    monkeypatch.setattr("app.infrastructure.services.token.jwt.decode", counting_decode)
+
+    with pytest.raises(ValueError):
+        service.verify_token(token)
+    assert calls == [token]